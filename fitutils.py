@@ -6,6 +6,8 @@ import matplotlib.pyplot as plt
 from sklearn.neighbors import LocalOutlierFactor
 from sklearn.preprocessing import RobustScaler
 from scipy.spatial import distance
+from scipy import signal
+import warnings
 from collections import deque as dq
 
 def clean_lists(x_list, y_list, a_list, b_list, t_list, v_list, n_list, c_list, g_list):
@@ -131,7 +133,285 @@ def filter_outliers(params, outlier_params = ('x','y','e','v','n'),
 
 
 
-def smooth_estimates(params, max_frames=0, hl=3):
+ELLIPSE_PARAMS = ('x', 'y', 'a', 'b', 't')
+# theta only means anything mod pi (see clean_lists), the rest don't wrap
+ELLIPSE_PERIODS = np.array([np.nan, np.nan, np.nan, np.nan, np.pi])
+# default measurement noise variance of each, px^2 and rad^2
+ELLIPSE_NOISE = np.array([1., 1., 1., 1., 0.01])
+
+
+def wrap_diff(d, periods=ELLIPSE_PERIODS):
+    # shortest difference for params that wrap around, others unchanged
+    d = np.array(d, dtype=np.float64)
+    wraps = np.isfinite(periods) & np.ones(d.shape, dtype=bool)
+    p = np.broadcast_to(periods, d.shape)[wraps]
+    d[wraps] = d[wraps] - p * np.round(d[wraps] / p)
+    return d
+
+
+def halflife_noise(r, hl):
+    # process noise for a constant velocity kalman filter w/ measurement noise r whose
+    # steady state position gain matches an exponentially weighted mean with halflife hl
+    # (the alpha-beta filter's tracking index, Kalata 1984)
+    alpha = 1. - 0.5 ** (1. / hl)
+    beta = 2. * (2. - alpha) - 4. * np.sqrt(1. - alpha)
+    return np.asarray(r, dtype=np.float64) * beta ** 2 / (1. - alpha)
+
+
+def measurement_noise(z, default=ELLIPSE_NOISE, periods=ELLIPSE_PERIODS):
+    # robust estimate of the measurement noise variance of each column of z (frames x params)
+    # from its second differences, which for white noise have 6x its variance. nans are skipped.
+    # columns without three consecutive measurements get default instead
+    z = np.asarray(z, dtype=np.float64)
+    n_params = z.shape[1]
+    if np.size(default) != 1 and len(default) != n_params:
+        default = 1.
+    if periods is not None and len(periods) != n_params:
+        periods = None
+
+    if len(z) < 3:
+        return np.ones(n_params) * default
+
+    d2 = np.diff(z, n=2, axis=0)
+    if periods is not None:
+        d2 = wrap_diff(d2, periods)
+    with warnings.catch_warnings():
+        # all nan columns
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mad = np.nanmedian(np.abs(d2 - np.nanmedian(d2, axis=0)), axis=0)
+    r = np.maximum((1.4826 * mad) ** 2 / 6., 1e-12)
+    return np.where(np.isfinite(r), r, default)
+
+
+def major_first(params):
+    # (x, y, a, b, t) with a as the major axis and t in [0, pi), like clean_lists does for dataframes
+    x, y, a, b, t = params
+    if b > a:
+        a, b = b, a
+        t = t + np.pi / 2
+    return np.array([x, y, a, b, np.mod(t, np.pi)], dtype=np.float64)
+
+
+class EllipseKalman(object):
+    """
+    Online constant velocity kalman filter over ellipse params (x, y, a, b, t).
+
+    Every param gets its own position/velocity state with white noise acceleration,
+    so the 2x2 covariances are kept as their three unique entries for all params at once
+    and each frame is O(1). theta wraps around at pi.
+
+    r: measurement noise variance for each param, in their units (px^2, rad^2)
+    q: process noise (acceleration) variance for each param, or
+    hl: if q isn't given, set it so the filter smooths about like an ewm with this halflife
+
+    Use predict() to get where the pupil should be this frame (eg. to center a search window),
+    then update() with what was measured, None or nans if nothing was.
+    """
+
+    def __init__(self, r=ELLIPSE_NOISE, q=None, hl=3, periods=ELLIPSE_PERIODS):
+        self.r = np.asarray(r, dtype=np.float64)
+        if q is None:
+            q = halflife_noise(self.r, hl)
+        self.q = np.asarray(q, dtype=np.float64)
+        self.periods = periods
+        self.reset()
+
+    def reset(self):
+        self.p = None
+        self.v = np.zeros(5)
+        self.P00 = np.zeros(5)
+        self.P01 = np.zeros(5)
+        self.P11 = np.zeros(5)
+
+    def predict(self, dt=1.):
+        # advance dt frames, return the predicted params (None before the first measurement)
+        if self.p is None:
+            return None
+        self.p, self.P00, self.P01, self.P11 = kalman_predict(self.p, self.v, self.P00, self.P01, self.P11,
+                                                              self.q, dt)
+        return self.p.copy()
+
+    def update(self, z):
+        # fold in measured params, returns the filtered params
+        if z is None:
+            return None if self.p is None else self.p.copy()
+        z = np.asarray(z, dtype=np.float64)
+
+        if self.p is None:
+            # start at the first complete measurement, not moving, with a wide velocity prior
+            if not np.all(np.isfinite(z)):
+                return None
+            self.p = z.copy()
+            self.v = np.zeros(5)
+            self.P00 = self.r.copy()
+            self.P01 = np.zeros(5)
+            self.P11 = self.r.copy() + self.q
+            return self.p.copy()
+
+        self.p, self.v, self.P00, self.P01, self.P11 = kalman_update(self.p, self.v, self.P00, self.P01, self.P11,
+                                                                     z, self.r, self.periods)
+        if self.periods is not None:
+            self.p = wrap_params(self.p, self.periods)
+        return self.p.copy()
+
+    def std(self):
+        # standard deviation of the current estimate of each param
+        return np.sqrt(self.P00)
+
+
+def wrap_params(p, periods=ELLIPSE_PERIODS):
+    # put wrapping params back in [0, period)
+    p = np.array(p, dtype=np.float64)
+    wraps = np.isfinite(periods) & np.ones(p.shape, dtype=bool)
+    per = np.broadcast_to(periods, p.shape)[wraps]
+    p[wraps] = np.mod(p[wraps], per)
+    return p
+
+
+def kalman_predict(p, v, P00, P01, P11, q, dt=1.):
+    # constant velocity prediction for independent params, covariances as their unique entries
+    p = p + dt * v
+    P00 = P00 + 2. * dt * P01 + dt ** 2 * P11 + q * dt ** 4 / 4.
+    P01 = P01 + dt * P11 + q * dt ** 3 / 2.
+    P11 = P11 + q * dt ** 2
+    return p, P00, P01, P11
+
+
+def kalman_update(p, v, P00, P01, P11, z, r, periods=ELLIPSE_PERIODS):
+    # measurement update for independent params observing position only, nans in z are skipped
+    y = z - p
+    if periods is not None:
+        y = wrap_diff(y, periods)
+    seen = np.isfinite(y)
+    y = np.where(seen, y, 0.)
+
+    S = P00 + r
+    K0 = np.where(seen, P00 / S, 0.)
+    K1 = np.where(seen, P01 / S, 0.)
+
+    p = p + K0 * y
+    v = v + K1 * y
+    P11 = P11 - K1 * P01
+    P00, P01 = (1. - K0) * P00, (1. - K0) * P01
+    return p, v, P00, P01, P11
+
+
+def steady_state_gains(r, q):
+    # the constant velocity filter's gains settle to those of an alpha-beta filter, which
+    # (the other way around from halflife_noise) have closed forms in the tracking index sqrt(q/r).
+    # returns alpha, beta, and the unique entries (00, 01, 11) of the steady state
+    # predicted and filtered covariances, for each param
+    r = np.asarray(r, dtype=np.float64)
+    q = np.asarray(q, dtype=np.float64)
+    lam = np.sqrt(q / r)
+    s = (4. + lam - np.sqrt(8. * lam + lam ** 2)) / 4.
+    alpha = 1. - s ** 2
+    beta = 2. * (2. - alpha) - 4. * s
+
+    # innovation variance, then the covariances from P = F P F' + Q at steady state
+    S = r / (1. - alpha)
+    P_pred = (alpha * S, beta * S, alpha * beta * S + beta ** 2 * S / 2.)
+    P_filt = (alpha * r, beta * r, beta * S * (alpha - beta / 2.))
+    return alpha, beta, P_pred, P_filt
+
+
+def kalman_smooth(z, r=None, q=None, hl=3, periods=ELLIPSE_PERIODS):
+    """
+    Kalman filter and Rauch-Tung-Striebel smooth a whole session of ellipse params at once.
+
+    z: (n_frames, n_params) measurements, one row per frame, nan where there wasn't one
+    r, q, hl: like EllipseKalman, r is estimated from z if not given
+
+    With the filter at its steady state (see steady_state_gains) both passes are fixed linear
+    filters, so they're run with scipy.signal.lfilter over all frames rather than frame by frame.
+    That needs a measurement every frame, so frames without one are linearly interpolated from
+    their neighbors first, and params that wrap (theta) are unwrapped.
+    The only difference from the time varying filter is in the first few frames, where it
+    would trust the measurements more while it settles.
+
+    Returns smoothed (n_frames, n_params) params, all nan for params that were never measured.
+    """
+    z = np.array(z, dtype=np.float64)
+    n_frames, n_params = z.shape
+    if periods is not None and len(periods) != n_params:
+        periods = None
+    if r is None:
+        r = measurement_noise(z, periods=periods)
+    r = np.asarray(r, dtype=np.float64) * np.ones(n_params)
+    if q is None:
+        q = halflife_noise(r, hl)
+    q = np.asarray(q, dtype=np.float64) * np.ones(n_params)
+
+    alpha, beta, P_pred, P_filt = steady_state_gains(r, q)
+
+    frames = np.arange(n_frames)
+    smoothed = np.full((n_frames, n_params), np.nan)
+    for i in range(n_params):
+        seen = np.isfinite(z[:, i])
+        if not np.any(seen):
+            continue
+
+        z_i = z[seen, i]
+        if periods is not None and np.isfinite(periods[i]):
+            z_i = np.unwrap(z_i * 2. * np.pi / periods[i]) * periods[i] / (2. * np.pi)
+        z_i = np.interp(frames, frames[seen], z_i)
+
+        smoothed[:, i] = steady_state_smooth(z_i, alpha[i], beta[i],
+                                             [P[i] for P in P_pred], [P[i] for P in P_filt])
+
+    if periods is not None:
+        smoothed = wrap_params(smoothed, periods)
+    return smoothed
+
+
+def steady_state_smooth(z, alpha, beta, P_pred, P_filt):
+    # forward alpha-beta filter and steady state RTS backward pass over a 1d series w/o gaps.
+    # P_pred and P_filt are the unique entries of the steady state covariances
+    if len(z) < 2:
+        return z.copy()
+
+    # forward: p_t = (1-alpha)(p + v)_{t-1} + alpha z_t, v_t = v_{t-1} - beta (p + v)_{t-1} + beta z_t
+    # starting from p = z_0 and not moving
+    den = np.array([1., alpha + beta - 2., 1. - alpha])
+    num_p = np.array([alpha, beta - alpha])
+    num_v = np.array([beta, -beta])
+    p, _ = signal.lfilter(num_p, den, z, zi=signal.lfilter_zi(num_p, den) * z[0])
+    v, _ = signal.lfilter(num_v, den, z, zi=signal.lfilter_zi(num_v, den) * z[0])
+
+    # backward: x_t = x_filt_t + C (x_{t+1} - F x_filt_t) = C x_{t+1} + G x_filt_t,
+    # with C = P_filt F' P_pred^-1 and G = I - C F, for F = [[1, 1], [0, 1]]
+    f00, f01, f11 = P_filt
+    a00, a01, a11 = P_pred
+    det = a00 * a11 - a01 ** 2
+    B = np.array([[f00 + f01, f01], [f01 + f11, f11]])
+    C = B.dot(np.array([[a11, -a01], [-a01, a00]])) / det
+    G = np.eye(2) - C.dot(np.array([[1., 1.], [0., 1.]]))
+
+    # response to the filtered states, run in reverse
+    p_rev, v_rev = p[::-1], v[::-1]
+    smoothed = np.zeros(len(z))
+    for j, x_filt in enumerate((p_rev, v_rev)):
+        num, den_c = signal.ss2tf(C, G[:, j:j+1], C[0:1, :], G[0:1, j:j+1])
+        smoothed += signal.lfilter(num[0], den_c, x_filt)
+
+    # plus the response to the state after the last frame, the prediction F x_filt_T,
+    # which makes the last frame's smoothed estimate its filtered one
+    state = np.array([p_rev[0] + v_rev[0], v_rev[0]])
+    h = [C.dot(state), C.dot(C.dot(state))]
+    homog = np.zeros(len(z))
+    homog[0] = h[0][0]
+    homog[1] = h[1][0]
+    if len(z) > 2:
+        homog[2:], _ = signal.lfilter([1.], den_c, np.zeros(len(z) - 2),
+                                      zi=signal.lfiltic([1.], den_c, [homog[1], homog[0]]))
+    smoothed += homog
+
+    return smoothed[::-1]
+
+
+def smooth_estimates(params, max_frames=0, hl=3, r=None, q=None):
+    # smooth the ellipse params over frames with kalman_smooth, and fill in frames w/o estimates.
+    # hl sets how much to smooth, like the halflife of an ewm. other columns are interpolated
     if 'n' in params.keys():
         params_smooth = params.groupby('n').mean()
 
@@ -140,24 +420,26 @@ def smooth_estimates(params, max_frames=0, hl=3):
     else:
         params_smooth = params.copy()
 
-    # filter each parameter column:
-    for p in ['a','b','x','y']:
-        fwd = params_smooth[p].ewm(halflife=hl).mean()
-        bwd = params_smooth[p][::-1].ewm(halflife=hl).mean()
-        smoothed = np.mean(np.column_stack((fwd, bwd)), axis=1)
-        params_smooth[p] = smoothed
-
-    # reindex and interpolate
+    # reindex
     if max_frames != 0:
-        frame_inds = np.linspace(0, max_frames, max_frames+1, dtype=np.int)
+        frame_inds = np.linspace(0, max_frames, max_frames+1, dtype=np.int64)
     else:
         max_frames = params['n'].max()
-        frame_inds = np.linspace(0, max_frames, max_frames + 1, dtype=np.int)
+        frame_inds = np.linspace(0, max_frames, max_frames + 1, dtype=np.int64)
 
     params_smooth = params_smooth.reindex(frame_inds)
 
+    # filter the ellipse params together (theta wraps), missing frames are interpolated by kalman_smooth
+    ell_cols = [p for p in ELLIPSE_PARAMS if p in params_smooth.keys()]
+    periods = ELLIPSE_PERIODS if len(ell_cols) == len(ELLIPSE_PARAMS) else None
+    if len(ell_cols) > 0:
+        params_smooth[ell_cols] = kalman_smooth(params_smooth[ell_cols].values, r=r, q=q, hl=hl,
+                                                periods=periods)
+
     for p in params_smooth.keys():
-        params_smooth[p].interpolate(method='cubic', limit_direction='both', inplace=True)
+        if p in ell_cols:
+            continue
+        params_smooth[p] = params_smooth[p].interpolate(method='cubic', limit_direction='both')
 
     return params_smooth
 
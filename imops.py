@@ -3,7 +3,7 @@ np.seterr(divide='ignore')
 np.seterr(invalid='ignore')
 import cv2
 from scipy.spatial.distance import euclidean
-from scipy.spatial import distance
+from scipy.spatial import distance, cKDTree, ConvexHull
 from skimage import filters, exposure, feature, morphology, measure, img_as_float
 from collections import deque as dq
 from pandas import ewma, ewmstd
@@ -29,11 +29,56 @@ def invert_color(im):
         return 1.-im
 
 
+class ShapeConstants(object):
+    """
+    Things the per-frame functions need that only depend on the frame shape
+    (or on params that are fixed for a whole video), built the first time they're asked for.
+
+    Get them with shape_constants(shape) so there's one per shape per process:
+        - disk(radius): structuring element for closing in preprocess_image
+        - trig(n_thetas): cos/sin of the angles points are predicted at along an ellipse
+        - rows, cols: open grids of row & column indices, like np.ogrid
+        - workspace: a CannyWorkspace, with the border mask & buffers for scharr_canny
+    """
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+        self.rows, self.cols = np.ogrid[:self.shape[0], :self.shape[1]]
+        self._disks = {}
+        self._trig = {}
+        self._workspace = None
+
+    def disk(self, radius):
+        if radius not in self._disks:
+            self._disks[radius] = morphology.disk(radius)
+        return self._disks[radius]
+
+    def trig(self, n_thetas):
+        if n_thetas not in self._trig:
+            thetas = np.linspace(0, np.pi*2, n_thetas)
+            self._trig[n_thetas] = (np.cos(thetas), np.sin(thetas))
+        return self._trig[n_thetas]
+
+    @property
+    def workspace(self):
+        if self._workspace is None:
+            self._workspace = CannyWorkspace(self.shape)
+        return self._workspace
+
+
+SHAPE_CONSTANTS = {}
+
+def shape_constants(shape):
+    shape = tuple(shape)
+    if shape not in SHAPE_CONSTANTS:
+        SHAPE_CONSTANTS[shape] = ShapeConstants(shape)
+    return SHAPE_CONSTANTS[shape]
+
+
 def circle_mask(frame, ix, iy, rad):
     # get a boolean mask from circular parameters
-    nx, ny = frame.shape
-    pmask_x, pmask_y = np.ogrid[-iy:nx - iy, -ix:ny - ix]
-    pmask = pmask_x ** 2 + pmask_y ** 2 <= rad ** 2
+    consts = shape_constants(frame.shape)
+    pmask = (consts.rows - iy) ** 2 + (consts.cols - ix) ** 2 <= rad ** 2
 
     return pmask
 
@@ -53,7 +98,99 @@ def edges2xy(edges, which_edge=None, order=True):
     return edges_xy
 
 
-def preprocess_image(img, roi = None, gauss_sig=None, sig_cutoff=None, sig_gain=None, closing=3):
+def labeled2xy(labeled_edges, small_thresh=0, order=True):
+    # get the coordinates of every labeled edge in one pass, rather than
+    # an np.where over the whole image for each label.
+    # returns a list of (row, col) arrays, one per label, in label order.
+    # edges with small_thresh points or fewer are dropped before ordering.
+    flat_labels = labeled_edges.ravel()
+    flat_inds = np.flatnonzero(flat_labels)
+    if len(flat_inds) == 0:
+        return []
+
+    # stable sort so points within each label stay in raster order,
+    # same as np.where would give us
+    labels = flat_labels[flat_inds]
+    sort_inds = np.argsort(labels, kind='mergesort')
+    flat_inds, labels = flat_inds[sort_inds], labels[sort_inds]
+
+    rows, cols = np.unravel_index(flat_inds, labeled_edges.shape)
+    points = np.column_stack((rows, cols))
+
+    split_inds = np.flatnonzero(np.diff(labels)) + 1
+    edges_xy = np.split(points, split_inds)
+
+    edges_xy = [e for e in edges_xy if len(e) > small_thresh]
+
+    # reorder so points are in spatial order (rather than axis=0 order)
+    if order:
+        edges_xy = [order_points(e) for e in edges_xy]
+
+    return edges_xy
+
+
+def equalize_lut(hist, invert=True):
+    # 256 entry lookup table that equalizes a uint8 image with this 256 bin histogram,
+    # the same as exposure.equalize_hist (of invert_color(img) if invert)
+    hist = np.asarray(hist, dtype=np.float64)
+    if invert:
+        hist = hist[::-1]
+    cdf = np.cumsum(hist)
+    cdf /= cdf[-1]
+    if invert:
+        cdf = cdf[::-1]
+    return cdf
+
+
+class Equalizer(object):
+    """
+    Reuse the histogram equalization lookup table between frames while the illumination is stable.
+
+    Keeps a running histogram (decayed by decay each frame, from every stride-th pixel) and
+    only remakes the table from the full frame when the running cdf has drifted more than drift
+    away from the cdf the table was made from. The drift is in equalized intensity (0-1),
+    so it bounds how far the reused table can be from equalizing the current frame.
+
+    One per video, frames should be given in order. Turn it on with params['eq_drift'].
+    """
+
+    def __init__(self, drift=0.02, decay=0.5, stride=2):
+        self.drift = drift
+        self.decay = decay
+        self.stride = stride
+        self.running = None
+        self.ref_cdf = None
+        self.table = None
+        self.n_remade = 0
+
+    def lut(self, img):
+        # equalization table for this uint8 frame, like equalize_lut(hist) of the frame
+        if self.table is not None:
+            hist = cv2.calcHist([img[::self.stride, ::self.stride]], [0], None, [256], [0, 256]).ravel()
+            self.running *= self.decay
+            self.running += (1.-self.decay) * (hist / hist.sum())
+            if np.max(np.abs(np.cumsum(self.running) - self.ref_cdf)) <= self.drift:
+                return self.table
+
+        hist = cv2.calcHist([img], [0], None, [256], [0, 256]).ravel()
+        self.running = hist / hist.sum()
+        self.ref_cdf = np.cumsum(self.running)
+        self.table = equalize_lut(hist)
+        self.n_remade += 1
+        return self.table
+
+
+def sigmoid_lut(lut, sig_cutoff, sig_gain):
+    # exposure.adjust_sigmoid applied to the values of a lookup table
+    return 1. / (1. + np.exp(sig_gain * (sig_cutoff - lut)))
+
+
+def preprocess_image(img, roi = None, gauss_sig=None, sig_cutoff=None, sig_gain=None, closing=3, fast=True,
+                     equalizer=None):
+    # fast: for uint8 images, fold the inversion, histogram equalization and sigmoid into one
+    # 256 entry lookup table, stay in float32 and close with cv2 (see preprocess_uint8).
+    # otherwise go through skimage in float64.
+    # equalizer: an Equalizer to reuse the equalization from previous frames (fast path only)
     if len(img.shape)>2:
         # TODO: this is what i'm talking about -- respect the --gray cmd line param.
         img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -62,6 +199,10 @@ def preprocess_image(img, roi = None, gauss_sig=None, sig_cutoff=None, sig_gain=
         img = crop(img, roi)
     # otherwise we've got a recolored/cropped image already
 
+    if fast and img.dtype == np.uint8:
+        return preprocess_uint8(img, gauss_sig=gauss_sig, sig_cutoff=sig_cutoff,
+                                sig_gain=sig_gain, closing=closing, equalizer=equalizer)
+
     img = invert_color(img)
 
     img = exposure.equalize_hist(img)
@@ -73,7 +214,33 @@ def preprocess_image(img, roi = None, gauss_sig=None, sig_cutoff=None, sig_gain=
     if sig_cutoff and sig_gain:
         img = exposure.adjust_sigmoid(img, cutoff=sig_cutoff, gain=sig_gain)
 
-    img = morphology.closing(img, selem=morphology.disk(closing))
+    img = morphology.closing(img, selem=shape_constants(img.shape).disk(closing))
+
+    return img
+
+
+def preprocess_uint8(img, gauss_sig=None, sig_cutoff=None, sig_gain=None, closing=3, equalizer=None):
+    # preprocess_image for a grayscale, cropped uint8 image with lookup tables, returns float32.
+    # matches the skimage path to float32 precision (unless an Equalizer reuses an older table).
+    if equalizer is not None:
+        lut = equalizer.lut(img)
+    else:
+        hist = cv2.calcHist([img], [0], None, [256], [0, 256]).ravel()
+        lut = equalize_lut(hist)
+
+    if gauss_sig:
+        # have to blur the equalized image before the sigmoid
+        img = cv2.LUT(img, lut.astype(np.float32))
+        img = cv2.GaussianBlur(img, ksize=(0, 0), sigmaX=gauss_sig, borderType=cv2.BORDER_REPLICATE)
+        if sig_cutoff and sig_gain:
+            img = sigmoid_lut(img, sig_cutoff, sig_gain).astype(np.float32)
+    else:
+        if sig_cutoff and sig_gain:
+            lut = sigmoid_lut(lut, sig_cutoff, sig_gain)
+        img = cv2.LUT(img, lut.astype(np.float32))
+
+    selem = shape_constants(img.shape).disk(closing).astype(np.uint8)
+    img = cv2.morphologyEx(img, cv2.MORPH_CLOSE, selem)
 
     return img
 
@@ -92,10 +259,238 @@ def fit_ellipse(edges, which_edge=1):
         #return ellipse, resid
         return ellipse
 
+
+def fit_ellipses(edges_xy):
+    # fit ellipses to many point sets at once, rather than making an EllipseModel for each.
+    # edges_xy is a list of (n, 2) point arrays (eg. all the edges of a frame, or of many frames)
+    # returns an (N, 5) array of (x, y, a, b, theta) params, like EllipseModel.params,
+    # and a boolean mask of which fits succeeded (failed fits have params of 0).
+    #
+    # numerically stable direct least squares, same as skimage's EllipseModel.estimate:
+    # Halir, R.; Flusser, J. "Numerically stable direct least squares fitting of ellipses"
+    # but with all the 3x3 linear algebra stacked.
+    n_edges = len(edges_xy)
+    params = np.zeros((n_edges, 5))
+    success = np.zeros(n_edges, dtype=bool)
+    if n_edges == 0:
+        return params, success
+
+    lens = np.array([len(e) for e in edges_xy])
+    offsets = np.concatenate(([0], np.cumsum(lens)[:-1]))
+    # reduceat can't handle empty point sets, they're failed anyway
+    has_points = lens > 0
+    offsets, lens = offsets[has_points], lens[has_points]
+    points = np.row_stack([e for e in edges_xy if len(e) > 0]).astype(np.float64)
+
+    # center and scale each point set to avoid numeric errors when the
+    # ellipse is small compared to its distance from the origin.
+    # the fit is invariant to both, so we just undo it at the end
+    origins = np.add.reduceat(points, offsets, axis=0) / lens[:, np.newaxis]
+    points = points - np.repeat(origins, lens, axis=0)
+    scales = np.sqrt(np.add.reduceat(np.sum(points**2, axis=1), offsets) / (2.*lens))
+    scales[scales == 0] = 1.
+    points = points / np.repeat(scales, lens)[:, np.newaxis]
+
+    x, y = points[:, 0], points[:, 1]
+
+    # quadratic and linear parts of the design matrix
+    # and all the scatter matrices for each point set at once
+    design = np.column_stack((x**2, x*y, y**2, x, y, np.ones(len(x))))
+    scatter = np.add.reduceat(design[:, :, np.newaxis] * design[:, np.newaxis, :], offsets, axis=0)
+    S1 = scatter[:, :3, :3]
+    S2 = scatter[:, :3, 3:]
+    S3 = scatter[:, 3:, 3:]
+
+    # need at least 5 points and an invertible S3
+    ok = (lens >= 5) & (np.abs(np.linalg.det(S3)) > 1e-12)
+    S3[~ok] = np.eye(3)
+    S3_inv = np.linalg.inv(S3)
+
+    # reduced scatter matrix, with the inverse of the constraint matrix
+    C1_inv = np.linalg.inv(np.array([[0., 0., 2.], [0., -1., 0.], [2., 0., 0.]]))
+    T = -np.matmul(S3_inv, np.transpose(S2, (0, 2, 1)))
+    M = np.matmul(C1_inv, S1 + np.matmul(S2, T))
+    M[~ok] = np.eye(3)
+
+    eig_vals, eig_vecs = np.linalg.eig(M)
+    eig_vecs = np.real(eig_vecs)
+
+    # eigenvector must meet constraint 4ac - b^2 > 0 to be valid, and there should only be one
+    cond = 4 * eig_vecs[:, 0, :] * eig_vecs[:, 2, :] - eig_vecs[:, 1, :]**2
+    ok &= np.sum(cond > 0, axis=1) == 1
+    a1 = eig_vecs[np.arange(len(eig_vecs)), :, np.argmax(cond > 0, axis=1)]
+    a2 = np.matmul(T, a1[:, :, np.newaxis])[:, :, 0]
+
+    # general form a*x^2 + 2*b*x*y + c*y^2 + 2*d*x + 2*f*y + g = 0
+    a, b, c = a1[:, 0], a1[:, 1]/2., a1[:, 2]
+    d, f, g = a2[:, 0]/2., a2[:, 1]/2., a2[:, 2]
+
+    # center, semi-axes and angle, see http://mathworld.wolfram.com/Ellipse.html
+    x0 = (c * d - b * f) / (b ** 2. - a * c)
+    y0 = (a * f - b * d) / (b ** 2. - a * c)
+    numerator = a * f ** 2 + c * d ** 2 + g * b ** 2 - 2 * b * d * f - a * c * g
+    term = np.sqrt((a - c) ** 2 + 4 * b ** 2)
+    denominator1 = (b ** 2 - a * c) * (term - (a + c))
+    denominator2 = (b ** 2 - a * c) * (- term - (a + c))
+    width = np.sqrt(2 * numerator / denominator1)
+    height = np.sqrt(2 * numerator / denominator2)
+    phi = 0.5 * np.arctan((2. * b) / (a - c))
+    phi[a > c] += 0.5 * np.pi
+
+    fit_params = np.nan_to_num(np.column_stack((x0, y0, width, height, phi)))
+    fit_params[:, :4] *= scales[:, np.newaxis]
+    fit_params[:, :2] += origins
+    fit_params[~ok, :] = 0.
+
+    params[has_points] = fit_params
+    success[has_points] = ok
+
+    return params, success
+
+
+def score_ellipses(ell_params, n_pts, frame, edge_mag, n_thetas=200):
+    # quality metrics for all the fitted ellipses of a frame at once.
+    # ell_params is an (N, 5) array of (x, y, a, b, theta), like from fit_ellipses,
+    # with x/y in (row, col) image coordinates like the edge points they were fit to.
+    # returns arrays of
+    #   c: coverage - n_points/perimeter
+    #   g: mean edge magnitude at points along the ellipse
+    #   v: mean value of the frame within the ellipse
+    ell_params = np.asarray(ell_params, dtype=np.float64).reshape(-1, 5)
+    n_pts = np.asarray(n_pts, dtype=np.float64)
+    x0, y0, a, b, t = [ell_params[:, i:i+1] for i in range(5)]
+
+    # coverage - number of points vs. circumference
+    # perim: https://stackoverflow.com/a/42311034
+    perimeter = np.pi * (3 * (a + b) - np.sqrt((3 * a + b) * (a + 3 * b)))
+    c = n_pts / perimeter[:, 0]
+
+    # get the mean edge mag for predicted points on the ellipse,
+    # off-target ellipses often go through the pupil aka through areas with low gradients...
+    # (same points as EllipseModel.predict_xy, for every ellipse at once)
+    cos_p, sin_p = shape_constants(frame.shape).trig(n_thetas)
+    cos_t, sin_t = np.cos(t), np.sin(t)
+    e_rows = x0 + a * cos_p * cos_t - b * sin_p * sin_t
+    e_cols = y0 + a * cos_p * sin_t + b * sin_p * cos_t
+    e_rows = np.clip(np.nan_to_num(np.round(e_rows)), 0, frame.shape[0] - 1).astype(np.int64)
+    e_cols = np.clip(np.nan_to_num(np.round(e_cols)), 0, frame.shape[1] - 1).astype(np.int64)
+    g = np.mean(edge_mag[e_rows, e_cols], axis=1)
+
+    v = ellipse_means(ell_params, frame)
+
+    return c, g, v
+
+
+def ellipse_means(ell_params, frame):
+    # mean value of the frame within each ellipse, without drawing a mask for each one.
+    # each row of an ellipse is a single run of pixels, so we find where each row enters and
+    # leaves the ellipse and take the sums from a cumulative sum along the rows of the frame.
+    ell_params = np.asarray(ell_params, dtype=np.float64).reshape(-1, 5)
+    n_ell = len(ell_params)
+    means = np.full(n_ell, np.nan)
+
+    x0, y0, a, b, t = [ell_params[:, i] for i in range(5)]
+    valid = np.all(np.isfinite(ell_params), axis=1) & (a > 0) & (b > 0)
+    if not np.any(valid):
+        return means
+    x0, y0, a, b, t = x0[valid], y0[valid], a[valid], b[valid], t[valid]
+    cos_t, sin_t = np.cos(t), np.sin(t)
+
+    # rows covered by each ellipse
+    row_extent = np.sqrt((a*cos_t)**2 + (b*sin_t)**2)
+    row_lo = np.clip(np.ceil(x0 - row_extent), 0, frame.shape[0])
+    row_hi = np.clip(np.floor(x0 + row_extent), -1, frame.shape[0] - 1)
+    n_rows = np.maximum(row_hi - row_lo + 1, 0).astype(np.int64)
+    total_rows = np.sum(n_rows)
+    if total_rows == 0:
+        return means
+
+    ell_inds = np.repeat(np.arange(len(n_rows)), n_rows)
+    row_starts = np.concatenate(([0], np.cumsum(n_rows)[:-1]))
+    rows = (np.repeat(row_lo, n_rows) + np.arange(total_rows) - np.repeat(row_starts, n_rows)).astype(np.int64)
+
+    # a point (dr, dc) from the center is inside if
+    # ((dr*cos + dc*sin)/a)**2 + ((-dr*sin + dc*cos)/b)**2 <= 1,
+    # which for a given row is a quadratic in dc
+    ea, eb, cos_r, sin_r = a[ell_inds], b[ell_inds], cos_t[ell_inds], sin_t[ell_inds]
+    dr = rows - x0[ell_inds]
+    qa = (sin_r/ea)**2 + (cos_r/eb)**2
+    qb = 2 * dr * cos_r * sin_r * (1/ea**2 - 1/eb**2)
+    qc = dr**2 * ((cos_r/ea)**2 + (sin_r/eb)**2) - 1
+    disc = qb**2 - 4*qa*qc
+    root = np.sqrt(np.maximum(disc, 0))
+    col_lo = np.clip(np.ceil(y0[ell_inds] + (-qb - root)/(2*qa)), 0, frame.shape[1]).astype(np.int64)
+    col_hi = np.clip(np.floor(y0[ell_inds] + (-qb + root)/(2*qa)), -1, frame.shape[1] - 1).astype(np.int64)
+    row_counts = np.where(disc >= 0, np.maximum(col_hi - col_lo + 1, 0), 0)
+
+    # sums along each run of pixels from the cumulative sum of each row
+    row_cumsum = np.zeros((frame.shape[0], frame.shape[1] + 1))
+    row_cumsum[:, 1:] = np.cumsum(frame, axis=1)
+    row_sums = np.where(row_counts > 0,
+                        row_cumsum[rows, np.maximum(col_hi + 1, 0)] - row_cumsum[rows, np.minimum(col_lo, frame.shape[1])],
+                        0.)
+
+    sums = np.bincount(ell_inds, weights=row_sums, minlength=len(n_rows))
+    counts = np.bincount(ell_inds, weights=row_counts, minlength=len(n_rows))
+
+    valid_means = np.full(len(n_rows), np.nan)
+    valid_means[counts > 0] = sums[counts > 0] / counts[counts > 0]
+    means[valid] = valid_means
+
+    return means
+
 def nothing(x):
     pass
 
-def edge_vectors(frame, sigma=1, return_angles = False):
+def gradient_buffers(shape):
+    # float32 arrays for edge_gradients to write into, allocate once per frame shape and reuse
+    return {'src': np.empty(shape, dtype=np.float32),
+            'raw': np.empty(shape, dtype=np.float32),
+            'grad_x': np.empty(shape, dtype=np.float32),
+            'grad_y': np.empty(shape, dtype=np.float32),
+            'edge_mag': np.empty(shape, dtype=np.float32)}
+
+
+def edge_gradients(frame, sigma=1, buffers=None):
+    """
+    Blurred scharr gradients, structure tensor edge magnitude, and unit gradient vectors in one pass.
+
+    The eigenvalues of the structure tensor (see edge_vectors) are
+    e1, e2 = 0.5 * (Ayy + Axx -/+ sqrt((Ayy - Axx)**2 + 4*Axy**2)), so
+    e2 - e1 = sqrt((Ayy - Axx)**2 + 4*Axy**2) = sqrt((gy**2 - gx**2)**2 + 4*gx**2*gy**2) = gx**2 + gy**2
+    since the tensor is built from the blurred gradients pointwise.
+
+    Everything is float32 and written into buffers (from gradient_buffers) if they're given,
+    so the returned arrays are overwritten by the next call with the same buffers.
+
+    Returns:
+        grad_x, grad_y: gradients normalized to unit length (0 where there's no gradient)
+        edge_mag: e2 - e1
+    """
+    if buffers is None:
+        buffers = gradient_buffers(frame.shape)
+    src, raw = buffers['src'], buffers['raw']
+    grad_x, grad_y, edge_mag = buffers['grad_x'], buffers['grad_y'], buffers['edge_mag']
+
+    np.copyto(src, frame, casting='unsafe')
+    cv2.Scharr(src, cv2.CV_32F, 1, 0, dst=raw)
+    cv2.GaussianBlur(raw, (0, 0), sigma, dst=grad_x)
+    cv2.Scharr(src, cv2.CV_32F, 0, 1, dst=raw)
+    cv2.GaussianBlur(raw, (0, 0), sigma, dst=grad_y)
+
+    # length of the gradient vectors, e2-e1 is its square
+    norm = cv2.magnitude(grad_x, grad_y, raw)
+    np.multiply(norm, norm, out=edge_mag)
+
+    # gradients are 0 wherever their length is, so avoid dividing by zero w/o a mask
+    np.maximum(norm, np.finfo(np.float32).tiny, out=norm)
+    np.divide(grad_x, norm, out=grad_x)
+    np.divide(grad_y, norm, out=grad_y)
+
+    return grad_x, grad_y, edge_mag
+
+
+def edge_vectors(frame, sigma=1, return_angles = False, buffers=None):
     """
     Get the eigenvectors/values of the structural tensor
     (1) https://arxiv.org/pdf/1402.5564.pdf
@@ -111,25 +506,10 @@ def edge_vectors(frame, sigma=1, return_angles = False):
     We use the Scharr kernel to compute A for greater rotational invariance
     https://ac.els-cdn.com/S104732030190495X/1-s2.0-S104732030190495X-main.pdf?_tid=61aa5911-ea13-4939-8792-2ff929704990&acdnat=1521241976_f795a9cf5fde71276ea047f6a226de4c
 
-
+    The work is done by edge_gradients, pass buffers to reuse its arrays between frames.
     """
-    grad_x = cv2.GaussianBlur(cv2.Scharr(frame, ddepth=-1, dx=1, dy=0), ksize=(0,0), sigmaX=sigma)
-    grad_y = cv2.GaussianBlur(cv2.Scharr(frame, ddepth=-1, dx=0, dy=1), ksize=(0,0), sigmaX=sigma)
-
-    # Eigenvalues
-    Axx = grad_x*grad_x
-    Axy = grad_x*grad_y
-    Ayy = grad_y*grad_y
-
-    e1 = 0.5 * (Ayy + Axx - np.sqrt((Ayy - Axx) ** 2 + 4 * (Axy ** 2)))
-    e2 = 0.5 * (Ayy + Axx + np.sqrt((Ayy - Axx) ** 2 + 4 * (Axy ** 2)))
-    # edges have eigenvalues with high e2 and low e1, so
-    edge_scale = e2 - e1
-
-    # norm the vectors
-    grads = np.stack((grad_x, grad_y), axis=-1)
-    grads = normalize(grads.reshape(-1,2), norm="l2", axis=1).reshape(grads.shape)
-    grad_x, grad_y = grads[:,:,0], grads[:,:,1]
+    # edges have eigenvalues with high e2 and low e1, so edge_scale = e2 - e1
+    grad_x, grad_y, edge_scale = edge_gradients(frame, sigma=sigma, buffers=buffers)
 
     if return_angles:
         # get angles 0-2pi
@@ -142,119 +522,144 @@ def edge_vectors(frame, sigma=1, return_angles = False):
         return grad_x, grad_y, edge_scale
 
 
-def scharr_canny(image, sigma, low_threshold=0.2, high_threshold=0.5, grads = None):
+class CannyWorkspace(object):
+    """
+    Reusable arrays for scharr_canny's non-maximum suppression (and the gradients it's given),
+    for one frame shape.
+
+    Each interior pixel gets an integer sector (0: 0-45, 1: 45-90, 2: 90-135, 3: 135-180 degrees)
+    from the direction of its gradient. The sector picks which pair of neighbors the magnitude
+    is interpolated from, so all four sectors are suppressed at once by gathering neighbors
+    through a table of flat index offsets, writing into the same buffers every frame.
+
+    Make one per worker and pass it to scharr_canny (and its grads to edge_vectors).
+    The returned local maxima are overwritten by the next call.
+    """
+
+    def __init__(self, shape, dtype=np.float32):
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        rows, cols = self.shape
+        inner = (max(rows-2, 0), max(cols-2, 0))
+
+        # gradient buffers for edge_gradients
+        self.grads = gradient_buffers(self.shape)
+
+        # flat index of every interior pixel
+        self.base = (np.arange(1, rows-1)[:, None]*cols + np.arange(1, cols-1)[None, :]).astype(np.intp)
+        self.base = self.base.reshape(inner)
+
+        # flat offsets of the (c1, c2) neighbors on the + side of each sector,
+        # the - side is the opposite pixel
+        self.off1 = np.array([cols, 1, 1, -cols], dtype=np.intp)
+        self.off2 = np.array([cols+1, cols+1, 1-cols, 1-cols], dtype=np.intp)
+
+        self.sector = np.empty(inner, dtype=np.int8)
+        self.sector2 = np.empty(inner, dtype=np.int8)
+        self.idx = np.empty(inner, dtype=np.intp)
+        self.abs_i = np.empty(inner, dtype=dtype)
+        self.abs_j = np.empty(inner, dtype=dtype)
+        self.w = np.empty(inner, dtype=dtype)
+        self.w1 = np.empty(inner, dtype=dtype)
+        self.c1 = np.empty(inner, dtype=dtype)
+        self.c2 = np.empty(inner, dtype=dtype)
+        self.b1 = np.empty(inner, dtype=bool)
+        self.b2 = np.empty(inner, dtype=bool)
+        self.b3 = np.empty(inner, dtype=bool)
+        self.c_plus = np.empty(inner, dtype=bool)
+
+        # border is never a maximum
+        self.local_maxima = np.zeros(self.shape, dtype=bool)
+
+    def sectors(self, isobel, jsobel):
+        # fill self.sector from the interior gradients. pixels on the boundary between two sectors
+        # (incl. zero gradients) go to the later one, like when the sectors were masked one at a time
+        i, j = isobel[1:-1, 1:-1], jsobel[1:-1, 1:-1]
+        b1, b2, b3 = self.b1, self.b2, self.b3
+        np.abs(i, out=self.abs_i)
+        np.abs(j, out=self.abs_j)
+
+        # opposite signs (or either is 0): sectors 2 & 3
+        np.less_equal(i, 0, out=b1)
+        np.greater_equal(j, 0, out=b2)
+        b1 &= b2
+        np.greater_equal(i, 0, out=b2)
+        np.less_equal(j, 0, out=b3)
+        b2 &= b3
+        b1 |= b2
+
+        # same signs: 1 if |i| <= |j| else 0, opposite: 3 if |i| >= |j| else 2
+        np.less_equal(self.abs_i, self.abs_j, out=b2)
+        np.copyto(self.sector, b2, casting='unsafe')
+        np.greater_equal(self.abs_i, self.abs_j, out=b3)
+        np.add(b3, np.int8(2), out=self.sector2)
+        np.copyto(self.sector, self.sector2, where=b1)
+        return self.sector
+
+    def suppress(self, isobel, jsobel, magnitude):
+        # boolean image of pixels whose magnitude is a local maximum across the gradient direction
+        if min(self.shape) < 3:
+            return self.local_maxima
+
+        sector = self.sectors(isobel, jsobel)
+        mflat = np.ascontiguousarray(magnitude, dtype=self.dtype).ravel()
+        m = mflat.reshape(self.shape)[1:-1, 1:-1]
+
+        # interpolation weight, |j|/|i| in sectors 0 and 3, |i|/|j| in 1 and 2
+        b1 = self.b1
+        np.equal(sector, 0, out=b1)
+        np.equal(sector, 3, out=self.b2)
+        b1 |= self.b2
+        np.copyto(self.w, self.abs_i)
+        np.copyto(self.w, self.abs_j, where=b1)
+        np.copyto(self.w1, self.abs_j)
+        np.copyto(self.w1, self.abs_i, where=b1)
+        np.divide(self.w, self.w1, out=self.w)
+        np.subtract(1, self.w, out=self.w1)
+
+        for sign, out in ((1, self.c_plus), (-1, self.b3)):
+            np.take(self.off1*sign, sector, out=self.idx)
+            self.idx += self.base
+            np.take(mflat, self.idx, out=self.c1)
+            np.take(self.off2*sign, sector, out=self.idx)
+            self.idx += self.base
+            np.take(mflat, self.idx, out=self.c2)
+
+            # c2 * w + c1 * (1 - w) <= m
+            self.c2 *= self.w
+            self.c1 *= self.w1
+            self.c2 += self.c1
+            np.less_equal(self.c2, m, out=out)
+
+        np.logical_and(self.c_plus, self.b3, out=self.local_maxima[1:-1, 1:-1])
+        return self.local_maxima
+
+
+def scharr_canny(image, sigma, low_threshold=0.2, high_threshold=0.5, grads = None, workspace=None):
     # skimage's canny but we get scharr grads instead of sobel,
     # and use the eigenvalues of the structure tensor rather than the hypotenuse
     # we can be passed a precomputed set of image gradients if we haven't already gotten them
+    # workspace: a CannyWorkspace for this image shape, by default the one cached for the shape
+
+    if workspace is None:
+        workspace = shape_constants(image.shape).workspace
 
     if grads is not None:
         isobel = grads['grad_y']
         jsobel = grads['grad_x']
-        abs_isobel = np.abs(isobel)
-        abs_jsobel = np.abs(jsobel)
         magnitude = grads['edge_mag']
     else:
-
-        isobel = cv2.GaussianBlur(cv2.Scharr(image, ddepth=-1, dx=0, dy=1), ksize=(0,0), sigmaX=sigma)
-        jsobel = cv2.GaussianBlur(cv2.Scharr(image, ddepth=-1, dx=1, dy=0), ksize=(0,0), sigmaX=sigma)
-
-
-        abs_isobel = np.abs(isobel)
-        abs_jsobel = np.abs(jsobel)
-
-        Axx = jsobel*jsobel
-        Axy = jsobel*isobel
-        Ayy = isobel*isobel
-
-        e1 = 0.5 * (Ayy + Axx - np.sqrt((Ayy - Axx) ** 2 + 4 * (Axy ** 2)))
-        e2 = 0.5 * (Ayy + Axx + np.sqrt((Ayy - Axx) ** 2 + 4 * (Axy ** 2)))
-
-        magnitude = e2-e1
-
-    # magnitude = np.hypot(isobel, jsobel)
-    #
-    # Make the eroded mask. Setting the border value to zero will wipe
-    # out the image edges for us.
-    #
-    #mask = np.ones(image.shape)
-    #s = generate_binary_structure(2, 2)
-    #eroded_mask = binary_erosion(mask, s, border_value=0)
-    #eroded_mask = eroded_mask & (magnitude > 0)
-    eroded_mask = np.zeros(image.shape, dtype=np.bool)
-    eroded_mask[1:-1, 1:-1] = True
-
+        # the suppression below only needs the direction of the gradients,
+        # so the normalized ones are as good as the raw ones
+        jsobel, isobel, magnitude = edge_gradients(image, sigma=sigma, buffers=workspace.grads)
 
     #--------- Find local maxima --------------
     #
     # Assign each point to have a normal of 0-45 degrees, 45-90 degrees,
-    # 90-135 degrees and 135-180 degrees.
-    #
-    local_maxima = np.zeros(image.shape, bool)
-    #----- 0 to 45 degrees ------
-    pts_plus = (isobel >= 0) & (jsobel >= 0) & (abs_isobel >= abs_jsobel)
-    pts_minus = (isobel <= 0) & (jsobel <= 0) & (abs_isobel >= abs_jsobel)
-    pts = pts_plus | pts_minus
-    pts = eroded_mask & pts
-    # Get the magnitudes shifted left to make a matrix of the points to the
-    # right of pts. Similarly, shift left and down to get the points to the
-    # top right of pts.
-    c1 = magnitude[1:, :][pts[:-1, :]]
-    c2 = magnitude[1:, 1:][pts[:-1, :-1]]
-    m = magnitude[pts]
-    w = abs_jsobel[pts] / abs_isobel[pts]
-    c_plus = c2 * w + c1 * (1 - w) <= m
-    c1 = magnitude[:-1, :][pts[1:, :]]
-    c2 = magnitude[:-1, :-1][pts[1:, 1:]]
-    c_minus = c2 * w + c1 * (1 - w) <= m
-    local_maxima[pts] = c_plus & c_minus
-    #----- 45 to 90 degrees ------
-    # Mix diagonal and vertical
-    #
-    pts_plus = (isobel >= 0) & (jsobel >= 0) & (abs_isobel <= abs_jsobel)
-    pts_minus = (isobel <= 0) & (jsobel <= 0) & (abs_isobel <= abs_jsobel)
-    pts = pts_plus | pts_minus
-    pts = eroded_mask & pts
-    c1 = magnitude[:, 1:][pts[:, :-1]]
-    c2 = magnitude[1:, 1:][pts[:-1, :-1]]
-    m = magnitude[pts]
-    w = abs_isobel[pts] / abs_jsobel[pts]
-    c_plus = c2 * w + c1 * (1 - w) <= m
-    c1 = magnitude[:, :-1][pts[:, 1:]]
-    c2 = magnitude[:-1, :-1][pts[1:, 1:]]
-    c_minus = c2 * w + c1 * (1 - w) <= m
-    local_maxima[pts] = c_plus & c_minus
-    #----- 90 to 135 degrees ------
-    # Mix anti-diagonal and vertical
+    # 90-135 degrees and 135-180 degrees, and compare it to the interpolated
+    # magnitude on either side. The image border is never a maximum.
     #
-    pts_plus = (isobel <= 0) & (jsobel >= 0) & (abs_isobel <= abs_jsobel)
-    pts_minus = (isobel >= 0) & (jsobel <= 0) & (abs_isobel <= abs_jsobel)
-    pts = pts_plus | pts_minus
-    pts = eroded_mask & pts
-    c1a = magnitude[:, 1:][pts[:, :-1]]
-    c2a = magnitude[:-1, 1:][pts[1:, :-1]]
-    m = magnitude[pts]
-    w = abs_isobel[pts] / abs_jsobel[pts]
-    c_plus = c2a * w + c1a * (1.0 - w) <= m
-    c1 = magnitude[:, :-1][pts[:, 1:]]
-    c2 = magnitude[1:, :-1][pts[:-1, 1:]]
-    c_minus = c2 * w + c1 * (1.0 - w) <= m
-    local_maxima[pts] = c_plus & c_minus
-    #----- 135 to 180 degrees ------
-    # Mix anti-diagonal and anti-horizontal
-    #
-    pts_plus = (isobel <= 0) & (jsobel >= 0) & (abs_isobel >= abs_jsobel)
-    pts_minus = (isobel >= 0) & (jsobel <= 0) & (abs_isobel >= abs_jsobel)
-    pts = pts_plus | pts_minus
-    pts = eroded_mask & pts
-    c1 = magnitude[:-1, :][pts[1:, :]]
-    c2 = magnitude[:-1, 1:][pts[1:, :-1]]
-    m = magnitude[pts]
-    w = abs_jsobel[pts] / abs_isobel[pts]
-    c_plus = c2 * w + c1 * (1 - w) <= m
-    c1 = magnitude[1:, :][pts[:-1, :]]
-    c2 = magnitude[1:, :-1][pts[:-1, 1:]]
-    c_minus = c2 * w + c1 * (1 - w) <= m
-    local_maxima[pts] = c_plus & c_minus
+    local_maxima = workspace.suppress(isobel, jsobel, magnitude)
 
 
     #
@@ -285,19 +690,14 @@ def scharr_canny(image, sigma, low_threshold=0.2, high_threshold=0.5, grads = No
 
 def parameterize_edges(edges, grad_x, grad_y, angles, small_thresh=20):
     # reduce binary 2d edge image to parameters
-    edges = morphology.label(edges)
-
-    uq_edges, counts = np.unique(edges, return_counts = True)
-    uq_edges, counts = uq_edges[uq_edges>0], counts[1:]
+    edges, n_edges = morphology.label(edges, return_num=True)
 
-    if len(uq_edges) == 0:
+    if n_edges == 0:
         return
 
     # get x/y representation so we don't have to keep passing a buncha booleans
-    edges_xy = [edges2xy(edges, e) for e in uq_edges]
-
-    # delete tiny edges
-    edges_xy = [e for e in edges_xy if len(e)>small_thresh]
+    # (tiny edges are deleted before they're ordered)
+    edges_xy = labeled2xy(edges, small_thresh=small_thresh)
     if len(edges_xy)==0:
         return []
 
@@ -327,38 +727,38 @@ def parameterize_edges(edges, grad_x, grad_y, angles, small_thresh=20):
 
 
 
-def repair_edges(edges, frame, sigma=3, small_thresh=20, grads=None):
+def repair_edges(edges, frame, sigma=3, small_thresh=20, grads=None, merge_radius=None):
     # connect contiguous edges, disconnect edges w/ sharp angles
     # expect a binary edge image, like from feature.canny
     # im_grad should be complex (array of vectors)
+    # merge_radius: farthest apart (px) edge ends can be to be merged, see merge_curves
 
     # super inefficient rn, will eventually just work with xy's directly but...
     #edges = edges.copy()
 
-    label_edges = morphology.label(edges)
-
-    uq_edges, counts = np.unique(label_edges, return_counts = True)
-    uq_edges, counts = uq_edges[uq_edges>0], counts[1:]
+    label_edges, n_edges = morphology.label(edges, return_num=True)
 
-    if len(uq_edges) == 0:
+    if n_edges == 0:
         return
 
     # get x/y representation so we don't have to keep passing a buncha booleans
-    edges_xy = [edges2xy(label_edges, e) for e in uq_edges]
+    # all edges are extracted in a single pass, tiny edges are deleted before ordering
+    edges_xy = labeled2xy(label_edges, small_thresh=small_thresh)
 
     ##################################
     # repair
 
-    # delete tiny edges
-    edges_xy = [e for e in edges_xy if len(e)>small_thresh]
     if len(edges_xy)==0:
         return []
 
-    # break edges at corners and inflection points
-    edges_xy = break_corners(edges_xy)
+    # break edges at corners and inflection points,
+    # keeping the line segments so merge_curves can reuse them
+    edges_xy, edges_segs = break_corners(edges_xy, return_segments=True)
 
     # delete tiny edges again
-    edges_xy = [e for e in edges_xy if len(e) > small_thresh]
+    keep_edges = [i for i, e in enumerate(edges_xy) if len(e) > small_thresh]
+    edges_xy = [edges_xy[i] for i in keep_edges]
+    edges_segs = [edges_segs[i] for i in keep_edges]
     if len(edges_xy) == 0:
         return []
 
@@ -372,9 +772,11 @@ def repair_edges(edges, frame, sigma=3, small_thresh=20, grads=None):
 
     # reconnect edges based on position, image gradient, and edge affinity
     if grads is not None:
-        edges_xy = merge_curves(edges_xy, frame, sigma=sigma, grads=grads)
+        edges_xy = merge_curves(edges_xy, frame, sigma=sigma, grads=grads, segs=edges_segs,
+                                merge_radius=merge_radius)
     else:
-        edges_xy = merge_curves(edges_xy, frame, sigma=sigma, grads=grads)
+        edges_xy = merge_curves(edges_xy, frame, sigma=sigma, grads=grads, segs=edges_segs,
+                                merge_radius=merge_radius)
 
     # final round of breaking curves if we introduced any bad ones in our merge
     # edges_xy = break_corners(edges_xy)
@@ -384,17 +786,87 @@ def repair_edges(edges, frame, sigma=3, small_thresh=20, grads=None):
 
     return edges_xy
 
-def break_corners(edges_xy):
+def break_corners(edges_xy, return_segments=False, corner_thresh=.6):
+    # if return_segments, also return the prasad segments for each returned edge
+    # so merge_curves doesn't have to compute them again.
+    # edges that got split have no segments yet, and get None.
     return_edges = []
+    return_segs = []
+
+    # segment all edges and find all their corners at once
+    edges_segs = prasad_lines_batch(edges_xy)
+    edges_splits = find_corners(edges_segs, corner_thresh=corner_thresh)
 
     #delete_mask = np.zeros(edges.shape, dtype=np.bool)
-    for edge_xy in edges_xy:
-        return_edges.extend(break_at_corners(edge_xy))
+    for edge_xy, segs_points, split_pts in zip(edges_xy, edges_segs, edges_splits):
+        split_edges, split_segs = break_at_corners(edge_xy, return_segments=True,
+                                                   segs_points=segs_points, split_pts=split_pts)
+        return_edges.extend(split_edges)
+        return_segs.extend(split_segs)
+
+    if return_segments:
+        return return_edges, return_segs
+    else:
+        return return_edges
 
-    return return_edges
 
+def find_corners(edges_segs, corner_thresh=.6):
+    # find sharp angles and inflection points for every segment of every edge at once.
+    # edges_segs is a list of prasad segment nodes (one list of x/y points per edge)
+    # returns a list of boolean arrays, one per edge, marking which nodes to split at.
+    #
+    # for each edge there will be n points, n-1 segments, and n-2 angles.
+    # angle i (between segments i and i+1) decides whether to split at point i+1
+    n_nodes = np.array([len(s) for s in edges_segs])
+    if len(n_nodes) == 0:
+        return []
+    nodes = np.row_stack(edges_segs).astype(np.float64)
+    node_edge = np.repeat(np.arange(len(n_nodes)), n_nodes)
+
+    # unit vectors for every segment,
+    # zero-length segments stay zero like sklearn's normalize would leave them
+    vects = np.diff(nodes, axis=0)
+    norms = np.sqrt(np.sum(vects**2, axis=1))
+    norms[norms == 0] = 1.
+    vects = vects / norms[:, np.newaxis]
+
+    # the "segment" between the last node of one edge and the first of the next isn't real
+    seg_valid = node_edge[1:] == node_edge[:-1]
+
+    # angle k is between segments k and k+1, centered on node k+1
+    v1, v2 = vects[:-1], vects[1:]
+    angle_valid = seg_valid[:-1] & seg_valid[1:]
+    # dot product between vectors, tells sharp angles
+    angles = v1[:, 0]*v2[:, 0] + v1[:, 1]*v2[:, 1]
+    # dot product of vector 2 and perp. vector to v1 (x,y)T = (-y,x)
+    inflection = -v1[:, 1]*v2[:, 0] + v1[:, 0]*v2[:, 1]
 
-def break_at_corners(edge_xy, return_segments=False, corner_thresh=.6, delete_straight=False):
+    # look for sharp edges
+    split_pts = np.zeros(len(nodes), dtype=bool)
+    split_pts[np.flatnonzero(angle_valid & (angles < corner_thresh)) + 1] = True
+
+    # and inflection points - where the sign flips between neighboring angles of the same edge
+    signs = inflection >= 0
+    sign_change = np.zeros(len(angles), dtype=bool)
+    sign_change[1:] = angle_valid[1:] & angle_valid[:-1] & (signs[1:] != signs[:-1])
+
+    # don't want to double-punish inflection points,
+    # when we cut, we make a new edge, so it doesnt make sense to
+    # also cut the next sign for being different because it has
+    # nothing to be different from in its new life.
+    # so in a run of consecutive sign changes we cut every other one, starting from the first
+    change_inds = np.arange(len(sign_change))
+    run_start = sign_change.copy()
+    run_start[1:] &= ~sign_change[:-1]
+    run_start_inds = np.maximum.accumulate(np.where(run_start, change_inds, 0))
+    sign_change &= (change_inds - run_start_inds) % 2 == 0
+    split_pts[np.flatnonzero(sign_change) + 1] = True
+
+    return np.split(split_pts, np.cumsum(n_nodes)[:-1])
+
+
+def break_at_corners(edge_xy, return_segments=False, corner_thresh=.6, delete_straight=False,
+                     segs_points=None, split_pts=None):
     # pass in an ordered list of x/y coords,
     # using prasad's line estimation we break edges at sharp turns/inflection points
     # returns an array of coords of corners/inflection points to
@@ -410,65 +882,30 @@ def break_at_corners(edge_xy, return_segments=False, corner_thresh=.6, delete_st
     # so splitting the edge at point 0<i<n (we don't split endpoints dummy!)
     # will depend on angle i-1
 
-    segs_points = prasad_lines(edge_xy)
-
-    segs = nodes2segs(segs_points)
-
-    # get angles between segments
-    angles = [] # dot product between vectors, tells sharp angles
-    inflection = [] # dot product between n+1 vector and (-y, x) of n vector
-    for i in range(len(segs)-1):
-        # make segments unit vectors
-        seg1, seg2 = segs[i], segs[i+1]
-        seg_n = normalize([[seg1[1][0]-seg1[0][0], seg1[1][1]-seg1[0][1]],
-                              [seg2[1][0]-seg2[0][0], seg2[1][1]-seg2[0][1]]])
-
-        # dot product of vector 2 and perp. vector to v1 (x,y)T = (-y,x)
-
-
-        inflection.append(-seg_n[0,1]*seg_n[1,0]+seg_n[0,0]*seg_n[1,1])
-        angles.append(seg_n[0, 0] * seg_n[1, 0] + seg_n[0, 1] * seg_n[1, 1])
+    # segs_points and split_pts can be passed if they've already been computed
+    # (eg. by prasad_lines_batch and find_corners)
+    if segs_points is None:
+        segs_points = prasad_lines(edge_xy)
 
     # first thing's first, if we get back a 2 pt segment
     # recommend to delete the whole segment by returning False
-
-    if len(angles) == 0 and delete_straight:
+    if len(segs_points) < 3 and delete_straight:
+        if return_segments:
+            return [], []
         return []
 
-
-    # otherwise go through and find sharp angles and inflection points
+    # otherwise find sharp angles and inflection points
     # boolean mask for deletion of points
-    angles = np.array(angles)
-    inflection = np.array(inflection)
-
-    # look for sharp edges
-    split_pts = np.zeros(len(segs_points), dtype=np.bool)
-    split_pts[np.where(angles < corner_thresh)[0] + 1] = True
-
-    # and inflection points
-    # sorry for how this works so sucky, head unclear.
-    signs = np.zeros(len(inflection), dtype=np.bool)
-    signs[np.where(inflection >= 0)] = True
-    last_deleted = False
-    for i in range(len(angles)):
-        if last_deleted:
-            # don't want to double-punish inflection points,
-            # when we cut, we make a new edge, so it doesnt make sense to
-            # also cut the next sign for being different because it has
-            # nothing to be different from in its new life
-            last_deleted =False
-            continue
-
-        if i>0:
-            if signs[i-1] != signs[i]:
-                split_pts[i+1] =True
-                last_deleted=True
+    if split_pts is None:
+        split_pts = find_corners([segs_points], corner_thresh=corner_thresh)[0]
 
     # return a list of split edges
     return_segs = []
     split_inds = np.where(split_pts)[0]
-    if np.alen(split_inds)==0:
+    if len(split_inds)==0:
         return_segs.append(edge_xy)
+        # unsplit edges keep their prasad segments
+        return_points = [segs_points]
     else:
         for split in np.where(split_pts)[0]:
             split_at = np.array(segs_points[split])
@@ -476,9 +913,12 @@ def break_at_corners(edge_xy, return_segments=False, corner_thresh=.6, delete_st
             return_segs.append(edge_xy[:split_ind-2,:])
             edge_xy = edge_xy[split_ind+2:,:]
         return_segs.append(edge_xy)
+        return_points = [None]*len(return_segs)
 
-
-    return return_segs
+    if return_segments:
+        return return_segs, return_points
+    else:
+        return return_segs
 
 
 def remove_tiny_edges(edges, thresh=30):
@@ -489,8 +929,15 @@ def remove_tiny_edges(edges, thresh=30):
     edges[~np.isin(label_edges, uq_edges)] = 0
     return edges
 
+def cosine_dist(u, v):
+    # rowwise cosine distance between two (n, 2) arrays,
+    # nan for zero-length vectors like scipy's cosine distance
+    norms = np.sqrt(np.sum(u**2, axis=1)) * np.sqrt(np.sum(v**2, axis=1))
+    return 1. - np.sum(u*v, axis=1)/norms
+
+
 def merge_curves(edges_xy, frame, sigma=3, threshold=0.5, keep_originals=True, only_max=False,
-                 grads=False):
+                 grads=False, segs=None, merge_radius=None):
     '''
     Given a binary array of edges and a grayscale image,
     generate three metrics of continuity for corner points (edges of edges):
@@ -502,6 +949,13 @@ def merge_curves(edges_xy, frame, sigma=3, threshold=0.5, keep_originals=True, o
     :param edges:
     :param frame:
     :param sigma:
+    :param segs: prasad segments for each edge if already computed (eg. from break_corners),
+        edges with None segments are segmented here
+    :param merge_radius: only score endpoints within this many pixels of each other.
+        if None, use the distance beyond which no pair could pass the threshold,
+        so the merges are the same as scoring every pair. the distance score is scaled by
+        how spread out the endpoints are, so that distance doesn't shrink as edges get denser --
+        cap it (eg. with params['merge_radius']) to trade far merges for speed on crowded frames
     :return:
     '''
 
@@ -517,22 +971,68 @@ def merge_curves(edges_xy, frame, sigma=3, threshold=0.5, keep_originals=True, o
     ###################
     # Continuity metrics
     ###################
+    # rather than scoring every pair of endpoints,
+    # we only score pairs within merge_radius pixels of each other.
     ## 1. distance
 
-    # get the  euclidean distances between points as a fraction of image size
-    edge_dists = distance.squareform(distance.pdist(edge_points))/np.min(frame.shape)
+    # distances are scaled by the largest distance between any two endpoints,
+    # which has to be on their convex hull
+    try:
+        hull_points = edge_points[ConvexHull(edge_points).vertices]
+    except Exception:
+        # too few or collinear points
+        hull_points = edge_points
+    max_dist = np.max(distance.pdist(hull_points)) if len(hull_points) > 1 else 0.
+    if max_dist == 0:
+        return edges_xy
+
+    # the distance score is 1 - dist/max_dist and the other scores are <= 1,
+    # so pairs farther than max_dist*(1-threshold) can never be merged
+    if merge_radius is None:
+        merge_radius = max_dist*(1.-threshold)
+
+    pairs = cKDTree(edge_points).query_pairs(merge_radius, output_type='ndarray')
+
+    # filter points that are on the same curve...
+    pairs = pairs[pairs[:, 0]//2 != pairs[:, 1]//2, :]
+    if len(pairs) == 0:
+        return edges_xy
+
+    # keep pairs as (row, col) in the lower triangle, sorted like np.where would give them
+    pairs = np.sort(pairs, axis=1)[:, ::-1]
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0])), :]
+    p1, p2 = pairs[:, 0], pairs[:, 1]
+
+    edge_dists = np.sqrt(np.sum((edge_points[p1, :] - edge_points[p2, :])**2, axis=1).astype(np.float64))
 
     ## 2. gradient similarity
-    # and the dot product of the image gradient
+    # and the cosine distance of the image gradient
     edge_grads = np.column_stack((grad_x[edge_points[:,0], edge_points[:,1]],
                                   grad_y[edge_points[:,0], edge_points[:,1]]))
-    edge_grads = distance.squareform(distance.pdist(edge_grads, "cosine"))
+    edge_grads = cosine_dist(edge_grads[p1, :], edge_grads[p2, :])
+
+    # the affinity score is at most 1 too, so pairs whose distance and gradient scores
+    # can't pass the threshold by themselves never will. drop them before scoring affinity
+    # (they'd score <= threshold, so they couldn't be anyone's merge for only_max either)
+    with np.errstate(invalid='ignore'):
+        could_pass = (1-(edge_dists/max_dist)) * (1-(edge_grads/2.))**2 > threshold
+    pairs, edge_dists, edge_grads = pairs[could_pass, :], edge_dists[could_pass], edge_grads[could_pass]
+    if len(pairs) == 0:
+        return edges_xy
+    p1, p2 = pairs[:, 0], pairs[:, 1]
 
     ## 3. edge affinity
     # want edges that point at each other
 
-    # get direction of edge points from line segments
-    segs = [prasad_lines(e) for e in edges_xy]
+    # get direction of edge points from line segments,
+    # only segmenting the edges we don't already have segments for
+    if segs is None:
+        segs = prasad_lines_batch(edges_xy)
+    else:
+        segs = list(segs)
+        missing = [i for i, s in enumerate(segs) if s is None]
+        for i, s in zip(missing, prasad_lines_batch([edges_xy[i] for i in missing])):
+            segs[i] = s
 
     # 3d array of the edge points and the neighboring segment vertex
     edge_segs = np.row_stack([((e[0],e[1]),(e[-1],e[-2])) for e in segs])
@@ -545,27 +1045,15 @@ def merge_curves(edges_xy, frame, sigma=3, threshold=0.5, keep_originals=True, o
     edge_mids = np.mean(edge_segs, axis=1)
 
     # cosine distance between direction of edge at endpoints and direction to other points
-    # note this distance is asymmetrical, affinity from point in row to point in column
-    edge_affinity = np.row_stack(
-        [distance.cdist(edge_vects[i,:].reshape(1,2), edge_mids-edge_points[i,:], "cosine")
-         for i in range(len(edge_segs))]
-    )
-
-    # get upper/lower indices manually so they match up right
-    triu_indices = np.triu_indices(edge_affinity.shape[0], k= 1)
-    tril_indices = triu_indices[::-1]
-
-    # average top and bottom triangles - both edges should point at each other
-    pair_affinity = np.mean((edge_affinity[tril_indices],
-                             edge_affinity[triu_indices]), axis=0)
-    edge_affinity[tril_indices] = pair_affinity
-    edge_affinity[triu_indices] = pair_affinity
+    # this distance is asymmetrical, so average both directions - both edges should point at each other
+    edge_affinity = np.mean((cosine_dist(edge_vects[p1, :], edge_mids[p2, :] - edge_points[p1, :]),
+                             cosine_dist(edge_vects[p2, :], edge_mids[p1, :] - edge_points[p2, :])), axis=0)
 
     ########################################
     # Clean up & combine merge metrics
     # want high values to be good, and for vals to be 0-1
-    edge_dists = 1-((edge_dists-np.min(edge_dists))/(np.max(edge_dists)-np.min(edge_dists)))
-    #edge_dists = 1-edge_dists
+    # (the min distance is always 0, from a point to itself)
+    edge_dists = 1-(edge_dists/max_dist)
     edge_grads = 1-(edge_grads/2.) # cosine distance is 0-2
     edge_affinity = 1-(edge_affinity/2.)
 
@@ -575,20 +1063,23 @@ def merge_curves(edges_xy, frame, sigma=3, threshold=0.5, keep_originals=True, o
     # zero nonmax joins (only want to join each end one time at most..
     # only keep scores if mutually max'd (avoids 3-way joins)
     if only_max:
-        col_max = np.argmax(merge_score, axis=0)
-        dupe_mask = np.ones_like(merge_score, dtype=np.bool)
-        dupe_mask[col_max[col_max], col_max] = 0
-        merge_score[dupe_mask] = 0.
-
-    # now only need triangle to avoid dupes
-    merge_score[triu_indices] = 0.
+        # best partner for each endpoint among its candidate pairs:
+        # sort by endpoint then score, and take the last of each endpoint's run
+        both_pts = np.concatenate((p1, p2))
+        both_partners = np.concatenate((p2, p1))
+        both_scores = np.concatenate((merge_score, merge_score))
+        sort_inds = np.lexsort((both_scores, both_pts))
+        both_pts, both_partners = both_pts[sort_inds], both_partners[sort_inds]
+        run_ends = np.flatnonzero(np.diff(np.append(both_pts, -1)) != 0)
+        best = np.full(len(edge_points), -1, dtype=np.int64)
+        best[both_pts[run_ends]] = both_partners[run_ends]
+
+        # each end of the pair has to be the other's best
+        merge_score[~((best[p1] == p2) & (best[p2] == p1))] = 0.
 
     # get good edges to merge,
     # empirically threshold of 0.5 seems to get the visually salient ones
-    merge_points = np.column_stack(np.where(merge_score>threshold))
-
-    # filter points that are on the same curve...
-    merge_points = merge_points[(merge_points/2)[:,0] != (merge_points/2)[:,1],:]
+    merge_points = pairs[merge_score>threshold, :]
 
     # make the merged segments, pop the originals and combine
     newsegs = []
@@ -677,7 +1168,57 @@ def plot_edge(labeled_edges, edge):
     pass
 
 
+# neighbor offsets for order_points, nearest first:
+# the 8-connected neighbors (chain code), then the rest of the 5x5 neighborhood
+# so we can hop small gaps and branches like the old distance < 3 search did
+ORDER_OFFSETS = sorted([(dr, dc) for dr in range(-2, 3) for dc in range(-2, 3) if (dr, dc) != (0, 0)],
+                       key=lambda o: o[0]**2 + o[1]**2)
+
+
 def order_points(edge_points):
+    # follow neighboring pixels along the edge directly on the pixel grid
+    # rather than computing all pairwise distances.
+    # we start at the first point, walk forward as far as we can,
+    # then go back to the first point and walk the other way.
+    # points off the walked path (branches) are dropped.
+    n_points = len(edge_points)
+    if n_points < 2:
+        return edge_points
+
+    # lookup grid of point indices, padded so offsets never fall off the edge
+    local = edge_points - edge_points.min(axis=0) + 2
+    grid = np.full(local.max(axis=0) + 3, -1, dtype=np.int64)
+    grid[local[:, 0], local[:, 1]] = np.arange(n_points)
+
+    # python lists are much faster to index one element at a time
+    grid = grid.tolist()
+    local = local.tolist()
+    grid[local[0][0]][local[0][1]] = -1
+
+    paths = []
+    for direction in range(2):
+        path = []
+        row, col = local[0]
+        while True:
+            for dr, dc in ORDER_OFFSETS:
+                point = grid[row+dr][col+dc]
+                if point >= 0:
+                    break
+            else:
+                # either at one end or *the end*
+                break
+
+            grid[row+dr][col+dc] = -1
+            path.append(point)
+            row, col = row+dr, col+dc
+        paths.append(path)
+
+    order = paths[1][::-1] + [0] + paths[0]
+
+    return edge_points[order]
+
+
+def order_points_old(edge_points):
     dists = distance.squareform(distance.pdist(edge_points))
 
     inds = {i: i for i in range(len(edge_points))}
@@ -693,7 +1234,7 @@ def order_points(edge_points):
         #close_enough = close_enough[np.isin(close_enough, inds.keys(), assume_unique=True)]
         close_enough = close_enough[np.argsort(dists[point,close_enough])]
 
-        if np.alen(close_enough)==0:
+        if len(close_enough)==0:
             # either at one end or *the end*
             if not backwards:
                 point = 0
@@ -804,8 +1345,8 @@ def prasad_maxlinedev(x, y, return_metrics=False):
     # all credit to http://ieeexplore.ieee.org/document/6166585/
     # adapted from MATLAB scripts here: https://docs.google.com/open?id=0B10RxHxW3I92dG9SU0pNMV84alk
 
-    x = x.astype(np.float)
-    y = y.astype(np.float)
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
 
     results = {}
 
@@ -846,62 +1387,169 @@ def prasad_maxlinedev(x, y, return_metrics=False):
 
     return results
 
+def prasad_lines_batch(edges_xy):
+    # prasad_lines for all the (ordered) edges of a frame at once.
+    # every edge keeps its own (first, last) state, and each pass of the loop
+    # computes the line deviations for all the edges that are still being segmented
+    # in one vectorized call to prasad_maxlinedev_batch.
+    # it's still a python loop over passes, as many as the most splits any one edge needs,
+    # but not over edges.
+    # returns a list of seglists, one per edge, same as calling prasad_lines on each.
+    n_edges = len(edges_xy)
+    if n_edges == 0:
+        return []
+
+    # ragged array of all the points, with each edge's offset into it
+    lens = np.array([len(e) for e in edges_xy])
+    offsets = np.concatenate(([0], np.cumsum(lens)[:-1]))
+    points = np.row_stack(edges_xy)
+    x = points[:, 0].astype(np.float64)
+    y = points[:, 1].astype(np.float64)
+
+    seglists = [[[e[0, 0], e[0, 1]]] for e in edges_xy]
+
+    first = np.zeros(n_edges, dtype=np.int64)
+    last = lens - 1
+    active = np.flatnonzero(first < last)
+
+    while len(active) > 0:
+        d_max, index_d_max, del_tol_max = prasad_maxlinedev_batch(x, y,
+                                                                  offsets[active] + first[active],
+                                                                  offsets[active] + last[active])
+
+        # split at the point of max deviation if it's too far from the line,
+        # unless we can't split any further - then we just jump to the end of the edge
+        split = d_max > del_tol_max
+        split_at = index_d_max + first[active]
+        jump = split & ((split_at == last[active]) |
+                        (split_at == first[active] + 1) |
+                        (split_at == first[active]))
+
+        keep_splitting = split & ~jump
+        last[active[keep_splitting]] = split_at[keep_splitting]
+
+        jumped = active[jump]
+        last[jumped] = lens[jumped] - 1
+
+        # otherwise the segment from first to last is done
+        done = active[~keep_splitting]
+        for i in done:
+            seglists[i].append([points[offsets[i]+last[i], 0], points[offsets[i]+last[i], 1]])
+
+        first[done] = last[done]
+        last[done] = lens[done] - 1
+
+        active = active[first[active] < last[active]]
+
+    return seglists
+
+
+def prasad_maxlinedev_batch(x, y, starts, stops):
+    # prasad_maxlinedev for many point ranges at once.
+    # x and y are the concatenated points of all edges, and
+    # each range runs from starts[i] to stops[i] (inclusive).
+    # returns arrays of d_max, index_d_max (relative to the start of the range) and del_tol_max
+    #
+    # the line deviations are computed elementwise here, while prasad_maxlinedev uses a matmul
+    # that BLAS may round differently (eg. with a fused multiply-add). usually that doesn't matter,
+    # but pixel coordinates make exact ties common, so ranges where the rounding could change
+    # the argmax or the comparison with del_tol_max are redone with prasad_maxlinedev.
+    lens = stops - starts + 1
+    group_starts = np.concatenate(([0], np.cumsum(lens)[:-1]))
+    n_total = np.sum(lens)
+
+    # index of each point within its range, and into x/y
+    local_inds = np.arange(n_total) - np.repeat(group_starts, lens)
+    point_inds = np.repeat(starts, lens) + local_inds
+    px, py = x[point_inds], y[point_inds]
+
+    x0, y0 = x[starts], y[starts]
+    xl, yl = x[stops], y[stops]
+
+    A0 = (y0-yl) / (y0*xl - yl*x0)
+    A1 = (x0-xl) / (x0*yl - xl*y0)
+    same_point = np.isnan(A0) & np.isnan(A1)
+    through_origin = np.isinf(A0) & np.isinf(A1)
+    c = x0/y0
+
+    # the three cases from prasad_maxlinedev, per point
+    A0, A1, c = np.repeat(A0, lens), np.repeat(A1, lens), np.repeat(c, lens)
+    dist_first = np.sqrt((px-np.repeat(x0, lens))**2 + (py-np.repeat(y0, lens))**2)
+    A_norm = np.sqrt(A0**2 + A1**2)
+    dev = np.abs(px*A0 + py*A1 - 1.)/A_norm
+    # generous bound on how differently the two ways could round
+    dev_err = 4*np.finfo(np.float64).eps*(np.abs(px*A0) + np.abs(py*A1) + 1.)/A_norm
+    dev_origin = np.abs(px/np.sqrt(1+c**2) - c*py/np.sqrt(1+c**2))
+
+    dev = np.where(np.repeat(same_point, lens), dist_first,
+                   np.where(np.repeat(through_origin, lens), dev_origin, dev))
+
+    d_max = np.maximum.reduceat(dev, group_starts)
+
+    # first index of the max in each range, like np.argmax
+    is_max = dev == np.repeat(d_max, lens)
+    index_d_max = np.minimum.reduceat(np.where(is_max, local_inds, n_total), group_starts)
+
+    s_max = np.maximum.reduceat(dist_first, group_starts)
+    del_phi_max = prasad_digital_error(s_max)
+    del_tol_max = np.tan(del_phi_max * s_max)
+
+    # ranges (in the general case) where another point is within rounding of the max,
+    # or the max is within rounding of the tolerance
+    general = np.repeat(~same_point & ~through_origin, lens)
+    max_err = np.maximum.reduceat(np.where(general, dev_err, 0.), group_starts)
+    near_max = general & (dev >= np.repeat(d_max - 2*max_err, lens))
+    unsure = (np.add.reduceat(near_max, group_starts) > 1) | \
+             (~same_point & ~through_origin & (np.abs(d_max - del_tol_max) <= 2*max_err))
+
+    for i in np.flatnonzero(unsure):
+        results = prasad_maxlinedev(x[starts[i]:stops[i]+1], y[starts[i]:stops[i]+1])
+        d_max[i] = results['d_max']
+        index_d_max[i] = results['index_d_max']
+        del_tol_max[i] = results['del_tol_max']
+
+    return d_max, index_d_max, del_tol_max
+
+
+# constants for prasad_digital_error, computed once at import.
+# the digital error is the max over the 8 cases (and phi = 0-360 deg) of
+#     (1/ss**2) * term1 * ss*(1 - tt2/ss + (tt2/ss)**2)
+# with tt2 = +/-[sin, cos, sin-cos, sin+cos] and term1 = |cos|, |sin|, |sin+cos|, |sin-cos|.
+# the +/- cases collapse to a +|tt2| term, which leaves a polynomial in 1/ss:
+#     term1/ss + term1*|tt2|/ss**2 + term1*tt2**2/ss**3
+PRASAD_PHI = np.arange(0, np.pi*2, np.pi / 180)
+PRASAD_TERM1 = np.abs(np.row_stack((np.cos(PRASAD_PHI),
+                                    np.sin(PRASAD_PHI),
+                                    np.sin(PRASAD_PHI)+np.cos(PRASAD_PHI),
+                                    np.sin(PRASAD_PHI)-np.cos(PRASAD_PHI))))
+PRASAD_TT2 = np.row_stack((np.sin(PRASAD_PHI),
+                           np.cos(PRASAD_PHI),
+                           np.sin(PRASAD_PHI)-np.cos(PRASAD_PHI),
+                           np.sin(PRASAD_PHI)+np.cos(PRASAD_PHI)))
+# (3, n_cases) coefficients of 1/ss, 1/ss**2, 1/ss**3
+PRASAD_COEFS = np.row_stack((PRASAD_TERM1.ravel(),
+                             (PRASAD_TERM1*np.abs(PRASAD_TT2)).ravel(),
+                             (PRASAD_TERM1*PRASAD_TT2**2).ravel()))
+
+
 def prasad_digital_error(ss):
     # all credit to http://ieeexplore.ieee.org/document/6166585/
     # adapted from MATLAB scripts here: https://docs.google.com/open?id=0B10RxHxW3I92dG9SU0pNMV84alk
 
-    # constants are hardcoded for faster operation
-
-    # phi = np.arange(0, np.pi*2, np.pi / 180)
-
-    #s, phii = np.meshgrid(ss, phi)
-
-    #sin_p = np.sin(phi)
-    #cos_p = np.cos(phi)
-    #sin_plus_cos = sin_p+cos_p
-    #sin_minus_cos = sin_p-cos_p
-
-    #term1 = []
-    #term1.append(np.abs(cos_p))
-    #term1.append(np.abs(sin_p))
-    #term1.append(np.abs(sin_plus_cos))
-    #term1.append(np.abs(sin_minus_cos))
-
-    term1 = np.array([[1.00000000e+00, 9.99847695e-01, 9.99390827e-01, 9.98629535e-01,9.97564050e-01, 9.96194698e-01, 9.94521895e-01, 9.92546152e-01,9.90268069e-01, 9.87688341e-01, 9.84807753e-01, 9.81627183e-01,9.78147601e-01, 9.74370065e-01, 9.70295726e-01, 9.65925826e-01,9.61261696e-01, 9.56304756e-01, 9.51056516e-01, 9.45518576e-01,9.39692621e-01, 9.33580426e-01, 9.27183855e-01, 9.20504853e-01,9.13545458e-01, 9.06307787e-01, 8.98794046e-01, 8.91006524e-01,8.82947593e-01, 8.74619707e-01, 8.66025404e-01, 8.57167301e-01,8.48048096e-01, 8.38670568e-01, 8.29037573e-01, 8.19152044e-01,8.09016994e-01, 7.98635510e-01, 7.88010754e-01, 7.77145961e-01,7.66044443e-01, 7.54709580e-01, 7.43144825e-01, 7.31353702e-01,7.19339800e-01, 7.07106781e-01, 6.94658370e-01, 6.81998360e-01,6.69130606e-01, 6.56059029e-01, 6.42787610e-01, 6.29320391e-01,6.15661475e-01, 6.01815023e-01, 5.87785252e-01, 5.73576436e-01,5.59192903e-01, 5.44639035e-01, 5.29919264e-01, 5.15038075e-01,5.00000000e-01, 4.84809620e-01, 4.69471563e-01, 4.53990500e-01,4.38371147e-01, 4.22618262e-01, 4.06736643e-01, 3.90731128e-01,3.74606593e-01, 3.58367950e-01, 3.42020143e-01, 3.25568154e-01,3.09016994e-01, 2.92371705e-01, 2.75637356e-01, 2.58819045e-01,2.41921896e-01, 2.24951054e-01, 2.07911691e-01, 1.90808995e-01,1.73648178e-01, 1.56434465e-01, 1.39173101e-01, 1.21869343e-01,1.04528463e-01, 8.71557427e-02, 6.97564737e-02, 5.23359562e-02,3.48994967e-02, 1.74524064e-02, 6.12323400e-17, 1.74524064e-02,3.48994967e-02, 5.23359562e-02, 6.97564737e-02, 8.71557427e-02,1.04528463e-01, 1.21869343e-01, 1.39173101e-01, 1.56434465e-01,1.73648178e-01, 1.90808995e-01, 2.07911691e-01, 2.24951054e-01,2.41921896e-01, 2.58819045e-01, 2.75637356e-01, 2.92371705e-01,3.09016994e-01, 3.25568154e-01, 3.42020143e-01, 3.58367950e-01,3.74606593e-01, 3.90731128e-01, 4.06736643e-01, 4.22618262e-01,4.38371147e-01, 4.53990500e-01, 4.69471563e-01, 4.84809620e-01,5.00000000e-01, 5.15038075e-01, 5.29919264e-01, 5.44639035e-01,5.59192903e-01, 5.73576436e-01, 5.87785252e-01, 6.01815023e-01,6.15661475e-01, 6.29320391e-01, 6.42787610e-01, 6.56059029e-01,6.69130606e-01, 6.81998360e-01, 6.94658370e-01, 7.07106781e-01,7.19339800e-01, 7.31353702e-01, 7.43144825e-01, 7.54709580e-01,7.66044443e-01, 7.77145961e-01, 7.88010754e-01, 7.98635510e-01,8.09016994e-01, 8.19152044e-01, 8.29037573e-01, 8.38670568e-01,8.48048096e-01, 8.57167301e-01, 8.66025404e-01, 8.74619707e-01,8.82947593e-01, 8.91006524e-01, 8.98794046e-01, 9.06307787e-01,9.13545458e-01, 9.20504853e-01, 9.27183855e-01, 9.33580426e-01,9.39692621e-01, 9.45518576e-01, 9.51056516e-01, 9.56304756e-01,9.61261696e-01, 9.65925826e-01, 9.70295726e-01, 9.74370065e-01,9.78147601e-01, 9.81627183e-01, 9.84807753e-01, 9.87688341e-01,9.90268069e-01, 9.92546152e-01, 9.94521895e-01, 9.96194698e-01,9.97564050e-01, 9.98629535e-01, 9.99390827e-01, 9.99847695e-01,1.00000000e+00, 9.99847695e-01, 9.99390827e-01, 9.98629535e-01,9.97564050e-01, 9.96194698e-01, 9.94521895e-01, 9.92546152e-01,9.90268069e-01, 9.87688341e-01, 9.84807753e-01, 9.81627183e-01,9.78147601e-01, 9.74370065e-01, 9.70295726e-01, 9.65925826e-01,9.61261696e-01, 9.56304756e-01, 9.51056516e-01, 9.45518576e-01,9.39692621e-01, 9.33580426e-01, 9.27183855e-01, 9.20504853e-01,9.13545458e-01, 9.06307787e-01, 8.98794046e-01, 8.91006524e-01,8.82947593e-01, 8.74619707e-01, 8.66025404e-01, 8.57167301e-01,8.48048096e-01, 8.38670568e-01, 8.29037573e-01, 8.19152044e-01,8.09016994e-01, 7.98635510e-01, 7.88010754e-01, 7.77145961e-01,7.66044443e-01, 7.54709580e-01, 7.43144825e-01, 7.31353702e-01,7.19339800e-01, 7.07106781e-01, 6.94658370e-01, 6.81998360e-01,6.69130606e-01, 6.56059029e-01, 6.42787610e-01, 6.29320391e-01,6.15661475e-01, 6.01815023e-01, 5.87785252e-01, 5.73576436e-01,5.59192903e-01, 5.44639035e-01, 5.29919264e-01, 5.15038075e-01,5.00000000e-01, 4.84809620e-01, 4.69471563e-01, 4.53990500e-01,4.38371147e-01, 4.22618262e-01, 4.06736643e-01, 3.90731128e-01,3.74606593e-01, 3.58367950e-01, 3.42020143e-01, 3.25568154e-01,3.09016994e-01, 2.92371705e-01, 2.75637356e-01, 2.58819045e-01,2.41921896e-01, 2.24951054e-01, 2.07911691e-01, 1.90808995e-01,1.73648178e-01, 1.56434465e-01, 1.39173101e-01, 1.21869343e-01,1.04528463e-01, 8.71557427e-02, 6.97564737e-02, 5.23359562e-02,3.48994967e-02, 1.74524064e-02, 1.83697020e-16, 1.74524064e-02,3.48994967e-02, 5.23359562e-02, 6.97564737e-02, 8.71557427e-02,1.04528463e-01, 1.21869343e-01, 1.39173101e-01, 1.56434465e-01,1.73648178e-01, 1.90808995e-01, 2.07911691e-01, 2.24951054e-01,2.41921896e-01, 2.58819045e-01, 2.75637356e-01, 2.92371705e-01,3.09016994e-01, 3.25568154e-01, 3.42020143e-01, 3.58367950e-01,3.74606593e-01, 3.90731128e-01, 4.06736643e-01, 4.22618262e-01,4.38371147e-01, 4.53990500e-01, 4.69471563e-01, 4.84809620e-01,5.00000000e-01, 5.15038075e-01, 5.29919264e-01, 5.44639035e-01,5.59192903e-01, 5.73576436e-01, 5.87785252e-01, 6.01815023e-01,6.15661475e-01, 6.29320391e-01, 6.42787610e-01, 6.56059029e-01,6.69130606e-01, 6.81998360e-01, 6.94658370e-01, 7.07106781e-01,7.19339800e-01, 7.31353702e-01, 7.43144825e-01, 7.54709580e-01,7.66044443e-01, 7.77145961e-01, 7.88010754e-01, 7.98635510e-01,8.09016994e-01, 8.19152044e-01, 8.29037573e-01, 8.38670568e-01,8.48048096e-01, 8.57167301e-01, 8.66025404e-01, 8.74619707e-01,8.82947593e-01, 8.91006524e-01, 8.98794046e-01, 9.06307787e-01,9.13545458e-01, 9.20504853e-01, 9.27183855e-01, 9.33580426e-01,9.39692621e-01, 9.45518576e-01, 9.51056516e-01, 9.56304756e-01,9.61261696e-01, 9.65925826e-01, 9.70295726e-01, 9.74370065e-01,9.78147601e-01, 9.81627183e-01, 9.84807753e-01, 9.87688341e-01,9.90268069e-01, 9.92546152e-01, 9.94521895e-01, 9.96194698e-01,9.97564050e-01, 9.98629535e-01, 9.99390827e-01, 9.99847695e-01],
-                      [0.00000000e+00, 1.74524064e-02, 3.48994967e-02, 5.23359562e-02,6.97564737e-02, 8.71557427e-02, 1.04528463e-01, 1.21869343e-01,1.39173101e-01, 1.56434465e-01, 1.73648178e-01, 1.90808995e-01,2.07911691e-01, 2.24951054e-01, 2.41921896e-01, 2.58819045e-01,2.75637356e-01, 2.92371705e-01, 3.09016994e-01, 3.25568154e-01,3.42020143e-01, 3.58367950e-01, 3.74606593e-01, 3.90731128e-01,4.06736643e-01, 4.22618262e-01, 4.38371147e-01, 4.53990500e-01,4.69471563e-01, 4.84809620e-01, 5.00000000e-01, 5.15038075e-01,5.29919264e-01, 5.44639035e-01, 5.59192903e-01, 5.73576436e-01,5.87785252e-01, 6.01815023e-01, 6.15661475e-01, 6.29320391e-01,6.42787610e-01, 6.56059029e-01, 6.69130606e-01, 6.81998360e-01,6.94658370e-01, 7.07106781e-01, 7.19339800e-01, 7.31353702e-01,7.43144825e-01, 7.54709580e-01, 7.66044443e-01, 7.77145961e-01,7.88010754e-01, 7.98635510e-01, 8.09016994e-01, 8.19152044e-01,8.29037573e-01, 8.38670568e-01, 8.48048096e-01, 8.57167301e-01,8.66025404e-01, 8.74619707e-01, 8.82947593e-01, 8.91006524e-01,8.98794046e-01, 9.06307787e-01, 9.13545458e-01, 9.20504853e-01,9.27183855e-01, 9.33580426e-01, 9.39692621e-01, 9.45518576e-01,9.51056516e-01, 9.56304756e-01, 9.61261696e-01, 9.65925826e-01,9.70295726e-01, 9.74370065e-01, 9.78147601e-01, 9.81627183e-01,9.84807753e-01, 9.87688341e-01, 9.90268069e-01, 9.92546152e-01,9.94521895e-01, 9.96194698e-01, 9.97564050e-01, 9.98629535e-01,9.99390827e-01, 9.99847695e-01, 1.00000000e+00, 9.99847695e-01,9.99390827e-01, 9.98629535e-01, 9.97564050e-01, 9.96194698e-01,9.94521895e-01, 9.92546152e-01, 9.90268069e-01, 9.87688341e-01,9.84807753e-01, 9.81627183e-01, 9.78147601e-01, 9.74370065e-01,9.70295726e-01, 9.65925826e-01, 9.61261696e-01, 9.56304756e-01,9.51056516e-01, 9.45518576e-01, 9.39692621e-01, 9.33580426e-01,9.27183855e-01, 9.20504853e-01, 9.13545458e-01, 9.06307787e-01,8.98794046e-01, 8.91006524e-01, 8.82947593e-01, 8.74619707e-01,8.66025404e-01, 8.57167301e-01, 8.48048096e-01, 8.38670568e-01,8.29037573e-01, 8.19152044e-01, 8.09016994e-01, 7.98635510e-01,7.88010754e-01, 7.77145961e-01, 7.66044443e-01, 7.54709580e-01,7.43144825e-01, 7.31353702e-01, 7.19339800e-01, 7.07106781e-01,6.94658370e-01, 6.81998360e-01, 6.69130606e-01, 6.56059029e-01,6.42787610e-01, 6.29320391e-01, 6.15661475e-01, 6.01815023e-01,5.87785252e-01, 5.73576436e-01, 5.59192903e-01, 5.44639035e-01,5.29919264e-01, 5.15038075e-01, 5.00000000e-01, 4.84809620e-01,4.69471563e-01, 4.53990500e-01, 4.38371147e-01, 4.22618262e-01,4.06736643e-01, 3.90731128e-01, 3.74606593e-01, 3.58367950e-01,3.42020143e-01, 3.25568154e-01, 3.09016994e-01, 2.92371705e-01,2.75637356e-01, 2.58819045e-01, 2.41921896e-01, 2.24951054e-01,2.07911691e-01, 1.90808995e-01, 1.73648178e-01, 1.56434465e-01,1.39173101e-01, 1.21869343e-01, 1.04528463e-01, 8.71557427e-02,6.97564737e-02, 5.23359562e-02, 3.48994967e-02, 1.74524064e-02,1.22464680e-16, 1.74524064e-02, 3.48994967e-02, 5.23359562e-02,6.97564737e-02, 8.71557427e-02, 1.04528463e-01, 1.21869343e-01,1.39173101e-01, 1.56434465e-01, 1.73648178e-01, 1.90808995e-01,2.07911691e-01, 2.24951054e-01, 2.41921896e-01, 2.58819045e-01,2.75637356e-01, 2.92371705e-01, 3.09016994e-01, 3.25568154e-01,3.42020143e-01, 3.58367950e-01, 3.74606593e-01, 3.90731128e-01,4.06736643e-01, 4.22618262e-01, 4.38371147e-01, 4.53990500e-01,4.69471563e-01, 4.84809620e-01, 5.00000000e-01, 5.15038075e-01,5.29919264e-01, 5.44639035e-01, 5.59192903e-01, 5.73576436e-01,5.87785252e-01, 6.01815023e-01, 6.15661475e-01, 6.29320391e-01,6.42787610e-01, 6.56059029e-01, 6.69130606e-01, 6.81998360e-01,6.94658370e-01, 7.07106781e-01, 7.19339800e-01, 7.31353702e-01,7.43144825e-01, 7.54709580e-01, 7.66044443e-01, 7.77145961e-01,7.88010754e-01, 7.98635510e-01, 8.09016994e-01, 8.19152044e-01,8.29037573e-01, 8.38670568e-01, 8.48048096e-01, 8.57167301e-01,8.66025404e-01, 8.74619707e-01, 8.82947593e-01, 8.91006524e-01,8.98794046e-01, 9.06307787e-01, 9.13545458e-01, 9.20504853e-01,9.27183855e-01, 9.33580426e-01, 9.39692621e-01, 9.45518576e-01,9.51056516e-01, 9.56304756e-01, 9.61261696e-01, 9.65925826e-01,9.70295726e-01, 9.74370065e-01, 9.78147601e-01, 9.81627183e-01,9.84807753e-01, 9.87688341e-01, 9.90268069e-01, 9.92546152e-01,9.94521895e-01, 9.96194698e-01, 9.97564050e-01, 9.98629535e-01,9.99390827e-01, 9.99847695e-01, 1.00000000e+00, 9.99847695e-01,9.99390827e-01, 9.98629535e-01, 9.97564050e-01, 9.96194698e-01,9.94521895e-01, 9.92546152e-01, 9.90268069e-01, 9.87688341e-01,9.84807753e-01, 9.81627183e-01, 9.78147601e-01, 9.74370065e-01,9.70295726e-01, 9.65925826e-01, 9.61261696e-01, 9.56304756e-01,9.51056516e-01, 9.45518576e-01, 9.39692621e-01, 9.33580426e-01,9.27183855e-01, 9.20504853e-01, 9.13545458e-01, 9.06307787e-01,8.98794046e-01, 8.91006524e-01, 8.82947593e-01, 8.74619707e-01,8.66025404e-01, 8.57167301e-01, 8.48048096e-01, 8.38670568e-01,8.29037573e-01, 8.19152044e-01, 8.09016994e-01, 7.98635510e-01,7.88010754e-01, 7.77145961e-01, 7.66044443e-01, 7.54709580e-01,7.43144825e-01, 7.31353702e-01, 7.19339800e-01, 7.07106781e-01,6.94658370e-01, 6.81998360e-01, 6.69130606e-01, 6.56059029e-01,6.42787610e-01, 6.29320391e-01, 6.15661475e-01, 6.01815023e-01,5.87785252e-01, 5.73576436e-01, 5.59192903e-01, 5.44639035e-01,5.29919264e-01, 5.15038075e-01, 5.00000000e-01, 4.84809620e-01,4.69471563e-01, 4.53990500e-01, 4.38371147e-01, 4.22618262e-01,4.06736643e-01, 3.90731128e-01, 3.74606593e-01, 3.58367950e-01,3.42020143e-01, 3.25568154e-01, 3.09016994e-01, 2.92371705e-01,2.75637356e-01, 2.58819045e-01, 2.41921896e-01, 2.24951054e-01,2.07911691e-01, 1.90808995e-01, 1.73648178e-01, 1.56434465e-01,1.39173101e-01, 1.21869343e-01, 1.04528463e-01, 8.71557427e-02,6.97564737e-02, 5.23359562e-02, 3.48994967e-02, 1.74524064e-02],
-                      [1.00000000e+00, 1.01730010e+00, 1.03429032e+00, 1.05096549e+00,1.06732052e+00, 1.08335044e+00, 1.09905036e+00, 1.11441550e+00,1.12944117e+00, 1.14412281e+00, 1.15845593e+00, 1.17243618e+00,1.18605929e+00, 1.19932112e+00, 1.21221762e+00, 1.22474487e+00,1.23689905e+00, 1.24867646e+00, 1.26007351e+00, 1.27108673e+00,1.28171276e+00, 1.29194838e+00, 1.30179045e+00, 1.31123598e+00,1.32028210e+00, 1.32892605e+00, 1.33716519e+00, 1.34499702e+00,1.35241916e+00, 1.35942933e+00, 1.36602540e+00, 1.37220538e+00,1.37796736e+00, 1.38330960e+00, 1.38823048e+00, 1.39272848e+00,1.39680225e+00, 1.40045053e+00, 1.40367223e+00, 1.40646635e+00,1.40883205e+00, 1.41076861e+00, 1.41227543e+00, 1.41335206e+00,1.41399817e+00, 1.41421356e+00, 1.41399817e+00, 1.41335206e+00,1.41227543e+00, 1.41076861e+00, 1.40883205e+00, 1.40646635e+00,1.40367223e+00, 1.40045053e+00, 1.39680225e+00, 1.39272848e+00,1.38823048e+00, 1.38330960e+00, 1.37796736e+00, 1.37220538e+00,1.36602540e+00, 1.35942933e+00, 1.35241916e+00, 1.34499702e+00,1.33716519e+00, 1.32892605e+00, 1.32028210e+00, 1.31123598e+00,1.30179045e+00, 1.29194838e+00, 1.28171276e+00, 1.27108673e+00,1.26007351e+00, 1.24867646e+00, 1.23689905e+00, 1.22474487e+00,1.21221762e+00, 1.19932112e+00, 1.18605929e+00, 1.17243618e+00,1.15845593e+00, 1.14412281e+00, 1.12944117e+00, 1.11441550e+00,1.09905036e+00, 1.08335044e+00, 1.06732052e+00, 1.05096549e+00,1.03429032e+00, 1.01730010e+00, 1.00000000e+00, 9.82395289e-01,9.64491330e-01, 9.46293579e-01, 9.27807577e-01, 9.09038955e-01,8.89993432e-01, 8.70676808e-01, 8.51094968e-01, 8.31253876e-01,8.11159575e-01, 7.90818188e-01, 7.70235910e-01, 7.49419010e-01,7.28373831e-01, 7.07106781e-01, 6.85624340e-01, 6.63933051e-01,6.42039522e-01, 6.19950421e-01, 5.97672477e-01, 5.75212477e-01,5.52577261e-01, 5.29773725e-01, 5.06808815e-01, 4.83689525e-01,4.60422900e-01, 4.37016024e-01, 4.13476030e-01, 3.89810087e-01,3.66025404e-01, 3.42129226e-01, 3.18128832e-01, 2.94031533e-01,2.69844669e-01, 2.45575608e-01, 2.21231742e-01, 1.96820487e-01,1.72349278e-01, 1.47825570e-01, 1.23256833e-01, 9.86505512e-02,7.40142191e-02, 4.93553416e-02, 2.46814299e-02, 1.11022302e-16,2.46814299e-02, 4.93553416e-02, 7.40142191e-02, 9.86505512e-02,1.23256833e-01, 1.47825570e-01, 1.72349278e-01, 1.96820487e-01,2.21231742e-01, 2.45575608e-01, 2.69844669e-01, 2.94031533e-01,3.18128832e-01, 3.42129226e-01, 3.66025404e-01, 3.89810087e-01,4.13476030e-01, 4.37016024e-01, 4.60422900e-01, 4.83689525e-01,5.06808815e-01, 5.29773725e-01, 5.52577261e-01, 5.75212477e-01,5.97672477e-01, 6.19950421e-01, 6.42039522e-01, 6.63933051e-01,6.85624340e-01, 7.07106781e-01, 7.28373831e-01, 7.49419010e-01,7.70235910e-01, 7.90818188e-01, 8.11159575e-01, 8.31253876e-01,8.51094968e-01, 8.70676808e-01, 8.89993432e-01, 9.09038955e-01,9.27807577e-01, 9.46293579e-01, 9.64491330e-01, 9.82395289e-01,1.00000000e+00, 1.01730010e+00, 1.03429032e+00, 1.05096549e+00,1.06732052e+00, 1.08335044e+00, 1.09905036e+00, 1.11441550e+00,1.12944117e+00, 1.14412281e+00, 1.15845593e+00, 1.17243618e+00,1.18605929e+00, 1.19932112e+00, 1.21221762e+00, 1.22474487e+00,1.23689905e+00, 1.24867646e+00, 1.26007351e+00, 1.27108673e+00,1.28171276e+00, 1.29194838e+00, 1.30179045e+00, 1.31123598e+00,1.32028210e+00, 1.32892605e+00, 1.33716519e+00, 1.34499702e+00,1.35241916e+00, 1.35942933e+00, 1.36602540e+00, 1.37220538e+00,1.37796736e+00, 1.38330960e+00, 1.38823048e+00, 1.39272848e+00,1.39680225e+00, 1.40045053e+00, 1.40367223e+00, 1.40646635e+00,1.40883205e+00, 1.41076861e+00, 1.41227543e+00, 1.41335206e+00,1.41399817e+00, 1.41421356e+00, 1.41399817e+00, 1.41335206e+00,1.41227543e+00, 1.41076861e+00, 1.40883205e+00, 1.40646635e+00,1.40367223e+00, 1.40045053e+00, 1.39680225e+00, 1.39272848e+00,1.38823048e+00, 1.38330960e+00, 1.37796736e+00, 1.37220538e+00,1.36602540e+00, 1.35942933e+00, 1.35241916e+00, 1.34499702e+00,1.33716519e+00, 1.32892605e+00, 1.32028210e+00, 1.31123598e+00,1.30179045e+00, 1.29194838e+00, 1.28171276e+00, 1.27108673e+00,1.26007351e+00, 1.24867646e+00, 1.23689905e+00, 1.22474487e+00,1.21221762e+00, 1.19932112e+00, 1.18605929e+00, 1.17243618e+00,1.15845593e+00, 1.14412281e+00, 1.12944117e+00, 1.11441550e+00,1.09905036e+00, 1.08335044e+00, 1.06732052e+00, 1.05096549e+00,1.03429032e+00, 1.01730010e+00, 1.00000000e+00, 9.82395289e-01,9.64491330e-01, 9.46293579e-01, 9.27807577e-01, 9.09038955e-01,8.89993432e-01, 8.70676808e-01, 8.51094968e-01, 8.31253876e-01,8.11159575e-01, 7.90818188e-01, 7.70235910e-01, 7.49419010e-01,7.28373831e-01, 7.07106781e-01, 6.85624340e-01, 6.63933051e-01,6.42039522e-01, 6.19950421e-01, 5.97672477e-01, 5.75212477e-01,5.52577261e-01, 5.29773725e-01, 5.06808815e-01, 4.83689525e-01,4.60422900e-01, 4.37016024e-01, 4.13476030e-01, 3.89810087e-01,3.66025404e-01, 3.42129226e-01, 3.18128832e-01, 2.94031533e-01,2.69844669e-01, 2.45575608e-01, 2.21231742e-01, 1.96820487e-01,1.72349278e-01, 1.47825570e-01, 1.23256833e-01, 9.86505512e-02,7.40142191e-02, 4.93553416e-02, 2.46814299e-02, 3.33066907e-16,2.46814299e-02, 4.93553416e-02, 7.40142191e-02, 9.86505512e-02,1.23256833e-01, 1.47825570e-01, 1.72349278e-01, 1.96820487e-01,2.21231742e-01, 2.45575608e-01, 2.69844669e-01, 2.94031533e-01,3.18128832e-01, 3.42129226e-01, 3.66025404e-01, 3.89810087e-01,4.13476030e-01, 4.37016024e-01, 4.60422900e-01, 4.83689525e-01,5.06808815e-01, 5.29773725e-01, 5.52577261e-01, 5.75212477e-01,5.97672477e-01, 6.19950421e-01, 6.42039522e-01, 6.63933051e-01,6.85624340e-01, 7.07106781e-01, 7.28373831e-01, 7.49419010e-01,7.70235910e-01, 7.90818188e-01, 8.11159575e-01, 8.31253876e-01,8.51094968e-01, 8.70676808e-01, 8.89993432e-01, 9.09038955e-01,9.27807577e-01, 9.46293579e-01, 9.64491330e-01, 9.82395289e-01],
-                      [1.00000000e+00, 9.82395289e-01, 9.64491330e-01, 9.46293579e-01,9.27807577e-01, 9.09038955e-01, 8.89993432e-01, 8.70676808e-01,8.51094968e-01, 8.31253876e-01, 8.11159575e-01, 7.90818188e-01,7.70235910e-01, 7.49419010e-01, 7.28373831e-01, 7.07106781e-01,6.85624340e-01, 6.63933051e-01, 6.42039522e-01, 6.19950421e-01,5.97672477e-01, 5.75212477e-01, 5.52577261e-01, 5.29773725e-01,5.06808815e-01, 4.83689525e-01, 4.60422900e-01, 4.37016024e-01,4.13476030e-01, 3.89810087e-01, 3.66025404e-01, 3.42129226e-01,3.18128832e-01, 2.94031533e-01, 2.69844669e-01, 2.45575608e-01,2.21231742e-01, 1.96820487e-01, 1.72349278e-01, 1.47825570e-01,1.23256833e-01, 9.86505512e-02, 7.40142191e-02, 4.93553416e-02,2.46814299e-02, 1.11022302e-16, 2.46814299e-02, 4.93553416e-02,7.40142191e-02, 9.86505512e-02, 1.23256833e-01, 1.47825570e-01,1.72349278e-01, 1.96820487e-01, 2.21231742e-01, 2.45575608e-01,2.69844669e-01, 2.94031533e-01, 3.18128832e-01, 3.42129226e-01,3.66025404e-01, 3.89810087e-01, 4.13476030e-01, 4.37016024e-01,4.60422900e-01, 4.83689525e-01, 5.06808815e-01, 5.29773725e-01,5.52577261e-01, 5.75212477e-01, 5.97672477e-01, 6.19950421e-01,6.42039522e-01, 6.63933051e-01, 6.85624340e-01, 7.07106781e-01,7.28373831e-01, 7.49419010e-01, 7.70235910e-01, 7.90818188e-01,8.11159575e-01, 8.31253876e-01, 8.51094968e-01, 8.70676808e-01,8.89993432e-01, 9.09038955e-01, 9.27807577e-01, 9.46293579e-01,9.64491330e-01, 9.82395289e-01, 1.00000000e+00, 1.01730010e+00,1.03429032e+00, 1.05096549e+00, 1.06732052e+00, 1.08335044e+00,1.09905036e+00, 1.11441550e+00, 1.12944117e+00, 1.14412281e+00,1.15845593e+00, 1.17243618e+00, 1.18605929e+00, 1.19932112e+00,1.21221762e+00, 1.22474487e+00, 1.23689905e+00, 1.24867646e+00,1.26007351e+00, 1.27108673e+00, 1.28171276e+00, 1.29194838e+00,1.30179045e+00, 1.31123598e+00, 1.32028210e+00, 1.32892605e+00,1.33716519e+00, 1.34499702e+00, 1.35241916e+00, 1.35942933e+00,1.36602540e+00, 1.37220538e+00, 1.37796736e+00, 1.38330960e+00,1.38823048e+00, 1.39272848e+00, 1.39680225e+00, 1.40045053e+00,1.40367223e+00, 1.40646635e+00, 1.40883205e+00, 1.41076861e+00,1.41227543e+00, 1.41335206e+00, 1.41399817e+00, 1.41421356e+00,1.41399817e+00, 1.41335206e+00, 1.41227543e+00, 1.41076861e+00,1.40883205e+00, 1.40646635e+00, 1.40367223e+00, 1.40045053e+00,1.39680225e+00, 1.39272848e+00, 1.38823048e+00, 1.38330960e+00,1.37796736e+00, 1.37220538e+00, 1.36602540e+00, 1.35942933e+00,1.35241916e+00, 1.34499702e+00, 1.33716519e+00, 1.32892605e+00,1.32028210e+00, 1.31123598e+00, 1.30179045e+00, 1.29194838e+00,1.28171276e+00, 1.27108673e+00, 1.26007351e+00, 1.24867646e+00,1.23689905e+00, 1.22474487e+00, 1.21221762e+00, 1.19932112e+00,1.18605929e+00, 1.17243618e+00, 1.15845593e+00, 1.14412281e+00,1.12944117e+00, 1.11441550e+00, 1.09905036e+00, 1.08335044e+00,1.06732052e+00, 1.05096549e+00, 1.03429032e+00, 1.01730010e+00,1.00000000e+00, 9.82395289e-01, 9.64491330e-01, 9.46293579e-01,9.27807577e-01, 9.09038955e-01, 8.89993432e-01, 8.70676808e-01,8.51094968e-01, 8.31253876e-01, 8.11159575e-01, 7.90818188e-01,7.70235910e-01, 7.49419010e-01, 7.28373831e-01, 7.07106781e-01,6.85624340e-01, 6.63933051e-01, 6.42039522e-01, 6.19950421e-01,5.97672477e-01, 5.75212477e-01, 5.52577261e-01, 5.29773725e-01,5.06808815e-01, 4.83689525e-01, 4.60422900e-01, 4.37016024e-01,4.13476030e-01, 3.89810087e-01, 3.66025404e-01, 3.42129226e-01,3.18128832e-01, 2.94031533e-01, 2.69844669e-01, 2.45575608e-01,2.21231742e-01, 1.96820487e-01, 1.72349278e-01, 1.47825570e-01,1.23256833e-01, 9.86505512e-02, 7.40142191e-02, 4.93553416e-02,2.46814299e-02, 2.22044605e-16, 2.46814299e-02, 4.93553416e-02,7.40142191e-02, 9.86505512e-02, 1.23256833e-01, 1.47825570e-01,1.72349278e-01, 1.96820487e-01, 2.21231742e-01, 2.45575608e-01,2.69844669e-01, 2.94031533e-01, 3.18128832e-01, 3.42129226e-01,3.66025404e-01, 3.89810087e-01, 4.13476030e-01, 4.37016024e-01,4.60422900e-01, 4.83689525e-01, 5.06808815e-01, 5.29773725e-01,5.52577261e-01, 5.75212477e-01, 5.97672477e-01, 6.19950421e-01,6.42039522e-01, 6.63933051e-01, 6.85624340e-01, 7.07106781e-01,7.28373831e-01, 7.49419010e-01, 7.70235910e-01, 7.90818188e-01,8.11159575e-01, 8.31253876e-01, 8.51094968e-01, 8.70676808e-01,8.89993432e-01, 9.09038955e-01, 9.27807577e-01, 9.46293579e-01,9.64491330e-01, 9.82395289e-01, 1.00000000e+00, 1.01730010e+00,1.03429032e+00, 1.05096549e+00, 1.06732052e+00, 1.08335044e+00,1.09905036e+00, 1.11441550e+00, 1.12944117e+00, 1.14412281e+00,1.15845593e+00, 1.17243618e+00, 1.18605929e+00, 1.19932112e+00,1.21221762e+00, 1.22474487e+00, 1.23689905e+00, 1.24867646e+00,1.26007351e+00, 1.27108673e+00, 1.28171276e+00, 1.29194838e+00,1.30179045e+00, 1.31123598e+00, 1.32028210e+00, 1.32892605e+00,1.33716519e+00, 1.34499702e+00, 1.35241916e+00, 1.35942933e+00,1.36602540e+00, 1.37220538e+00, 1.37796736e+00, 1.38330960e+00,1.38823048e+00, 1.39272848e+00, 1.39680225e+00, 1.40045053e+00,1.40367223e+00, 1.40646635e+00, 1.40883205e+00, 1.41076861e+00,1.41227543e+00, 1.41335206e+00, 1.41399817e+00, 1.41421356e+00,1.41399817e+00, 1.41335206e+00, 1.41227543e+00, 1.41076861e+00,1.40883205e+00, 1.40646635e+00, 1.40367223e+00, 1.40045053e+00,1.39680225e+00, 1.39272848e+00, 1.38823048e+00, 1.38330960e+00,1.37796736e+00, 1.37220538e+00, 1.36602540e+00, 1.35942933e+00,1.35241916e+00, 1.34499702e+00, 1.33716519e+00, 1.32892605e+00,1.32028210e+00, 1.31123598e+00, 1.30179045e+00, 1.29194838e+00,1.28171276e+00, 1.27108673e+00, 1.26007351e+00, 1.24867646e+00,1.23689905e+00, 1.22474487e+00, 1.21221762e+00, 1.19932112e+00,1.18605929e+00, 1.17243618e+00, 1.15845593e+00, 1.14412281e+00,1.12944117e+00, 1.11441550e+00, 1.09905036e+00, 1.08335044e+00,1.06732052e+00, 1.05096549e+00, 1.03429032e+00, 1.01730010e+00]
-                     ])
-    term1 = np.row_stack((term1, term1))
-
-    #tt2 = []
-    #tt2.append(sin_p/ss)
-    #tt2.append(cos_p/ ss)
-    #tt2.append(sin_minus_cos/ ss)
-    #tt2.append(sin_plus_cos/ ss)
-    #tt2.extend([-tt2[0], -tt2[1], -tt2[2], -tt2[3]])
-
-    tt2 = np.array([
-        [ 0.00000000e+00,  1.74524064e-02,  3.48994967e-02,  5.23359562e-02, 6.97564737e-02,  8.71557427e-02,  1.04528463e-01,  1.21869343e-01, 1.39173101e-01,  1.56434465e-01,  1.73648178e-01,  1.90808995e-01, 2.07911691e-01,  2.24951054e-01,  2.41921896e-01,  2.58819045e-01, 2.75637356e-01,  2.92371705e-01,  3.09016994e-01,  3.25568154e-01, 3.42020143e-01,  3.58367950e-01,  3.74606593e-01,  3.90731128e-01, 4.06736643e-01,  4.22618262e-01,  4.38371147e-01,  4.53990500e-01, 4.69471563e-01,  4.84809620e-01,  5.00000000e-01,  5.15038075e-01, 5.29919264e-01,  5.44639035e-01,  5.59192903e-01,  5.73576436e-01, 5.87785252e-01,  6.01815023e-01,  6.15661475e-01,  6.29320391e-01, 6.42787610e-01,  6.56059029e-01,  6.69130606e-01,  6.81998360e-01, 6.94658370e-01,  7.07106781e-01,  7.19339800e-01,  7.31353702e-01, 7.43144825e-01,  7.54709580e-01,  7.66044443e-01,  7.77145961e-01, 7.88010754e-01,  7.98635510e-01,  8.09016994e-01,  8.19152044e-01, 8.29037573e-01,  8.38670568e-01,  8.48048096e-01,  8.57167301e-01, 8.66025404e-01,  8.74619707e-01,  8.82947593e-01,  8.91006524e-01, 8.98794046e-01,  9.06307787e-01,  9.13545458e-01,  9.20504853e-01, 9.27183855e-01,  9.33580426e-01,  9.39692621e-01,  9.45518576e-01, 9.51056516e-01,  9.56304756e-01,  9.61261696e-01,  9.65925826e-01, 9.70295726e-01,  9.74370065e-01,  9.78147601e-01,  9.81627183e-01, 9.84807753e-01,  9.87688341e-01,  9.90268069e-01,  9.92546152e-01, 9.94521895e-01,  9.96194698e-01,  9.97564050e-01,  9.98629535e-01, 9.99390827e-01,  9.99847695e-01,  1.00000000e+00,  9.99847695e-01, 9.99390827e-01,  9.98629535e-01,  9.97564050e-01,  9.96194698e-01, 9.94521895e-01,  9.92546152e-01,  9.90268069e-01,  9.87688341e-01, 9.84807753e-01,  9.81627183e-01,  9.78147601e-01,  9.74370065e-01, 9.70295726e-01,  9.65925826e-01,  9.61261696e-01,  9.56304756e-01, 9.51056516e-01,  9.45518576e-01,  9.39692621e-01,  9.33580426e-01, 9.27183855e-01,  9.20504853e-01,  9.13545458e-01,  9.06307787e-01, 8.98794046e-01,  8.91006524e-01,  8.82947593e-01,  8.74619707e-01, 8.66025404e-01,  8.57167301e-01,  8.48048096e-01,  8.38670568e-01, 8.29037573e-01,  8.19152044e-01,  8.09016994e-01,  7.98635510e-01, 7.88010754e-01,  7.77145961e-01,  7.66044443e-01,  7.54709580e-01, 7.43144825e-01,  7.31353702e-01,  7.19339800e-01,  7.07106781e-01, 6.94658370e-01,  6.81998360e-01,  6.69130606e-01,  6.56059029e-01, 6.42787610e-01,  6.29320391e-01,  6.15661475e-01,  6.01815023e-01, 5.87785252e-01,  5.73576436e-01,  5.59192903e-01,  5.44639035e-01, 5.29919264e-01,  5.15038075e-01,  5.00000000e-01,  4.84809620e-01, 4.69471563e-01,  4.53990500e-01,  4.38371147e-01,  4.22618262e-01, 4.06736643e-01,  3.90731128e-01,  3.74606593e-01,  3.58367950e-01, 3.42020143e-01,  3.25568154e-01,  3.09016994e-01,  2.92371705e-01, 2.75637356e-01,  2.58819045e-01,  2.41921896e-01,  2.24951054e-01, 2.07911691e-01,  1.90808995e-01,  1.73648178e-01,  1.56434465e-01, 1.39173101e-01,  1.21869343e-01,  1.04528463e-01,  8.71557427e-02, 6.97564737e-02,  5.23359562e-02,  3.48994967e-02,  1.74524064e-02, 1.22464680e-16, -1.74524064e-02, -3.48994967e-02, -5.23359562e-02,-6.97564737e-02, -8.71557427e-02, -1.04528463e-01, -1.21869343e-01,-1.39173101e-01, -1.56434465e-01, -1.73648178e-01, -1.90808995e-01,-2.07911691e-01, -2.24951054e-01, -2.41921896e-01, -2.58819045e-01,-2.75637356e-01, -2.92371705e-01, -3.09016994e-01, -3.25568154e-01,-3.42020143e-01, -3.58367950e-01, -3.74606593e-01, -3.90731128e-01,-4.06736643e-01, -4.22618262e-01, -4.38371147e-01, -4.53990500e-01,-4.69471563e-01, -4.84809620e-01, -5.00000000e-01, -5.15038075e-01,-5.29919264e-01, -5.44639035e-01, -5.59192903e-01, -5.73576436e-01,-5.87785252e-01, -6.01815023e-01, -6.15661475e-01, -6.29320391e-01,-6.42787610e-01, -6.56059029e-01, -6.69130606e-01, -6.81998360e-01,-6.94658370e-01, -7.07106781e-01, -7.19339800e-01, -7.31353702e-01,-7.43144825e-01, -7.54709580e-01, -7.66044443e-01, -7.77145961e-01,-7.88010754e-01, -7.98635510e-01, -8.09016994e-01, -8.19152044e-01,-8.29037573e-01, -8.38670568e-01, -8.48048096e-01, -8.57167301e-01,-8.66025404e-01, -8.74619707e-01, -8.82947593e-01, -8.91006524e-01,-8.98794046e-01, -9.06307787e-01, -9.13545458e-01, -9.20504853e-01,-9.27183855e-01, -9.33580426e-01, -9.39692621e-01, -9.45518576e-01,-9.51056516e-01, -9.56304756e-01, -9.61261696e-01, -9.65925826e-01,-9.70295726e-01, -9.74370065e-01, -9.78147601e-01, -9.81627183e-01,-9.84807753e-01, -9.87688341e-01, -9.90268069e-01, -9.92546152e-01,-9.94521895e-01, -9.96194698e-01, -9.97564050e-01, -9.98629535e-01,-9.99390827e-01, -9.99847695e-01, -1.00000000e+00, -9.99847695e-01,-9.99390827e-01, -9.98629535e-01, -9.97564050e-01, -9.96194698e-01,-9.94521895e-01, -9.92546152e-01, -9.90268069e-01, -9.87688341e-01,-9.84807753e-01, -9.81627183e-01, -9.78147601e-01, -9.74370065e-01,-9.70295726e-01, -9.65925826e-01, -9.61261696e-01, -9.56304756e-01,-9.51056516e-01, -9.45518576e-01, -9.39692621e-01, -9.33580426e-01,-9.27183855e-01, -9.20504853e-01, -9.13545458e-01, -9.06307787e-01,-8.98794046e-01, -8.91006524e-01, -8.82947593e-01, -8.74619707e-01,-8.66025404e-01, -8.57167301e-01, -8.48048096e-01, -8.38670568e-01,-8.29037573e-01, -8.19152044e-01, -8.09016994e-01, -7.98635510e-01,-7.88010754e-01, -7.77145961e-01, -7.66044443e-01, -7.54709580e-01,-7.43144825e-01, -7.31353702e-01, -7.19339800e-01, -7.07106781e-01,-6.94658370e-01, -6.81998360e-01, -6.69130606e-01, -6.56059029e-01,-6.42787610e-01, -6.29320391e-01, -6.15661475e-01, -6.01815023e-01,-5.87785252e-01, -5.73576436e-01, -5.59192903e-01, -5.44639035e-01,-5.29919264e-01, -5.15038075e-01, -5.00000000e-01, -4.84809620e-01,-4.69471563e-01, -4.53990500e-01, -4.38371147e-01, -4.22618262e-01,-4.06736643e-01, -3.90731128e-01, -3.74606593e-01, -3.58367950e-01,-3.42020143e-01, -3.25568154e-01, -3.09016994e-01, -2.92371705e-01,-2.75637356e-01, -2.58819045e-01, -2.41921896e-01, -2.24951054e-01,-2.07911691e-01, -1.90808995e-01, -1.73648178e-01, -1.56434465e-01,-1.39173101e-01, -1.21869343e-01, -1.04528463e-01, -8.71557427e-02,-6.97564737e-02, -5.23359562e-02, -3.48994967e-02, -1.74524064e-02],
-        [1.00000000e+00, 9.99847695e-01, 9.99390827e-01, 9.98629535e-01,9.97564050e-01, 9.96194698e-01, 9.94521895e-01, 9.92546152e-01,9.90268069e-01, 9.87688341e-01, 9.84807753e-01, 9.81627183e-01,9.78147601e-01, 9.74370065e-01, 9.70295726e-01, 9.65925826e-01,9.61261696e-01, 9.56304756e-01, 9.51056516e-01, 9.45518576e-01,9.39692621e-01, 9.33580426e-01, 9.27183855e-01, 9.20504853e-01,9.13545458e-01, 9.06307787e-01, 8.98794046e-01, 8.91006524e-01,8.82947593e-01, 8.74619707e-01, 8.66025404e-01, 8.57167301e-01,8.48048096e-01, 8.38670568e-01, 8.29037573e-01, 8.19152044e-01,8.09016994e-01, 7.98635510e-01, 7.88010754e-01, 7.77145961e-01,7.66044443e-01, 7.54709580e-01, 7.43144825e-01, 7.31353702e-01,7.19339800e-01, 7.07106781e-01, 6.94658370e-01, 6.81998360e-01,6.69130606e-01, 6.56059029e-01, 6.42787610e-01, 6.29320391e-01,6.15661475e-01, 6.01815023e-01, 5.87785252e-01, 5.73576436e-01,5.59192903e-01, 5.44639035e-01, 5.29919264e-01, 5.15038075e-01,5.00000000e-01, 4.84809620e-01, 4.69471563e-01, 4.53990500e-01,4.38371147e-01, 4.22618262e-01, 4.06736643e-01, 3.90731128e-01,3.74606593e-01, 3.58367950e-01, 3.42020143e-01, 3.25568154e-01,3.09016994e-01, 2.92371705e-01, 2.75637356e-01, 2.58819045e-01,2.41921896e-01, 2.24951054e-01, 2.07911691e-01, 1.90808995e-01,1.73648178e-01, 1.56434465e-01, 1.39173101e-01, 1.21869343e-01,1.04528463e-01, 8.71557427e-02, 6.97564737e-02, 5.23359562e-02,3.48994967e-02, 1.74524064e-02, 6.12323400e-17, -1.74524064e-02,-3.48994967e-02, -5.23359562e-02, -6.97564737e-02, -8.71557427e-02,-1.04528463e-01, -1.21869343e-01, -1.39173101e-01, -1.56434465e-01,-1.73648178e-01, -1.90808995e-01, -2.07911691e-01, -2.24951054e-01,-2.41921896e-01, -2.58819045e-01, -2.75637356e-01, -2.92371705e-01,-3.09016994e-01, -3.25568154e-01, -3.42020143e-01, -3.58367950e-01,-3.74606593e-01, -3.90731128e-01, -4.06736643e-01, -4.22618262e-01,-4.38371147e-01, -4.53990500e-01, -4.69471563e-01, -4.84809620e-01,-5.00000000e-01, -5.15038075e-01, -5.29919264e-01, -5.44639035e-01,-5.59192903e-01, -5.73576436e-01, -5.87785252e-01, -6.01815023e-01,-6.15661475e-01, -6.29320391e-01, -6.42787610e-01, -6.56059029e-01,-6.69130606e-01, -6.81998360e-01, -6.94658370e-01, -7.07106781e-01,-7.19339800e-01, -7.31353702e-01, -7.43144825e-01, -7.54709580e-01,-7.66044443e-01, -7.77145961e-01, -7.88010754e-01, -7.98635510e-01,-8.09016994e-01, -8.19152044e-01, -8.29037573e-01, -8.38670568e-01,-8.48048096e-01, -8.57167301e-01, -8.66025404e-01, -8.74619707e-01,-8.82947593e-01, -8.91006524e-01, -8.98794046e-01, -9.06307787e-01,-9.13545458e-01, -9.20504853e-01, -9.27183855e-01, -9.33580426e-01,-9.39692621e-01, -9.45518576e-01, -9.51056516e-01, -9.56304756e-01,-9.61261696e-01, -9.65925826e-01, -9.70295726e-01, -9.74370065e-01,-9.78147601e-01, -9.81627183e-01, -9.84807753e-01, -9.87688341e-01,-9.90268069e-01, -9.92546152e-01, -9.94521895e-01, -9.96194698e-01,-9.97564050e-01, -9.98629535e-01, -9.99390827e-01, -9.99847695e-01,-1.00000000e+00, -9.99847695e-01, -9.99390827e-01, -9.98629535e-01,-9.97564050e-01, -9.96194698e-01, -9.94521895e-01, -9.92546152e-01,-9.90268069e-01, -9.87688341e-01, -9.84807753e-01, -9.81627183e-01,-9.78147601e-01, -9.74370065e-01, -9.70295726e-01, -9.65925826e-01,-9.61261696e-01, -9.56304756e-01, -9.51056516e-01, -9.45518576e-01,-9.39692621e-01, -9.33580426e-01, -9.27183855e-01, -9.20504853e-01,-9.13545458e-01, -9.06307787e-01, -8.98794046e-01, -8.91006524e-01,-8.82947593e-01, -8.74619707e-01, -8.66025404e-01, -8.57167301e-01,-8.48048096e-01, -8.38670568e-01, -8.29037573e-01, -8.19152044e-01,-8.09016994e-01, -7.98635510e-01, -7.88010754e-01, -7.77145961e-01,-7.66044443e-01, -7.54709580e-01, -7.43144825e-01, -7.31353702e-01,-7.19339800e-01, -7.07106781e-01, -6.94658370e-01, -6.81998360e-01,-6.69130606e-01, -6.56059029e-01, -6.42787610e-01, -6.29320391e-01,-6.15661475e-01, -6.01815023e-01, -5.87785252e-01, -5.73576436e-01,-5.59192903e-01, -5.44639035e-01, -5.29919264e-01, -5.15038075e-01,-5.00000000e-01, -4.84809620e-01, -4.69471563e-01, -4.53990500e-01,-4.38371147e-01, -4.22618262e-01, -4.06736643e-01, -3.90731128e-01,-3.74606593e-01, -3.58367950e-01, -3.42020143e-01, -3.25568154e-01,-3.09016994e-01, -2.92371705e-01, -2.75637356e-01, -2.58819045e-01,-2.41921896e-01, -2.24951054e-01, -2.07911691e-01, -1.90808995e-01,-1.73648178e-01, -1.56434465e-01, -1.39173101e-01, -1.21869343e-01,-1.04528463e-01, -8.71557427e-02, -6.97564737e-02, -5.23359562e-02,-3.48994967e-02, -1.74524064e-02, -1.83697020e-16, 1.74524064e-02,3.48994967e-02, 5.23359562e-02, 6.97564737e-02, 8.71557427e-02,1.04528463e-01, 1.21869343e-01, 1.39173101e-01, 1.56434465e-01,1.73648178e-01, 1.90808995e-01, 2.07911691e-01, 2.24951054e-01,2.41921896e-01, 2.58819045e-01, 2.75637356e-01, 2.92371705e-01,3.09016994e-01, 3.25568154e-01, 3.42020143e-01, 3.58367950e-01,3.74606593e-01, 3.90731128e-01, 4.06736643e-01, 4.22618262e-01,4.38371147e-01, 4.53990500e-01, 4.69471563e-01, 4.84809620e-01,5.00000000e-01, 5.15038075e-01, 5.29919264e-01, 5.44639035e-01,5.59192903e-01, 5.73576436e-01, 5.87785252e-01, 6.01815023e-01,6.15661475e-01, 6.29320391e-01, 6.42787610e-01, 6.56059029e-01,6.69130606e-01, 6.81998360e-01, 6.94658370e-01, 7.07106781e-01,7.19339800e-01, 7.31353702e-01, 7.43144825e-01, 7.54709580e-01,7.66044443e-01, 7.77145961e-01, 7.88010754e-01, 7.98635510e-01,8.09016994e-01, 8.19152044e-01, 8.29037573e-01, 8.38670568e-01,8.48048096e-01, 8.57167301e-01, 8.66025404e-01, 8.74619707e-01,8.82947593e-01, 8.91006524e-01, 8.98794046e-01, 9.06307787e-01,9.13545458e-01, 9.20504853e-01, 9.27183855e-01, 9.33580426e-01,9.39692621e-01, 9.45518576e-01, 9.51056516e-01, 9.56304756e-01,9.61261696e-01, 9.65925826e-01, 9.70295726e-01, 9.74370065e-01,9.78147601e-01, 9.81627183e-01, 9.84807753e-01, 9.87688341e-01,9.90268069e-01, 9.92546152e-01, 9.94521895e-01, 9.96194698e-01,9.97564050e-01, 9.98629535e-01, 9.99390827e-01, 9.99847695e-01],
-        [-1.00000000e+00, -9.82395289e-01, -9.64491330e-01, -9.46293579e-01,-9.27807577e-01, -9.09038955e-01, -8.89993432e-01, -8.70676808e-01,-8.51094968e-01, -8.31253876e-01, -8.11159575e-01, -7.90818188e-01,-7.70235910e-01, -7.49419010e-01, -7.28373831e-01, -7.07106781e-01,-6.85624340e-01, -6.63933051e-01, -6.42039522e-01, -6.19950421e-01,-5.97672477e-01, -5.75212477e-01, -5.52577261e-01, -5.29773725e-01,-5.06808815e-01, -4.83689525e-01, -4.60422900e-01, -4.37016024e-01,-4.13476030e-01, -3.89810087e-01, -3.66025404e-01, -3.42129226e-01,-3.18128832e-01, -2.94031533e-01, -2.69844669e-01, -2.45575608e-01,-2.21231742e-01, -1.96820487e-01, -1.72349278e-01, -1.47825570e-01,-1.23256833e-01, -9.86505512e-02, -7.40142191e-02, -4.93553416e-02,-2.46814299e-02, -1.11022302e-16, 2.46814299e-02, 4.93553416e-02,7.40142191e-02, 9.86505512e-02, 1.23256833e-01, 1.47825570e-01,1.72349278e-01, 1.96820487e-01, 2.21231742e-01, 2.45575608e-01,2.69844669e-01, 2.94031533e-01, 3.18128832e-01, 3.42129226e-01,3.66025404e-01, 3.89810087e-01, 4.13476030e-01, 4.37016024e-01,4.60422900e-01, 4.83689525e-01, 5.06808815e-01, 5.29773725e-01,5.52577261e-01, 5.75212477e-01, 5.97672477e-01, 6.19950421e-01,6.42039522e-01, 6.63933051e-01, 6.85624340e-01, 7.07106781e-01,7.28373831e-01, 7.49419010e-01, 7.70235910e-01, 7.90818188e-01,8.11159575e-01, 8.31253876e-01, 8.51094968e-01, 8.70676808e-01,8.89993432e-01, 9.09038955e-01, 9.27807577e-01, 9.46293579e-01,9.64491330e-01, 9.82395289e-01, 1.00000000e+00, 1.01730010e+00,1.03429032e+00, 1.05096549e+00, 1.06732052e+00, 1.08335044e+00,1.09905036e+00, 1.11441550e+00, 1.12944117e+00, 1.14412281e+00,1.15845593e+00, 1.17243618e+00, 1.18605929e+00, 1.19932112e+00,1.21221762e+00, 1.22474487e+00, 1.23689905e+00, 1.24867646e+00,1.26007351e+00, 1.27108673e+00, 1.28171276e+00, 1.29194838e+00,1.30179045e+00, 1.31123598e+00, 1.32028210e+00, 1.32892605e+00,1.33716519e+00, 1.34499702e+00, 1.35241916e+00, 1.35942933e+00,1.36602540e+00, 1.37220538e+00, 1.37796736e+00, 1.38330960e+00,1.38823048e+00, 1.39272848e+00, 1.39680225e+00, 1.40045053e+00,1.40367223e+00, 1.40646635e+00, 1.40883205e+00, 1.41076861e+00,1.41227543e+00, 1.41335206e+00, 1.41399817e+00, 1.41421356e+00,1.41399817e+00, 1.41335206e+00, 1.41227543e+00, 1.41076861e+00,1.40883205e+00, 1.40646635e+00, 1.40367223e+00, 1.40045053e+00,1.39680225e+00, 1.39272848e+00, 1.38823048e+00, 1.38330960e+00,1.37796736e+00, 1.37220538e+00, 1.36602540e+00, 1.35942933e+00,1.35241916e+00, 1.34499702e+00, 1.33716519e+00, 1.32892605e+00,1.32028210e+00, 1.31123598e+00, 1.30179045e+00, 1.29194838e+00,1.28171276e+00, 1.27108673e+00, 1.26007351e+00, 1.24867646e+00,1.23689905e+00, 1.22474487e+00, 1.21221762e+00, 1.19932112e+00,1.18605929e+00, 1.17243618e+00, 1.15845593e+00, 1.14412281e+00,1.12944117e+00, 1.11441550e+00, 1.09905036e+00, 1.08335044e+00,1.06732052e+00, 1.05096549e+00, 1.03429032e+00, 1.01730010e+00,1.00000000e+00, 9.82395289e-01, 9.64491330e-01, 9.46293579e-01,9.27807577e-01, 9.09038955e-01, 8.89993432e-01, 8.70676808e-01,8.51094968e-01, 8.31253876e-01, 8.11159575e-01, 7.90818188e-01,7.70235910e-01, 7.49419010e-01, 7.28373831e-01, 7.07106781e-01,6.85624340e-01, 6.63933051e-01, 6.42039522e-01, 6.19950421e-01,5.97672477e-01, 5.75212477e-01, 5.52577261e-01, 5.29773725e-01,5.06808815e-01, 4.83689525e-01, 4.60422900e-01, 4.37016024e-01,4.13476030e-01, 3.89810087e-01, 3.66025404e-01, 3.42129226e-01,3.18128832e-01, 2.94031533e-01, 2.69844669e-01, 2.45575608e-01,2.21231742e-01, 1.96820487e-01, 1.72349278e-01, 1.47825570e-01,1.23256833e-01, 9.86505512e-02, 7.40142191e-02, 4.93553416e-02,2.46814299e-02, 2.22044605e-16, -2.46814299e-02, -4.93553416e-02,-7.40142191e-02, -9.86505512e-02, -1.23256833e-01, -1.47825570e-01,-1.72349278e-01, -1.96820487e-01, -2.21231742e-01, -2.45575608e-01,-2.69844669e-01, -2.94031533e-01, -3.18128832e-01, -3.42129226e-01,-3.66025404e-01, -3.89810087e-01, -4.13476030e-01, -4.37016024e-01,-4.60422900e-01, -4.83689525e-01, -5.06808815e-01, -5.29773725e-01,-5.52577261e-01, -5.75212477e-01, -5.97672477e-01, -6.19950421e-01,-6.42039522e-01, -6.63933051e-01, -6.85624340e-01, -7.07106781e-01,-7.28373831e-01, -7.49419010e-01, -7.70235910e-01, -7.90818188e-01,-8.11159575e-01, -8.31253876e-01, -8.51094968e-01, -8.70676808e-01,-8.89993432e-01, -9.09038955e-01, -9.27807577e-01, -9.46293579e-01,-9.64491330e-01, -9.82395289e-01, -1.00000000e+00, -1.01730010e+00,-1.03429032e+00, -1.05096549e+00, -1.06732052e+00, -1.08335044e+00,-1.09905036e+00, -1.11441550e+00, -1.12944117e+00, -1.14412281e+00,-1.15845593e+00, -1.17243618e+00, -1.18605929e+00, -1.19932112e+00,-1.21221762e+00, -1.22474487e+00, -1.23689905e+00, -1.24867646e+00,-1.26007351e+00, -1.27108673e+00, -1.28171276e+00, -1.29194838e+00,-1.30179045e+00, -1.31123598e+00, -1.32028210e+00, -1.32892605e+00,-1.33716519e+00, -1.34499702e+00, -1.35241916e+00, -1.35942933e+00,-1.36602540e+00, -1.37220538e+00, -1.37796736e+00, -1.38330960e+00,-1.38823048e+00, -1.39272848e+00, -1.39680225e+00, -1.40045053e+00,-1.40367223e+00, -1.40646635e+00, -1.40883205e+00, -1.41076861e+00,-1.41227543e+00, -1.41335206e+00, -1.41399817e+00, -1.41421356e+00,-1.41399817e+00, -1.41335206e+00, -1.41227543e+00, -1.41076861e+00,-1.40883205e+00, -1.40646635e+00, -1.40367223e+00, -1.40045053e+00,-1.39680225e+00, -1.39272848e+00, -1.38823048e+00, -1.38330960e+00,-1.37796736e+00, -1.37220538e+00, -1.36602540e+00, -1.35942933e+00,-1.35241916e+00, -1.34499702e+00, -1.33716519e+00, -1.32892605e+00,-1.32028210e+00, -1.31123598e+00, -1.30179045e+00, -1.29194838e+00,-1.28171276e+00, -1.27108673e+00, -1.26007351e+00, -1.24867646e+00,-1.23689905e+00, -1.22474487e+00, -1.21221762e+00, -1.19932112e+00,-1.18605929e+00, -1.17243618e+00, -1.15845593e+00, -1.14412281e+00,-1.12944117e+00, -1.11441550e+00, -1.09905036e+00, -1.08335044e+00,-1.06732052e+00, -1.05096549e+00, -1.03429032e+00, -1.01730010e+00],
-        [1.00000000e+00, 1.01730010e+00, 1.03429032e+00, 1.05096549e+00,1.06732052e+00, 1.08335044e+00, 1.09905036e+00, 1.11441550e+00,1.12944117e+00, 1.14412281e+00, 1.15845593e+00, 1.17243618e+00,1.18605929e+00, 1.19932112e+00, 1.21221762e+00, 1.22474487e+00,1.23689905e+00, 1.24867646e+00, 1.26007351e+00, 1.27108673e+00,1.28171276e+00, 1.29194838e+00, 1.30179045e+00, 1.31123598e+00,1.32028210e+00, 1.32892605e+00, 1.33716519e+00, 1.34499702e+00,1.35241916e+00, 1.35942933e+00, 1.36602540e+00, 1.37220538e+00,1.37796736e+00, 1.38330960e+00, 1.38823048e+00, 1.39272848e+00,1.39680225e+00, 1.40045053e+00, 1.40367223e+00, 1.40646635e+00,1.40883205e+00, 1.41076861e+00, 1.41227543e+00, 1.41335206e+00,1.41399817e+00, 1.41421356e+00, 1.41399817e+00, 1.41335206e+00,1.41227543e+00, 1.41076861e+00, 1.40883205e+00, 1.40646635e+00,1.40367223e+00, 1.40045053e+00, 1.39680225e+00, 1.39272848e+00,1.38823048e+00, 1.38330960e+00, 1.37796736e+00, 1.37220538e+00,1.36602540e+00, 1.35942933e+00, 1.35241916e+00, 1.34499702e+00,1.33716519e+00, 1.32892605e+00, 1.32028210e+00, 1.31123598e+00,1.30179045e+00, 1.29194838e+00, 1.28171276e+00, 1.27108673e+00,1.26007351e+00, 1.24867646e+00, 1.23689905e+00, 1.22474487e+00,1.21221762e+00, 1.19932112e+00, 1.18605929e+00, 1.17243618e+00,1.15845593e+00, 1.14412281e+00, 1.12944117e+00, 1.11441550e+00,1.09905036e+00, 1.08335044e+00, 1.06732052e+00, 1.05096549e+00,1.03429032e+00, 1.01730010e+00, 1.00000000e+00, 9.82395289e-01,9.64491330e-01, 9.46293579e-01, 9.27807577e-01, 9.09038955e-01,8.89993432e-01, 8.70676808e-01, 8.51094968e-01, 8.31253876e-01,8.11159575e-01, 7.90818188e-01, 7.70235910e-01, 7.49419010e-01,7.28373831e-01, 7.07106781e-01, 6.85624340e-01, 6.63933051e-01,6.42039522e-01, 6.19950421e-01, 5.97672477e-01, 5.75212477e-01,5.52577261e-01, 5.29773725e-01, 5.06808815e-01, 4.83689525e-01,4.60422900e-01, 4.37016024e-01, 4.13476030e-01, 3.89810087e-01,3.66025404e-01, 3.42129226e-01, 3.18128832e-01, 2.94031533e-01,2.69844669e-01, 2.45575608e-01, 2.21231742e-01, 1.96820487e-01,1.72349278e-01, 1.47825570e-01, 1.23256833e-01, 9.86505512e-02,7.40142191e-02, 4.93553416e-02, 2.46814299e-02, 1.11022302e-16,-2.46814299e-02, -4.93553416e-02, -7.40142191e-02, -9.86505512e-02,-1.23256833e-01, -1.47825570e-01, -1.72349278e-01, -1.96820487e-01,-2.21231742e-01, -2.45575608e-01, -2.69844669e-01, -2.94031533e-01,-3.18128832e-01, -3.42129226e-01, -3.66025404e-01, -3.89810087e-01,-4.13476030e-01, -4.37016024e-01, -4.60422900e-01, -4.83689525e-01,-5.06808815e-01, -5.29773725e-01, -5.52577261e-01, -5.75212477e-01,-5.97672477e-01, -6.19950421e-01, -6.42039522e-01, -6.63933051e-01,-6.85624340e-01, -7.07106781e-01, -7.28373831e-01, -7.49419010e-01,-7.70235910e-01, -7.90818188e-01, -8.11159575e-01, -8.31253876e-01,-8.51094968e-01, -8.70676808e-01, -8.89993432e-01, -9.09038955e-01,-9.27807577e-01, -9.46293579e-01, -9.64491330e-01, -9.82395289e-01,-1.00000000e+00, -1.01730010e+00, -1.03429032e+00, -1.05096549e+00,-1.06732052e+00, -1.08335044e+00, -1.09905036e+00, -1.11441550e+00,-1.12944117e+00, -1.14412281e+00, -1.15845593e+00, -1.17243618e+00,-1.18605929e+00, -1.19932112e+00, -1.21221762e+00, -1.22474487e+00,-1.23689905e+00, -1.24867646e+00, -1.26007351e+00, -1.27108673e+00,-1.28171276e+00, -1.29194838e+00, -1.30179045e+00, -1.31123598e+00,-1.32028210e+00, -1.32892605e+00, -1.33716519e+00, -1.34499702e+00,-1.35241916e+00, -1.35942933e+00, -1.36602540e+00, -1.37220538e+00,-1.37796736e+00, -1.38330960e+00, -1.38823048e+00, -1.39272848e+00,-1.39680225e+00, -1.40045053e+00, -1.40367223e+00, -1.40646635e+00,-1.40883205e+00, -1.41076861e+00, -1.41227543e+00, -1.41335206e+00,-1.41399817e+00, -1.41421356e+00, -1.41399817e+00, -1.41335206e+00,-1.41227543e+00, -1.41076861e+00, -1.40883205e+00, -1.40646635e+00,-1.40367223e+00, -1.40045053e+00, -1.39680225e+00, -1.39272848e+00,-1.38823048e+00, -1.38330960e+00, -1.37796736e+00, -1.37220538e+00,-1.36602540e+00, -1.35942933e+00, -1.35241916e+00, -1.34499702e+00,-1.33716519e+00, -1.32892605e+00, -1.32028210e+00, -1.31123598e+00,-1.30179045e+00, -1.29194838e+00, -1.28171276e+00, -1.27108673e+00,-1.26007351e+00, -1.24867646e+00, -1.23689905e+00, -1.22474487e+00,-1.21221762e+00, -1.19932112e+00, -1.18605929e+00, -1.17243618e+00,-1.15845593e+00, -1.14412281e+00, -1.12944117e+00, -1.11441550e+00,-1.09905036e+00, -1.08335044e+00, -1.06732052e+00, -1.05096549e+00,-1.03429032e+00, -1.01730010e+00, -1.00000000e+00, -9.82395289e-01,-9.64491330e-01, -9.46293579e-01, -9.27807577e-01, -9.09038955e-01,-8.89993432e-01, -8.70676808e-01, -8.51094968e-01, -8.31253876e-01,-8.11159575e-01, -7.90818188e-01, -7.70235910e-01, -7.49419010e-01,-7.28373831e-01, -7.07106781e-01, -6.85624340e-01, -6.63933051e-01,-6.42039522e-01, -6.19950421e-01, -5.97672477e-01, -5.75212477e-01,-5.52577261e-01, -5.29773725e-01, -5.06808815e-01, -4.83689525e-01,-4.60422900e-01, -4.37016024e-01, -4.13476030e-01, -3.89810087e-01,-3.66025404e-01, -3.42129226e-01, -3.18128832e-01, -2.94031533e-01,-2.69844669e-01, -2.45575608e-01, -2.21231742e-01, -1.96820487e-01,-1.72349278e-01, -1.47825570e-01, -1.23256833e-01, -9.86505512e-02,-7.40142191e-02, -4.93553416e-02, -2.46814299e-02, -3.33066907e-16,2.46814299e-02, 4.93553416e-02, 7.40142191e-02, 9.86505512e-02,1.23256833e-01, 1.47825570e-01, 1.72349278e-01, 1.96820487e-01,2.21231742e-01, 2.45575608e-01, 2.69844669e-01, 2.94031533e-01,3.18128832e-01, 3.42129226e-01, 3.66025404e-01, 3.89810087e-01,4.13476030e-01, 4.37016024e-01, 4.60422900e-01, 4.83689525e-01,5.06808815e-01, 5.29773725e-01, 5.52577261e-01, 5.75212477e-01,5.97672477e-01, 6.19950421e-01, 6.42039522e-01, 6.63933051e-01,6.85624340e-01, 7.07106781e-01, 7.28373831e-01, 7.49419010e-01,7.70235910e-01, 7.90818188e-01, 8.11159575e-01, 8.31253876e-01,8.51094968e-01, 8.70676808e-01, 8.89993432e-01, 9.09038955e-01,9.27807577e-01, 9.46293579e-01, 9.64491330e-01, 9.82395289e-01]
-    ])
-    tt2 = tt2/ss
-    tt2 = np.row_stack((tt2, -tt2))
-    term2 = ss*(1-tt2+tt2**2)
-
-    #term2 = []
-    #for t2_item in tt2:
-    #    term2.append(ss * (1 - t2_item + t2_item ** 2))
+    # constants are precomputed at import for faster operation, see PRASAD_COEFS.
+    # ss can be a scalar or an array of segment lengths, which are evaluated all at once.
+    ss_arr = np.asarray(ss, dtype=np.float64)
+    inv_s = 1. / ss_arr.reshape(-1, 1)
 
-    #case_value = []
-    #for c_i in range(8):
-    #    case_value.append((1/ ss ** 2) * term1[c_i%4,:] * term2[c_i])
+    case_value = (inv_s * PRASAD_COEFS[0] +
+                  inv_s**2 * PRASAD_COEFS[1] +
+                  inv_s**3 * PRASAD_COEFS[2])
+    case_max = np.max(case_value, axis=1)
 
-    case_value = (1 / ss ** 2) * term1 * term2
-
-    return np.max(case_value)
+    if ss_arr.ndim == 0:
+        return case_max[0]
+    else:
+        return case_max.reshape(ss_arr.shape)
 
 
 from numpy import where, dstack, diff, meshgrid
@@ -985,7 +1633,7 @@ def measure_affinity(edges_xy, grads):
     # want edges that point at each other
 
     # get direction of edge points from line segments
-    segs = [prasad_lines(e) for e in edges_xy]
+    segs = prasad_lines_batch(edges_xy)
 
     # 3d array of the edge points and the neighboring segment vertex
     edge_segs = np.row_stack([((e[0], e[1]), (e[-1], e[-2])) for e in segs])
@@ -4,13 +4,19 @@ np.seterr(invalid='ignore')
 import cv2
 from skimage import draw
 from itertools import count
+from collections import deque
 import argparse
 import Tkinter as tk, tkFileDialog
 import os
 from datetime import datetime
 import json
+import warnings
 from tqdm import trange, tqdm
 import multiprocessing as mp
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
 import pandas as pd
 
 import imops
@@ -22,52 +28,179 @@ import workers
 
 ##################################
 
-def run_mp(file, params, data_dir, n_proc=7):
+def run_mp(file, params, data_dir, n_proc=7, n_slots=None, resume=False, checkpoint_every=1000):
+    # resume: pick up from the frames already saved for this video, if they were made with the same params
+    # checkpoint_every: how many frames to collect before writing them to disk
+    # frames are handed out to whichever worker is free, so they can't be tracked (params['track'])
+    if params.get('track'):
+        warnings.warn("run_mp processes frames independently and ignores params['track'], use run_batch to track")
     vid = cv2.VideoCapture(file)
     total_frames = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
 
-    # Create queues
-    task_queue = mp.Queue()
+    # results are written to disk as they come in
+    vid_name = os.path.basename(file).rsplit('.', 1)[0]
+    sink = runops.EllipseSink(os.path.join(data_dir, "Ellall_" + vid_name),
+                              chunk_frames=checkpoint_every, resume=resume, params=params)
+
+    # seek to the first frame we don't have yet
+    start_frame = runops.first_unprocessed(sink.done_frames)
+    if start_frame > total_frames:
+        return
+    workers.seek(vid, start_frame)
+
+    # frames are passed to workers through a ring of shared memory slots,
+    # params are sent once when the workers start
+    if n_slots is None:
+        n_slots = n_proc*4
+    ring = workers.FrameRing(n_slots, params['shape'])
     done_queue = mp.Queue()
 
     # start processes
     procs = []
     for i in range(n_proc):
-        procs.append(mp.Process(target=workers.frame_worker2, args=(task_queue, done_queue, params, i+1)))
+        procs.append(mp.Process(target=workers.ring_worker, args=(ring, done_queue, params)))
         procs[-1].start()
 
-    # and the grabber
-    #grabber = mp.Process(target=workers.result_grabber, args=(done_queue,))
-    #grabber.start()
-
-    for i in trange(total_frames, position=0):
+    n_done = 0
+    n_sent = 0
+    for i in trange(start_frame-1, total_frames, position=0):
         ret, frame = vid.read()
+        if ret == False:
+            break
+
+        n_frame = vid.get(cv2.CAP_PROP_POS_FRAMES)
+        # frames after a gap might be done already
+        if n_frame in sink.done_frames:
+            continue
+
         frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         frame = imops.crop(frame, params['roi'])
 
-        n_frame = vid.get(cv2.CAP_PROP_POS_FRAMES)
+        # blocks until a slot is free
+        ring.put(frame, n_frame)
+        n_sent += 1
 
-        #task_queue.put((frame, n_frame), block=True, timeout=60)
-        task_queue.put((frame, n_frame), block=False)
-        # try:
-        #     results.append(done_queue.get())
-        # except:
-        #     pass
-        # if i%100==0:
-        #     print(len(results))
+        # grab any finished results so they don't pile up in the queue
+        while not done_queue.empty():
+            sink.append(*done_queue.get())
+            n_done += 1
 
-    results = []
-    for i in range(n_proc):
-        results.append(done_queue.get())
+    ring.stop(n_proc)
+
+    while n_done < n_sent:
+        sink.append(*done_queue.get())
+        n_done += 1
+
+    for p in procs:
+        p.join()
+
+    sink.close()
+
+
+def run_sharded(file, params, data_dir, n_proc=7, n_shards=None, resume=False, checkpoint_every=1000):
+    # every worker opens its own capture and decodes + processes whole ranges of frames,
+    # so the parent only collects results.
+    # n_shards: how many frame ranges to split the video into, more balances load better,
+    #   fewer means less seeking. defaults to a few per process.
+    if n_shards is None:
+        n_shards = n_proc*4
+    run_batch([file], params, data_dir, n_proc=n_proc, n_shards=n_shards,
+              resume=resume, checkpoint_every=checkpoint_every)
+
+
+def run_batch(files, params, data_dir, n_proc=7, n_shards=None, shard_frames=2000,
+              resume=False, checkpoint_every=1000, timeout=60):
+    # process many videos at once: the frame ranges of every video go into one queue,
+    # so workers move on to the next video instead of idling while one finishes.
+    # each video's results are written out and closed as soon as all of its ranges are done.
+    # n_shards: split each video into this many ranges, or if None,
+    # shard_frames: split each video into ranges of this many frames
+    # resume: skip the frames already saved for each video, if they were made with the same params
+    # timeout: seconds to wait for a result before checking whether the workers are still alive
+    task_queue = mp.Queue()
+    done_queue = mp.Queue()
+
+    # queue videos in order so they finish roughly in order
+    sinks = {}
+    n_left = {}
+    n_frames = 0
+    for fn in files:
+        vid = cv2.VideoCapture(fn)
+        total_frames = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+        vid.release()
 
+        vid_name = os.path.basename(fn).rsplit('.', 1)[0]
+        sink = runops.EllipseSink(os.path.join(data_dir, "Ellall_" + vid_name),
+                                  chunk_frames=checkpoint_every, resume=resume, params=params)
 
+        if n_shards is not None:
+            ranges = runops.frame_ranges(total_frames, n_shards, sink.done_frames)
+        else:
+            ranges = runops.frame_ranges(total_frames, done_frames=sink.done_frames,
+                                         range_frames=shard_frames)
+        if len(ranges) == 0:
+            continue
 
+        for start, stop in ranges:
+            task_queue.put((fn, start, stop))
+            n_frames += stop-start
+        sinks[fn] = sink
+        n_left[fn] = len(ranges)
 
+    if len(sinks) == 0:
+        return
 
-def run(files, params, data_dir):
-    thetas = np.linspace(0, np.pi * 2, num=200, endpoint=False)
+    # no point starting more workers than there are ranges
+    n_workers = min(n_proc, sum(n_left.values()))
+    for i in range(n_workers):
+        task_queue.put('END')
+
+    procs = []
+    for i in range(n_workers):
+        procs.append(mp.Process(target=workers.shard_worker, args=(task_queue, done_queue, params)))
+        procs[-1].start()
+
+    # results come back in whatever order the shards get to them,
+    # the sink keeps their frame numbers so they're put back in order when loaded
+    pbar = tqdm(total=n_frames, position=0)
+    while len(sinks) > 0:
+        try:
+            fn, n_frame, result = done_queue.get(timeout=timeout)
+        except Empty:
+            # workers always finish their ranges, so if one died (or they all quit early)
+            # some of them never will. keep what we have, resuming will pick up the rest
+            if any(p.exitcode for p in procs) or not any(p.is_alive() for p in procs):
+                for sink in sinks.values():
+                    sink.close()
+                for p in procs:
+                    p.terminate()
+                pbar.close()
+                raise RuntimeError("Shard workers died with ranges left unfinished in {}".format(list(sinks.keys())))
+            continue
+        if n_frame is None:
+            n_left[fn] -= 1
+            if n_left[fn] == 0:
+                sinks.pop(fn).close()
+            continue
+        sinks[fn].append(n_frame, result)
+        pbar.update()
+    pbar.close()
+
+    for p in procs:
+        p.join()
+
+
+def run(files, params, data_dir, n_proc=8, max_pending=32, resume=False, checkpoint_every=1000):
+    # n_proc: how many processes in the pool
+    # max_pending: how many frames can be submitted to the pool before we have to wait for
+    # results to come back. with results streamed to disk, keeps memory constant regardless of video length
+    # resume: pick up from the frames already saved for each video, if they were made with the same params
+    # checkpoint_every: how many frames to collect before writing them to disk
+    # frames are processed independently by a pool, so they can't be tracked (params['track'])
+    if params.get('track'):
+        warnings.warn("run processes frames independently and ignores params['track'], use run_batch to track")
     # loop through videos...
-    pool = mp.Pool(8)
+    pool = mp.Pool(n_proc)
 
     for fn in tqdm(files, total=len(files), position=0):
 
@@ -88,8 +221,21 @@ def run(files, params, data_dir):
         # c_list = [] # coverage - n_points/perimeter
         # g_list = [] # gradient magnitude of edge points
 
-        results = []
-        for i in trange(total_frames, position=1):
+        # results are written to disk as they come in
+        vid_name = os.path.basename(fn).rsplit('.', 1)[0]
+        sink = runops.EllipseSink(os.path.join(data_dir, "Ellall_" + vid_name),
+                                  chunk_frames=checkpoint_every, resume=resume, params=params)
+
+        # seek to the first frame we don't have yet
+        start_frame = runops.first_unprocessed(sink.done_frames)
+        if start_frame > total_frames:
+            continue
+        workers.seek(vid, start_frame)
+
+        # (frame number, result) for frames in flight, oldest first
+        pending = deque()
+        pbar = tqdm(total=total_frames, initial=start_frame-1, position=2)
+        for i in trange(start_frame-1, total_frames, position=1):
             ret, frame = vid.read()
             if ret == False:
                 # ret aka "if return == true"
@@ -99,12 +245,28 @@ def run(files, params, data_dir):
                 # we got ta take a
                 break
 
+            n_frame = vid.get(cv2.CAP_PROP_POS_FRAMES)
+            # frames after a gap might be done already
+            if n_frame in sink.done_frames:
+                pbar.update()
+                continue
+
             frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
             frame = imops.crop(frame, params['roi'])
 
-            n_frame = vid.get(cv2.CAP_PROP_POS_FRAMES)
+            # if the workers are behind, wait for the oldest frame before decoding any more
+            if len(pending) >= max_pending:
+                n_done, result = pending.popleft()
+                sink.append(n_done, result.get())
+                pbar.update()
 
-            results.append(pool.apply_async(runops.process_frame_all, args=(frame, params, n_frame)))
+            pending.append((n_frame, pool.apply_async(runops.process_frame_all, args=(frame, params, n_frame))))
+
+            # and grab any others that are done, in order
+            while len(pending) > 0 and pending[0][1].ready():
+                n_done, result = pending.popleft()
+                sink.append(n_done, result.get())
+                pbar.update()
 
             #
             # # Chew up a frame, return a list of ellipses
@@ -151,20 +313,14 @@ def run(files, params, data_dir):
             #     e_points[:, 1] = np.clip(e_points[:,1], 0, frame_preproc.shape[1]-1)
             #     g_list.append(np.mean(edge_mag[e_points[:,0], e_points[:,1]]))
 
-        got_results = []
-        for r in tqdm(results, total=total_frames, position=2):
-            got_results.append(r.get())
-
-        flat_results = got_results[0]
-        for i in got_results[1:]:
-            for k, v in i.items():
-                flat_results[k].extend(v)
+        while len(pending) > 0:
+            n_done, result = pending.popleft()
+            sink.append(n_done, result.get())
+            pbar.update()
+        pbar.close()
 
+        sink.close()
 
-        df = pd.DataFrame.from_dict(flat_results)
-        vid_name = os.path.basename(fn).rsplit('.', 1)[0]
-        save_fn = os.path.join(data_dir, "Ellall_" + vid_name + ".csv")
-        df.to_csv(save_fn)
         # clean and combine parameter lists
         # ell_df = fitutils.clean_lists(x_list, y_list, a_list, b_list, t_list, v_list, n_list, c_list, g_list)
         # # remove extremely bad ellipses
@@ -192,9 +348,13 @@ if __name__ == "__main__":
     pars = argparse.ArgumentParser()
     pars.add_argument("--dir", help="Base directory for output & params")
     pars.add_argument("--vdir", help="Base directory for videos")
-    pars.add_argument("--n_procs", help="Number of processes to spawn")
+    pars.add_argument("--n_procs", help="Number of processes to spawn, defaults to one per cpu")
     pars.add_argument("--params", help="Prespecify a .json parameter set")
     pars.add_argument("--gray", help="Videos are grayscale (y/n)")
+    pars.add_argument("--batch", help="Split the videos into frame ranges and process them all at once "
+                                      "with n_procs processes (y/n)")
+    pars.add_argument("--resume", help="Skip the frames already saved for each video, "
+                                       "if they were processed with the same params (y/n)")
 
     # then parse em
     args = pars.parse_args()
@@ -211,16 +371,22 @@ if __name__ == "__main__":
     else:
         vdir = base_dir
 
+    # batch mode
+    batch = bool(args.batch) and args.batch.lower() == "y"
+
+    # pick up where a previous run left off
+    resume = bool(args.resume) and args.resume.lower() == "y"
+
     # number of processes
     if args.n_procs:
         try:
             n_procs = int(args.n_procs)
 
-        except TypeError:
+        except (TypeError, ValueError):
             SyntaxWarning("n_procs must be an integer, resorting to 1")
             n_procs = 1
     else:
-        n_procs = 1
+        n_procs = mp.cpu_count()
 
     # params file
     if args.params:
@@ -322,7 +488,10 @@ if __name__ == "__main__":
     #######################################
     # do the rest
     # https://stackoverflow.com/a/11241708
-    run(files, params, data_dir)
+    if batch:
+        run_batch(files, params, data_dir, n_proc=n_procs, resume=resume)
+    else:
+        run(files, params, data_dir, n_proc=n_procs, resume=resume)
 
 
 
@@ -3,9 +3,11 @@ import cv2
 from scipy.spatial.distance import euclidean
 from skimage import filters, exposure, feature, morphology, measure, img_as_float, segmentation
 from collections import deque
-from pandas import ewma, ewmstd, Series
+from pandas import ewma, ewmstd
 from itertools import count, islice
 
+import imops
+
 
 class Pupil_Model(object):
 
@@ -30,13 +32,15 @@ class Pupil_Model(object):
         # lists of deque to store the parameter history
         self.st_params = [deque(maxlen=st_memory) for i in range(5)]
         self.lt_params = [deque(maxlen=st_memory) for i in range(5)]
+        # and exponentially weighted stats of the st params, updated as they're stashed
+        self.st_stats = [EW_Stats(halflife=10) for i in range(5)]
 
         # store the longest axis - aka the pupil diameter
         self.pupil_diam = []
 
         # store the number of points & residuals we get from edge detection to estimate frame quality
-        self.n_points = deque(maxlen=st_memory)
-        self.resids   = deque(maxlen=st_memory)
+        self.n_points = mean_dq(maxlen=st_memory)
+        self.resids   = mean_dq(maxlen=st_memory)
         self.obl      = deque(maxlen=st_memory)
 
         # store the standard deviation used to include/exclude points
@@ -67,14 +71,17 @@ class Pupil_Model(object):
 
         self.f_points = None
 
-    def update(self, points, frame):
+    def update(self, points, frame, offset=(0, 0), shape=None):
         # update the model using detected edges from the the most recent frame
-        self.n_frames = self.frame_counter.next()
+        # returns whether the model could be updated from this frame's points
+        # points can also be the edges of just a window of the frame, whose top left corner is
+        # at offset (row, col) in a frame of size shape, see filter_points
+        self.n_frames = next(self.frame_counter)
 
         # filter points
-        ret, f_points, mean_resid = self.filter_points(points)
+        ret, f_points, mean_resid = self.filter_points(points, offset=offset, shape=shape)
         if not ret:
-            return
+            return False
 
         #save f_points for plotting outside us
         self.f_points = f_points
@@ -83,7 +90,7 @@ class Pupil_Model(object):
         ret = self.st_model.estimate(f_points)
         if not ret:
             self.failed_frames.append(self.n_frames)
-            return
+            return False
 
         # pull out params
         st_params = self.st_model.params
@@ -98,13 +105,13 @@ class Pupil_Model(object):
 
         # get quality metrics, n points, param changes, oblongity
         self.n_points.append(f_points.shape[0])
-        point_mult = np.clip(float(f_points.shape[0])/np.mean(self.n_points), 0, 1)
+        point_mult = np.clip(float(f_points.shape[0])/self.n_points.mean(), 0, 1)
         #self.point_mult.append(point_mult)
 
         # residuals
         self.resids.append(mean_resid)
         if mean_resid > 0: # avoid divide by zero error
-            residual_mult = np.clip(np.mean(self.resids)/mean_resid, 0,1)
+            residual_mult = np.clip(self.resids.mean()/mean_resid, 0,1)
         else:
             residual_mult = 0.
 
@@ -162,79 +169,90 @@ class Pupil_Model(object):
         #if self.stdev > 20:
         #    self.backtrack_model()
 
-    def filter_points(self, points):
-        # first remove any distractions
+        return True
+
+    def filter_points(self, points, offset=(0, 0), shape=None):
+        # points: binary edge image, which gets the distracting points removed.
+        # if points is only a window of the frame, offset is the (row, col) of its top left corner
+        # and shape the size of the whole frame (the limits on the ellipse are relative to it),
+        # so only the window has to be searched and labeled.
+        # returns (ok, filtered (x, y) points in frame coordinates, mean squared residual to the model)
+        if shape is None:
+            shape = points.shape
+        offset_xy = np.array([offset[1], offset[0]])
+
+        # first remove any distractions.
+        # this is the only time we look through the whole image for points,
+        # every component is pulled out of these at once below
         edges_xy = self.convert_edges_xy(points)
-        resids = self.model.residuals(edges_xy)
-        edges_xy = edges_xy[resids>np.max(self.model.params[2:4])/2.,:]
-        points[edges_xy[:,1], edges_xy[:,0]] = 0
+        resids = ellipse_residuals(self.model.params, edges_xy + offset_xy)
+        far = resids>np.max(self.model.params[2:4])/2.
+        points[edges_xy[far,1], edges_xy[far,0]] = 0
+        edges_xy = edges_xy[~far,:] + offset_xy
 
-        labeled_edges = morphology.label(points)
-        uq_edges = np.unique(labeled_edges)[1:]
+        labeled_edges, n_labels = morphology.label(points, return_num=True)
 
         # if we only have one, just get on with it
-        if len(uq_edges) != 1:
-            # fit ellipses for all of em
+        if n_labels != 1:
+            # (x, y) points of every component at once.
+            # components with fewer than 5 points can't be fit, so don't bother pulling them out.
+            # (that's the only screen before fitting: the checks below are on the fit, and a component's
+            # points don't have to lie on its fit, so its size or position doesn't rule a good fit out.
+            # points far from the predicted ellipse, most eyelashes and reflections, are already gone,
+            # and the rest are fit all at once, so a screen wouldn't save much)
+            components = [e[:, ::-1] + offset_xy
+                          for e in imops.labeled2xy(labeled_edges, small_thresh=4, order=False)]
 
             m_params = self.model.params
+            im_major = np.max(shape)
+            im_minor = np.min(shape)
+
+            # fit ellipses for all of em
+            fit_params, fit_ok = imops.fit_ellipses(components)
+
+            # pull out some params
+            major_ax = np.max(fit_params[:, 2:4], axis=1)
+            minor_ax = np.min(fit_params[:, 2:4], axis=1)
+
+            # check that we're not all weird
+            # shouldn't travel more than 1/8 the image in a single frame...
+            dist = np.hypot(fit_params[:, 0]-m_params[0], fit_params[:, 1]-m_params[1])
+            fit_ok &= ~(dist>(im_major/5))
+
+            # or be huge or tiny
+            fit_ok &= ~((major_ax>im_major*.75) | (major_ax<im_minor/20))
+
+            # or be really oblong
+            fit_ok &= ~(major_ax < minor_ax*.6)
+
             last_best_ellipse = None
             last_best_resid = np.inf
-            for e in uq_edges:
-                ellipse_model = measure.EllipseModel()
-                edges_xy = self.convert_edges_xy(labeled_edges, e)
-                ret = ellipse_model.estimate(edges_xy)
-                if not ret:
-                    continue
-
-                # pull out some params
-                major_ax = np.max(ellipse_model.params[2:4])
-                minor_ax = np.min(ellipse_model.params[2:4])
-                im_major = np.max(points.shape)
-                im_minor = np.min(points.shape)
-
-                # check that we're not all weird
-                # shouldn't travel more than 1/8 the image in a single frame...
-                dist = euclidean(ellipse_model.params[0:2], m_params[0:2])
-                if dist>(im_major/5):
-                    continue
-
-                # or be huge or tiny
-                if major_ax>im_major*.75 or major_ax<im_minor/20:
-                    continue
-
-                # or be really oblong
-                if major_ax/minor_ax < .6:
-                    continue
-
+            for e in np.flatnonzero(fit_ok):
                 # calc distance from initial and last
-                mod_resids = np.mean(self.model.residuals(edges_xy)**2)
-                init_resids = np.mean(self.initial_model.residuals(edges_xy)**2)
+                mod_resids = np.mean(ellipse_residuals(m_params, components[e])**2)
+                init_resids = np.mean(ellipse_residuals(self.initial_model.params, components[e])**2)
                 #print(mod_resids)
                 #print(init_resids)
                 mean_resid = np.mean((mod_resids, mod_resids, init_resids))
 
                 if mean_resid < last_best_resid:
                     last_best_resid = mean_resid
-                    last_best_ellipse = ellipse_model
+                    last_best_ellipse = fit_params[e]
 
 
             # keep only points that made good ellipses
             #labeled_edges = np.isin(labeled_edges, good_ellipses)
             # catch any points that were unconnected but are in our ellipse
-            if not last_best_ellipse:
+            if last_best_ellipse is None:
                 return False, False, False
 
-            edges_xy = self.convert_edges_xy(points)
-            resids = last_best_ellipse.residuals(edges_xy)
-            major_ax = np.max(last_best_ellipse.params[2:4])
+            resids = ellipse_residuals(last_best_ellipse, edges_xy)
+            major_ax = np.max(last_best_ellipse[2:4])
             edges_xy = edges_xy[resids<(major_ax/10.),:]
 
-        else:
-            edges_xy = self.convert_edges_xy(labeled_edges)
-
         # now keep only points within certain distance of model
 
-        resids = self.model.residuals(edges_xy)
+        resids = ellipse_residuals(self.model.params, edges_xy)
 
         # greater than 1sd+mean
         #resids_std = np.mean(resids)+np.std(resids)
@@ -280,9 +298,17 @@ class Pupil_Model(object):
 
 
 
+    def reseed(self, params):
+        # restart the model from new (x, y, a, b, t) params, eg. when the pupil is found again
+        # after losing it. they're also the new initial params the fits are checked against
+        params = tuple(float(p) for p in params)
+        self.initial_params = params
+        self.initial_model.params = params
+        self.model.params = params
+        self.st_model.params = params
+
     def filter_points_old(self, points):
         # find only those points that are within a standard deviation of our model
-        # with respect to https://stackoverflow.com/questions/37031356/check-if-points-are-inside-ellipse-faster-than-contains-point-method
 
         # get model params handy
         x, y, a, b, t = self.model.params
@@ -292,22 +318,8 @@ class Pupil_Model(object):
         min_r = np.max([(a-self.stdev)/a, (b-self.stdev)/b])
         max_r = np.min([(a+self.stdev)/a, (b+self.stdev)/b])
 
-        # split points into x and y coords
-        pts_x, pts_y = points[:,0], points[:,1]
-
-        cos_e = np.cos(t)
-        sin_e = np.sin(t)
-
-        # get distance from center of ellipse
-        dist_x = pts_x - x
-        dist_y = pts_y - y
-
-        # transform so that coordinates aligned w/ major/minor ax
-        tf_x = dist_x*cos_e - dist_y*sin_e
-        tf_y = dist_x*sin_e + dist_y*cos_e
-
         # get normalized distance from center
-        norm_dist = (tf_x**2/a**2) + (tf_y**2/b**2)
+        norm_dist = normalized_radius(self.model.params, points)
 
         # get the points in error margin
         good_pts = np.logical_and(norm_dist > min_r, norm_dist < max_r)
@@ -319,7 +331,7 @@ class Pupil_Model(object):
         # for now let's try to use 125% of the mean points for no particular reason
         # so if we get a particularly bad frame, we use more points from the previous model
 
-        mean_pts = np.mean(self.n_points)
+        mean_pts = self.n_points.mean()
 
         model_pts = (1.-self.n_points[-1]/mean_pts) * mean_pts
 
@@ -364,21 +376,23 @@ class Pupil_Model(object):
 
         # if we have hit our lt ratio, update the lt deque
         if self.n_frames % self.lt_ratio == 0 and self.n_frames > 0:
-            for param, st_dq, lt_dq in zip(params, self.st_params, self.lt_params):
+            for param, st_dq, lt_dq, st_stat in zip(params, self.st_params, self.lt_params, self.st_stats):
                 st_dq.append(param)
+                st_stat.append(param)
                 # append the mean of the last (lt_ratio) param entries
                 lt_dq.append(np.mean(list(st_dq)[-self.lt_ratio:]))
 
         # otherwise we just save this round
         else:
-            for param, st_dq in zip(params, self.st_params):
+            for param, st_dq, st_stat in zip(params, self.st_params, self.st_stats):
                 st_dq.append(param)
+                st_stat.append(param)
 
     def check_quality(self, filtered_pts):
         # more points, lower residuals are a better estimate
-        point_prop = 1./(float(self.n_points[-1])/np.mean(self.n_points))
-        self.resids.append(np.mean(self.model.residuals(filtered_pts)**2))
-        resid_prop = float(self.resids[-1])/np.mean(self.resids)
+        point_prop = 1./(float(self.n_points[-1])/self.n_points.mean())
+        self.resids.append(np.mean(ellipse_residuals(self.model.params, filtered_pts)**2))
+        resid_prop = float(self.resids[-1])/self.resids.mean()
 
         quality_prop = point_prop * resid_prop
         # make this number closer to one to have less influence...
@@ -395,7 +409,7 @@ class Pupil_Model(object):
             param_std = self.initial_params[2]/4.
         else:
             # exponentially weighted stdev of all params except theta
-            param_stds = [Series(param).ewm(halflife=10).std().iloc[-1] for param in self.st_params[0:4]]
+            param_stds = [stat.std() for stat in self.st_stats[0:4]]
             param_std = np.mean(param_stds)
 
         # take ratio of this and last std
@@ -403,9 +417,9 @@ class Pupil_Model(object):
 
         # adjust the std by the quality of our estimate
         # more points, lower residuals are a better estimate
-        point_prop = 1./(float(self.n_points[-1])/np.mean(self.n_points))
-        self.resids.append(np.mean(self.model.residuals(filtered_pts)**2))
-        resid_prop = float(self.resids[-1])/np.mean(self.resids)
+        point_prop = 1./(float(self.n_points[-1])/self.n_points.mean())
+        self.resids.append(np.mean(ellipse_residuals(self.model.params, filtered_pts)**2))
+        resid_prop = float(self.resids[-1])/self.resids.mean()
 
         quality_prop = np.mean([point_prop, resid_prop])
         # make this number closer to one to have less influence...
@@ -430,6 +444,156 @@ class Pupil_Model(object):
         else:
             return points[:,0], points[:,1]
 
+def flip_params(params):
+    # swap ellipse params between the model's (x, y) = (col, row) coordinates (see convert_edges_xy)
+    # and the (row, col) coordinates the rest of the pipeline fits ellipses in.
+    # mirroring across the diagonal keeps the axes but turns theta into pi/2 - theta
+    x, y, a, b, t = params
+    return (y, x, a, b, np.pi/2. - t)
+
+
+def normalized_radius(params, points, return_axes=False):
+    # radius of (x, y) points in units of the ellipse, ie. after rotating into the ellipse's axes
+    # and scaling them to 1: 1 is on the ellipse, <1 inside, >1 outside.
+    # with respect to https://stackoverflow.com/questions/37031356/check-if-points-are-inside-ellipse-faster-than-contains-point-method
+    x, y, a, b, t = params
+    cos_e = np.cos(t)
+    sin_e = np.sin(t)
+
+    # get distance from center of ellipse
+    dist_x = points[:,0] - x
+    dist_y = points[:,1] - y
+
+    # transform so that coordinates aligned w/ major/minor ax (same rotation as EllipseModel)
+    tf_x = dist_x*cos_e + dist_y*sin_e
+    tf_y = dist_y*cos_e - dist_x*sin_e
+
+    norm_rad = np.sqrt((tf_x/a)**2 + (tf_y/b)**2)
+
+    if return_axes:
+        return norm_rad, tf_x, tf_y
+    return norm_rad
+
+
+def ellipse_residuals(params, points):
+    # approximate distance of (x, y) points to an ellipse, a drop-in for EllipseModel.residuals,
+    # which solves for the closest point on the ellipse separately for every point.
+    # this is the Sampson (first order) distance of the normalized radius: |r-1|/|grad r|,
+    # exact for circles and within a few % of the true distance near the ellipse for pupil-ish ellipses.
+    # (the Sampson distance of the usual r**2-1 conic badly underestimates away from the ellipse)
+    # deep inside oblong ellipses it overestimates instead, up to a/b times near the center
+    # (it gives the distance along the major axis), so inside points are clipped to their distance
+    # to the ellipse straight along either axis, which the true distance can't be more than.
+    # that leaves them at most ~20% over for a/b up to 4
+    a, b = params[2:4]
+    norm_rad, tf_x, tf_y = normalized_radius(params, points, return_axes=True)
+
+    # |grad r| = |(tf_x/a**2, tf_y/b**2)|/r
+    grad_mag = np.sqrt((tf_x/a**2)**2 + (tf_y/b**2)**2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        resids = np.abs(norm_rad-1.)*norm_rad/grad_mag
+
+    # the gradient vanishes at the center, which is the minor axis away
+    resids[grad_mag == 0] = np.min(np.abs((a, b)))
+
+    inside = norm_rad < 1
+    along_b = np.abs(b)*np.sqrt(1. - (tf_x[inside]/a)**2) - np.abs(tf_y[inside])
+    along_a = np.abs(a)*np.sqrt(1. - (tf_y[inside]/b)**2) - np.abs(tf_x[inside])
+    resids[inside] = np.minimum(resids[inside], np.minimum(along_a, along_b))
+    return resids
+
+
+class mean_dq(object):
+    # bounded deque of numbers that keeps a running sum so the mean is O(1).
+    # wraps a deque rather than subclassing it so only the operations that keep the sum right exist:
+    # append/extend (dropping the oldest values past maxlen), clear, len, iteration and indexing
+
+    def __init__(self, iterable=(), maxlen=None):
+        self.values = deque(maxlen=maxlen)
+        self.total = 0.
+        self.n_appends = 0
+        self.extend(iterable)
+
+    @property
+    def maxlen(self):
+        return self.values.maxlen
+
+    def append(self, x):
+        x = float(x)
+        if self.maxlen is not None and len(self.values) == self.maxlen:
+            self.total -= self.values[0]
+        self.values.append(x)
+        self.total += x
+
+        # rounding errors pile up in the running sum, so start it fresh every so often
+        self.n_appends += 1
+        if self.maxlen is not None and self.n_appends % self.maxlen == 0:
+            self.total = float(sum(self.values))
+
+    def extend(self, iterable):
+        for x in iterable:
+            self.append(x)
+
+    def clear(self):
+        self.values.clear()
+        self.total = 0.
+
+    def mean(self):
+        # same as np.mean(self), nan if empty
+        if len(self.values) == 0:
+            return np.nan
+        return self.total / len(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __repr__(self):
+        return 'mean_dq({!r}, maxlen={})'.format(list(self.values), self.maxlen)
+
+
+class EW_Stats(object):
+    # exponentially weighted mean & stdev updated one value at a time.
+    # the same as pandas' Series(values).ewm(halflife=halflife).mean()/.std() (adjust=True, bias=False)
+    # at the last value, but without keeping the values around
+
+    def __init__(self, halflife=10):
+        self.decay = 0.5 ** (1. / halflife)
+        self.w = 0.    # sum of weights
+        self.w2 = 0.   # sum of squared weights
+        self.wx = 0.   # weighted sum
+        self.wxx = 0.  # weighted sum of squares
+        self.n = 0
+
+    def append(self, x):
+        x = float(x)
+        self.w = self.w * self.decay + 1.
+        self.w2 = self.w2 * self.decay ** 2 + 1.
+        self.wx = self.wx * self.decay + x
+        self.wxx = self.wxx * self.decay + x * x
+        self.n += 1
+
+    def mean(self):
+        if self.n == 0:
+            return np.nan
+        return self.wx / self.w
+
+    def var(self):
+        if self.n < 2:
+            return np.nan
+        mean = self.wx / self.w
+        biased = max(self.wxx / self.w - mean ** 2, 0.)
+        return biased * self.w ** 2 / (self.w ** 2 - self.w2)
+
+    def std(self):
+        return np.sqrt(self.var())
+
+
 class slice_dq(deque):
     # credit to https://stackoverflow.com/a/10003201
     def __getitem__(self, index):
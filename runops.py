@@ -10,9 +10,11 @@ import multiprocessing as mp
 from tqdm import tqdm, trange
 import pandas as pd
 import json
+import warnings
 
 import imops
 import fitutils
+import model
 
 def draw_circle(event,x,y,flags,param):
     # Draw a circle on the frame to outline the pupil
@@ -139,6 +141,8 @@ def set_params(files):
         "files": files,
         "roi": roi,
         "shape": (roi[3], roi[2]),
+        # farthest apart (px) edge ends can be merged, None for as far as could pass (see imops.merge_curves)
+        "merge_radius": None,
     }
 
     return params
@@ -146,80 +150,470 @@ def set_params(files):
 def serve_frames(vid, output):
     pass
 
-def process_frame_all(frame, params, n):
+def process_frame_all(frame, params, n, workspace=None, equalizer=None, window=None):
+    # workspace: an imops.CannyWorkspace for params['shape'], its arrays are reused for every frame.
+    #   by default the one cached for the frame's shape in this process
+    # equalizer: an imops.Equalizer (see make_equalizer) if consecutive frames come through here in order
+    # window: (row0, row1, col0, col1) to only look for ellipses within, like from TrackingWindow.window()
+    #   the whole frame is still preprocessed so equalization doesn't depend on the window.
+    #   ellipses are returned in whole frame coordinates either way.
     frame = imops.preprocess_image(frame,
                                    sig_cutoff=params['sig_cutoff'],
-                                   sig_gain=params['sig_gain'])
+                                   sig_gain=params['sig_gain'],
+                                   equalizer=equalizer)
+
+    if window is not None:
+        row0, row1, col0, col1 = window
+        frame = frame[row0:row1, col0:col1]
+    else:
+        row0, col0 = 0, 0
+
+    if workspace is None or workspace.shape != frame.shape:
+        workspace = imops.shape_constants(frame.shape).workspace
 
     # get gradients
-    grad_x, grad_y, edge_mag = imops.edge_vectors(frame, sigma=params['canny_sig'], return_angles=False)
+    grad_x, grad_y, edge_mag = imops.edge_vectors(frame, sigma=params['canny_sig'], return_angles=False,
+                                                  buffers=workspace.grads)
 
     edges = imops.scharr_canny(frame, sigma=params['canny_sig'],
                                high_threshold=params['canny_high'],
                                low_threshold=params['canny_low'],
                                grads={'grad_x': grad_x,
                                       'grad_y': grad_y,
-                                      'edge_mag': edge_mag})
+                                      'edge_mag': edge_mag},
+                               workspace=workspace)
 
     edges_rep = imops.repair_edges(edges, frame, grads={'grad_x': grad_x,
                                                         'grad_y': grad_y,
-                                                        'edge_mag': edge_mag})
+                                                        'edge_mag': edge_mag},
+                                   merge_radius=params.get('merge_radius'))
 
     if edges_rep is None:
         return {}
-    ellipses = [(imops.fit_ellipse(e), len(e)) for e in edges_rep]
 
-    # appending to lists is actually pretty fast in python when dealing w/ uncertain quantities
-    # store ellipse parameters here, rejoin into a pandas dataframe at the end
-    ret = {
-        'x': [], # x position of ellipse center
-        'y': [],  # y position of ellipse center
-        'a': [],  # major axis (enforced when lists are combined - fitutils.clean_lists)
-        'b': [],  # minor axis ("")
-        't': [],  # theta, angle of a from x axis, radians, increasing counterclockwise
-        'n': [],  # frame number
-        #'v': [],  # mean value of points contained within ellipse
-        'c': [],  # coverage - n_points/perimeter
-        'g': []  # gradient magnitude of edge points
-    }
+    # fit all the edges at once, keep the ones that worked
+    ell_params, ell_ok = imops.fit_ellipses(edges_rep)
+    ell_npts = np.array([len(e) for e in edges_rep])
+    ell_params, ell_npts = ell_params[ell_ok], ell_npts[ell_ok]
 
-    for e, n_pts in ellipses:
-        if not e:
-            continue
+    # score all the ellipses at once
+    c, g, v = imops.score_ellipses(ell_params, ell_npts, frame, edge_mag)
 
-        ret['x'].append(e.params[0])
-        ret['y'].append(e.params[1])
-        ret['a'].append(e.params[2])
-        ret['b'].append(e.params[3])
-        ret['t'].append(e.params[4])
-        ret['n'].append(n)
+    # back to whole frame coordinates
+    ell_params[:, 0] += row0
+    ell_params[:, 1] += col0
 
-        # ell_mask_y, ell_mask_x = draw.ellipse(e.params[0], e.params[1], e.params[2], e.params[3],
-        #                                       shape=(frame.shape[1], frame.shape[0]),
-        #                                       rotation=e.params[4])
-        # v_list.append(np.mean(frame[ell_mask_x, ell_mask_y]))
-
-        # coverage - number of points vs. circumference
-        # perim: https://stackoverflow.com/a/42311034
-        perimeter = np.pi * (3 * (e.params[2] + e.params[3]) -
-                             np.sqrt((3 * e.params[2] + e.params[3]) *
-                                     (e.params[2] + 3 * e.params[3])))
+    # store ellipse parameters here, rejoin into a pandas dataframe at the end
+    ret = {
+        'x': ell_params[:, 0].tolist(), # x position of ellipse center
+        'y': ell_params[:, 1].tolist(),  # y position of ellipse center
+        'a': ell_params[:, 2].tolist(),  # major axis (enforced when lists are combined - fitutils.clean_lists)
+        'b': ell_params[:, 3].tolist(),  # minor axis ("")
+        't': ell_params[:, 4].tolist(),  # theta, angle of a from x axis, radians, increasing counterclockwise
+        'n': [n]*len(ell_params),  # frame number
+        'v': v.tolist(),  # mean value of points contained within ellipse
+        'c': c.tolist(),  # coverage - n_points/perimeter
+        'g': g.tolist()  # gradient magnitude of edge points
+    }
 
-        ret['c'].append(float(n_pts) / perimeter)
+    return ret
 
-        # get the mean edge mag for predicted points on the ellipse,
-        # off-target ellipses often go through the pupil aka through areas with low gradients...
-        e_points = np.round(e.predict_xy(np.linspace(0,np.pi*2, 200))).astype(np.int)
-        e_points[:, 0] = np.clip(e_points[:, 0], 0, frame.shape[0] - 1)
-        e_points[:, 1] = np.clip(e_points[:, 1], 0, frame.shape[1] - 1)
-        ret['g'].append(np.mean(edge_mag[e_points[:, 0], e_points[:, 1]]))
 
 
-    return ret
 
 
 
+class TrackingWindow(object):
+    """
+    Only look for the pupil near where it was last found.
+
+    After each frame, give update() its result from process_frame_all. If any of the ellipses are
+    confident (cover at least min_coverage of their perimeter with edge points, aren't more oblong
+    than min_ratio minor/major, and have a major axis of at least min_major), the next window() is a
+    square around the one with the strongest edges, pad times its major axis on a side.
+    Otherwise, window() goes back to the whole frame until the pupil is found again.
+
+    Window sizes are rounded up to a multiple of step so only a few frame shapes
+    (and cached workspaces, see imops.shape_constants) ever get made.
+    """
+
+    def __init__(self, shape, pad=3., min_coverage=0.5, min_ratio=0.5, min_major=0, step=32):
+        self.shape = tuple(shape)
+        self.pad = pad
+        self.min_coverage = min_coverage
+        self.min_ratio = min_ratio
+        self.min_major = min_major
+        self.step = step
+        self.bounds = None
+
+    def window(self):
+        # (row0, row1, col0, col1) to process next
+        if self.bounds is None:
+            return (0, self.shape[0], 0, self.shape[1])
+        return self.bounds
+
+    def update(self, result):
+        # set the next window from a result dict. returns the index of the ellipse it's centered on,
+        # or None if there wasn't a confident one
+        if not result or len(result.get('x', [])) == 0:
+            self.bounds = None
+            return None
+
+        x, y, a, b, c, g = [np.asarray(result[k], dtype=np.float64) for k in ('x', 'y', 'a', 'b', 'c', 'g')]
+        major, minor = np.maximum(np.abs(a), np.abs(b)), np.minimum(np.abs(a), np.abs(b))
+        ok = np.isfinite(x) & np.isfinite(y) & np.isfinite(g) & (major > 0)
+        ok[ok] = (c[ok] >= self.min_coverage) & (minor[ok] / major[ok] >= self.min_ratio) & \
+                 (major[ok] >= self.min_major) & \
+                 (x[ok] >= 0) & (x[ok] < self.shape[0]) & (y[ok] >= 0) & (y[ok] < self.shape[1])
+        if not ok.any():
+            self.bounds = None
+            return None
+
+        # off-target ellipses tend to go through areas with weak gradients
+        best = int(np.argmax(np.where(ok, g, -np.inf)))
+        self.center(x[best], y[best], major[best])
+        return best
+
+    def center(self, x, y, major):
+        # put the next window around an ellipse centered at (x, y) (row, col) with this major axis
+        size = int(np.ceil(2 * self.pad * major / self.step) * self.step)
+        bounds = []
+        for center, length in ((x, self.shape[0]), (y, self.shape[1])):
+            if size >= length:
+                bounds.extend([0, length])
+            else:
+                start = int(np.clip(np.round(center - size / 2.), 0, length - size))
+                bounds.extend([start, start + size])
+        self.bounds = tuple(bounds)
+
+
+def make_window(params):
+    # if params['window_pad'] is set, a TrackingWindow that sizes its windows that many times
+    # the pupil's major axis (eg. 3), otherwise None to always process the whole frame.
+    # ellipses smaller than basic_filter allows don't count as found.
+    if params.get('window_pad'):
+        min_major = params['mask']['r'] / 6. if 'mask' in params else 0
+        return TrackingWindow(params['shape'], pad=params['window_pad'], min_major=min_major)
+    return None
+
+
+class PupilTracker(object):
+    """
+    Follow one pupil through consecutive frames with a model.Pupil_Model, one ellipse per frame.
+
+    The pupil is found by running process_frame_all on the whole frame and taking the ellipse a
+    TrackingWindow would center on. After that, edges are only detected in a window around the
+    model's estimate, and the model is updated from those edge points instead of fitting and
+    scoring every candidate. Whole frame detection runs again every redetect_every frames, and
+    as soon as the model loses the pupil (max_misses bad frames in a row).
+
+    The emitted ellipses also go through a fitutils.EllipseKalman, whose prediction
+    is where the window is centered on the next frame.
+
+    Frames have to be given in order, so make one per video or contiguous range of frames.
+    step() returns a result with the same columns & (row, col) coordinates as process_frame_all,
+    with either one ellipse or none.
+    """
+
+    def __init__(self, params, redetect_every=250, max_misses=5, pad=3., equalizer=None):
+        self.params = params
+        self.redetect_every = redetect_every
+        self.max_misses = max_misses
+        self.equalizer = equalizer
+
+        min_major = params['mask']['r'] / 6. if 'mask' in params else 0
+        self.window = TrackingWindow(params['shape'], pad=pad, min_major=min_major)
+
+        self.model = None
+        self.kalman = fitutils.EllipseKalman()
+        self.since_detect = 0
+        self.misses = 0
+
+    def step(self, frame, n):
+        # cropped grayscale frame -> result dict
+        if self.model is None or self.since_detect >= self.redetect_every:
+            self.since_detect = 0
+            found = self.detect(frame, n)
+            if found:
+                self.seed(found)
+                return found
+            elif self.model is None:
+                return {}
+            # if we still have a model, keep tracking with it
+
+        self.since_detect += 1
+        result = self.track(frame, n)
+        if not result:
+            self.misses += 1
+            if self.misses >= self.max_misses:
+                self.model = None
+            return {}
+
+        self.misses = 0
+        self.kalman.update(fitutils.major_first([result[k][0] for k in ('x', 'y', 'a', 'b', 't')]))
+        return result
+
+    def detect(self, frame, n):
+        # look for the pupil in the whole frame, return just the best ellipse if there is one
+        result = process_frame_all(frame, self.params, n, equalizer=self.equalizer)
+        best = self.window.update(result)
+        if best is None:
+            return {}
+        return {k: [v[best]] for k, v in result.items()}
+
+    def seed(self, result):
+        # (re)start the model from a detected ellipse
+        ell = [result[k][0] for k in ('x', 'y', 'a', 'b', 't')]
+        xy_params = model.flip_params(ell)
+        if self.model is None:
+            self.model = model.Pupil_Model(xy_params[0], xy_params[1], max(ell[2], ell[3]))
+        self.model.reseed(xy_params)
+        self.misses = 0
+
+        self.kalman.reset()
+        self.kalman.update(fitutils.major_first(ell))
+
+    def track(self, frame, n):
+        params = self.params
+        frame = imops.preprocess_image(frame,
+                                       sig_cutoff=params['sig_cutoff'],
+                                       sig_gain=params['sig_gain'],
+                                       equalizer=self.equalizer)
+
+        # only look for edges around where the pupil should be
+        ell = np.array(model.flip_params(self.model.model.params), dtype=np.float64)
+        if not np.all(np.isfinite(ell)):
+            return {}
+        predicted = self.kalman.predict()
+        if predicted is not None and np.all(np.isfinite(predicted)):
+            self.window.center(predicted[0], predicted[1], max(abs(ell[2]), abs(ell[3]), predicted[2]))
+        else:
+            self.window.center(ell[0], ell[1], max(abs(ell[2]), abs(ell[3])))
+        row0, row1, col0, col1 = self.window.window()
+        frame_win = frame[row0:row1, col0:col1]
+
+        workspace = imops.shape_constants(frame_win.shape).workspace
+        grad_x, grad_y, edge_mag = imops.edge_vectors(frame_win, sigma=params['canny_sig'],
+                                                      buffers=workspace.grads)
+        edges = imops.scharr_canny(frame_win, sigma=params['canny_sig'],
+                                   high_threshold=params['canny_high'],
+                                   low_threshold=params['canny_low'],
+                                   grads={'grad_x': grad_x,
+                                          'grad_y': grad_y,
+                                          'edge_mag': edge_mag},
+                                   workspace=workspace)
+
+        # the model only has to look through the window's edges
+        if not self.model.update(edges, frame, offset=(row0, col0), shape=frame.shape):
+            return {}
+
+        ell = np.array(model.flip_params(self.model.model.params), dtype=np.float64)
+        if not np.all(np.isfinite(ell)):
+            return {}
+
+        # score it like process_frame_all would, in window coordinates
+        ell_win = ell.copy()
+        ell_win[0] -= row0
+        ell_win[1] -= col0
+        c, g, v = imops.score_ellipses(ell_win, [len(self.model.f_points)], frame_win, edge_mag)
+        if not c[0] >= self.window.min_coverage:
+            return {}
+
+        return {
+            'x': [ell[0]],
+            'y': [ell[1]],
+            'a': [ell[2]],
+            'b': [ell[3]],
+            't': [ell[4]],
+            'n': [n],
+            'v': v.tolist(),
+            'c': c.tolist(),
+            'g': g.tolist()
+        }
+
+
+def make_tracker(params, equalizer=None):
+    # if params['track'] is set, a PupilTracker to emit one tracked ellipse per frame
+    # (re-detecting every params['redetect_every'] frames), otherwise None to keep every candidate
+    if params.get('track'):
+        return PupilTracker(params, redetect_every=params.get('redetect_every', 250),
+                            pad=params.get('window_pad', 3.), equalizer=equalizer)
+    return None
+
+
+def make_equalizer(params):
+    # if params['eq_drift'] is set, an imops.Equalizer that reuses the histogram equalization
+    # until the histogram drifts that far (0-1, eg. 0.02), otherwise None to equalize every frame
+    if params.get('eq_drift'):
+        return imops.Equalizer(drift=params['eq_drift'])
+    return None
+
+
+class EllipseSink(object):
+    """
+    Append per-frame ellipse results to disk as they come in.
+
+    Rows are buffered in memory and every chunk_frames frames they're written as typed arrays
+    to a numbered .npz chunk in the sink's directory (eg. data/Ellall_<video name>/).
+    Each chunk also stores the numbers of all the frames it covers, including frames where
+    no ellipses were found. Load everything back with load_ellipses.
+
+    The chunks double as checkpoints: with resume=True, chunks already in the directory are kept
+    and done_frames holds the frames they cover, so a restarted job can skip them
+    (see first_unprocessed). Otherwise any old chunks are removed.
+
+    If params are given they're saved next to the chunks (params.json), and resuming from chunks
+    that were made with different params starts over instead, so old and new results never mix.
+    """
+
+    columns = ('x', 'y', 'a', 'b', 't', 'n', 'v', 'c', 'g')
+
+    def __init__(self, path, chunk_frames=1000, resume=False, params=None):
+        self.path = path
+        self.chunk_frames = chunk_frames
 
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+        # the file list grows as videos are added to a batch, it doesn't change the results.
+        # round trip through json so tuples and lists compare equal
+        params_fn = os.path.join(path, "params.json")
+        if params is not None:
+            params = json.loads(json.dumps({k: v for k, v in params.items() if k != 'files'}))
+
+        if resume and params is not None and len(chunk_files(path)) > 0:
+            try:
+                with open(params_fn, 'r') as params_f:
+                    saved_params = json.load(params_f)
+            except (IOError, OSError, ValueError):
+                saved_params = None
+            if saved_params != params:
+                warnings.warn("Results in {} were made with different params, starting over".format(path))
+                resume = False
+
+        if params is not None:
+            with open(params_fn, 'w') as params_f:
+                json.dump(params, params_f)
+
+        if resume:
+            self.done_frames = set(processed_frames(path).tolist())
+        else:
+            for fn in chunk_files(path):
+                os.remove(fn)
+            self.done_frames = set()
+
+        # keep numbering after any chunks that are already there
+        self.n_chunks = len(chunk_files(path))
+
+        self.buffer = {k: [] for k in self.columns}
+        self.frames = []
+
+    def append(self, n, result):
+        # result is a dict of lists like process_frame_all returns, possibly empty
+        n_rows = len(result.get('n', []))
+        for k in self.columns:
+            self.buffer[k].extend(result.get(k, [np.nan]*n_rows))
+        self.frames.append(n)
+
+        if len(self.frames) >= self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        if len(self.frames) == 0:
+            return
+
+        arrays = {k: np.array(v, dtype=np.float64) for k, v in self.buffer.items()}
+        arrays['n'] = arrays['n'].astype(np.int64)
+        arrays['frames'] = np.array(self.frames, dtype=np.int64)
+
+        # write to a temp file and rename so a crash never leaves half a chunk
+        chunk_fn = os.path.join(self.path, "chunk_{:06d}.npz".format(self.n_chunks))
+        tmp_fn = chunk_fn + ".tmp.npz"
+        np.savez(tmp_fn, **arrays)
+        os.rename(tmp_fn, chunk_fn)
+
+        self.n_chunks += 1
+        self.buffer = {k: [] for k in self.columns}
+        self.frames = []
+
+    def close(self):
+        self.flush()
+
+
+def chunk_files(path):
+    # the finished chunks in an EllipseSink directory, in order
+    return sorted([os.path.join(path, f) for f in os.listdir(path)
+                   if f.startswith("chunk_") and f.endswith(".npz") and not f.endswith(".tmp.npz")])
+
+
+def processed_frames(path):
+    # every frame number covered by the chunks in an EllipseSink directory, sorted
+    frames = []
+    for fn in chunk_files(path):
+        # close each file once we have its arrays
+        with np.load(fn) as chunk:
+            frames.append(chunk['frames'])
+    if len(frames) == 0:
+        return np.array([], dtype=np.int64)
+    return np.sort(np.concatenate(frames))
+
+
+def first_unprocessed(done_frames, first_frame=1):
+    # first frame number (counting like CAP_PROP_POS_FRAMES after a read, from 1) not in done_frames
+    n = first_frame
+    while n in done_frames:
+        n += 1
+    return n
+
+
+def frame_ranges(total_frames, n_ranges=None, done_frames=(), range_frames=None):
+    # split the frames of a video that haven't been done yet into about n_ranges contiguous
+    # (start, stop) ranges of frame numbers, from 1, stop exclusive.
+    # or, if range_frames is given instead, ranges of at most that many frames.
+    # ranges never span a gap left by done frames, so there can be a few more than n_ranges.
+    # each range starts with a seek (see workers.seek). if a video can't seek accurately the worker
+    # decodes from the start of the video instead, so every range costs O(start) frames and
+    # many ranges of a long video cost O(frames**2) -- use fewer, longer ranges for those.
+    todo = np.setdiff1d(np.arange(1, total_frames+1), np.array(list(done_frames), dtype=np.int64))
+    if len(todo) == 0:
+        return []
+
+    if range_frames is not None:
+        size = int(range_frames)
+    else:
+        size = int(np.ceil(float(len(todo)) / n_ranges))
+
+    # break wherever frames aren't consecutive or a range gets full
+    breaks = np.flatnonzero(np.diff(todo) != 1) + 1
+    runs = np.split(todo, breaks)
+
+    ranges = []
+    for run in runs:
+        for i in range(0, len(run), size):
+            ranges.append((int(run[i]), int(run[min(i+size, len(run))-1])+1))
+    return ranges
+
+
+def load_ellipses(path, return_frames=False):
+    # load the chunks written by an EllipseSink into a dataframe sorted by frame
+    # if return_frames, also return an array of every frame number that was processed
+    chunks = []
+    for fn in chunk_files(path):
+        with np.load(fn) as chunk:
+            chunks.append({k: chunk[k] for k in EllipseSink.columns})
+    columns = {k: np.concatenate([c[k] for c in chunks]) if chunks else np.array([])
+               for k in EllipseSink.columns}
+
+    df = pd.DataFrame(columns, columns=EllipseSink.columns)
+    df = df.sort_values('n', kind='mergesort').reset_index(drop=True)
+
+    if return_frames:
+        return df, processed_frames(path)
+    else:
+        return df
 
 
 def process_frame(frame, params, crop=True, preproc=True):
@@ -245,7 +639,8 @@ def process_frame(frame, params, crop=True, preproc=True):
 
     edges_rep = imops.repair_edges(edges, frame, grads={'grad_x': grad_x,
                                                         'grad_y': grad_y,
-                                                        'edge_mag': edge_mag})
+                                                        'edge_mag': edge_mag},
+                                   merge_radius=params.get('merge_radius'))
 
     # return [(ellipse, n_pts)]
     try:
@@ -342,7 +737,11 @@ def video_from_params(param_fn, ell_fn, which_vid = 0):
     vid = cv2.VideoCapture(vid_fn)
     total_frames = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
 
-    ell_df = pd.read_csv(ell_fn)
+    # ellipses can be in a .csv or a directory of chunks from an EllipseSink
+    if os.path.isdir(ell_fn):
+        ell_df = load_ellipses(ell_fn)
+    else:
+        ell_df = pd.read_csv(ell_fn)
 
     vid_path, vid_name = os.path.split(vid_fn)
     vid_name = "Ellone_" + vid_name.rsplit('.',1)[0] + ".mp4"
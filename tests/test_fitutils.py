@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+
+import fitutils
+
+
+def kalman_reference(z, r, q):
+    # constant velocity kalman filter and RTS smoother for one param, written out step by step
+    # with full matrices. starts like EllipseKalman: at the first measurement, not moving.
+    # returns the filtered and smoothed positions
+    F = np.array([[1., 1.], [0., 1.]])
+    Q = q * np.array([[0.25, 0.5], [0.5, 1.]])
+    x = np.array([z[0], 0.])
+    P = np.diag([r, r + q])
+    x_filt, P_filt, x_pred, P_pred = [x], [P], [None], [None]
+    for z_t in z[1:]:
+        x = F.dot(x)
+        P = F.dot(P).dot(F.T) + Q
+        x_pred.append(x)
+        P_pred.append(P)
+        K = P[:, 0] / (P[0, 0] + r)
+        x = x + K * (z_t - x[0])
+        P = P - np.outer(K, P[0, :])
+        x_filt.append(x)
+        P_filt.append(P)
+
+    x_smooth = [x_filt[-1]]
+    for t in range(len(z) - 2, -1, -1):
+        C = P_filt[t].dot(F.T).dot(np.linalg.inv(P_pred[t + 1]))
+        x_smooth.append(x_filt[t] + C.dot(x_smooth[-1] - x_pred[t + 1]))
+    x_smooth = x_smooth[::-1]
+
+    return np.array([x[0] for x in x_filt]), np.array([x[0] for x in x_smooth])
+
+
+def noisy_params(n_frames=600, seed=6):
+    # moving ellipse params w/ measurement noise, theta swinging back and forth across the wrap.
+    # returns them unwrapped and wrapped into [0, pi) like they'd be measured
+    rand = np.random.RandomState(seed)
+    frames = np.arange(n_frames)
+    params = np.column_stack((240 + 20 * np.sin(2 * np.pi * frames / 150),
+                              320 + 0.05 * frames,
+                              30 + 3 * np.sin(2 * np.pi * frames / 90),
+                              25 + 2 * np.cos(2 * np.pi * frames / 120),
+                              0.3 * np.sin(2 * np.pi * frames / 200)))
+    params += rand.normal(0, 1, params.shape) * np.sqrt(fitutils.ELLIPSE_NOISE)
+    wrapped = params.copy()
+    wrapped[:, 4] = np.mod(wrapped[:, 4], np.pi)
+    return params, wrapped
+
+
+def test_kalman_smooth_constant():
+    params = np.array([240., 320., 30., 25., 0.])
+    z = np.tile(params, (500, 1))
+    # gaps, and theta at the wrap: 0 and pi are the same angle
+    z[100:120] = np.nan
+    z[1::2, 4] = np.pi
+
+    smoothed = fitutils.kalman_smooth(z, r=fitutils.ELLIPSE_NOISE)
+
+    assert np.all(np.isfinite(smoothed))
+    np.testing.assert_allclose(smoothed[:, :4], np.tile(params[:4], (500, 1)), rtol=1e-9)
+    np.testing.assert_allclose(fitutils.wrap_diff(smoothed - params)[:, 4], 0, atol=1e-9)
+
+
+def test_ellipse_kalman_constant():
+    params = np.array([240., 320., 30., 25., 1.])
+    kalman = fitutils.EllipseKalman()
+    assert kalman.predict() is None
+    for i in range(100):
+        kalman.predict()
+        filtered = kalman.update(np.nan * params if i % 10 == 5 else params)
+        np.testing.assert_allclose(filtered, params, rtol=1e-9)
+    np.testing.assert_allclose(kalman.predict(), params, rtol=1e-9)
+    assert np.all(kalman.std() < np.sqrt(fitutils.ELLIPSE_NOISE))
+
+
+def test_kalman_smooth_matches_reference():
+    z, z_wrapped = noisy_params()
+    r = fitutils.ELLIPSE_NOISE
+    q = fitutils.halflife_noise(r, 3)
+
+    smoothed = fitutils.kalman_smooth(z_wrapped, r=r, hl=3)
+    assert np.all((smoothed[:, 4] >= 0) & (smoothed[:, 4] < np.pi))
+
+    for i in range(5):
+        _, expected = kalman_reference(z[:, i], r[i], q[i])
+        diff = fitutils.wrap_diff(smoothed[:, i] - expected, fitutils.ELLIPSE_PERIODS[i])
+        # kalman_smooth uses the steady state gains from the first frame, where the
+        # reference still trusts the measurements more, so they only agree once it settles
+        assert np.all(np.abs(diff[:60]) < 3 * np.sqrt(r[i]))
+        np.testing.assert_allclose(diff[60:], 0, atol=0.005 * np.sqrt(r[i]))
+
+
+def test_ellipse_kalman_matches_reference():
+    z, z_wrapped = noisy_params()
+    kalman = fitutils.EllipseKalman(r=fitutils.ELLIPSE_NOISE, hl=3)
+    filtered = []
+    for z_t in z_wrapped:
+        kalman.predict()
+        filtered.append(kalman.update(z_t))
+    filtered = np.array(filtered)
+
+    for i in range(5):
+        expected, _ = kalman_reference(z[:, i], kalman.r[i], kalman.q[i])
+        diff = fitutils.wrap_diff(filtered[:, i] - expected, fitutils.ELLIPSE_PERIODS[i])
+        np.testing.assert_allclose(diff, 0, atol=1e-9)
+
+
+def test_smooth_estimates_smooths_theta():
+    z, z_wrapped = noisy_params()
+    params = pd.DataFrame(z_wrapped, columns=fitutils.ELLIPSE_PARAMS)
+    params['n'] = np.arange(len(params))
+    params['v'] = 1.
+    # frames without an estimate
+    params = params.drop(params.index[100:110])
+
+    smoothed = fitutils.smooth_estimates(params, r=fitutils.ELLIPSE_NOISE)
+
+    assert len(smoothed) == len(z)
+    ell_cols = list(fitutils.ELLIPSE_PARAMS)
+    measured = params.set_index('n').reindex(np.arange(len(z)))[ell_cols].values
+    expected = fitutils.kalman_smooth(measured, r=fitutils.ELLIPSE_NOISE)
+    np.testing.assert_allclose(smoothed[ell_cols].values, expected)
+    assert np.all((smoothed['t'] >= 0) & (smoothed['t'] < np.pi))
+    np.testing.assert_allclose(smoothed['v'], 1.)
@@ -0,0 +1,234 @@
+import numpy as np
+from scipy.spatial import distance
+from skimage import draw, feature, measure
+from sklearn.preprocessing import normalize
+
+import imops
+
+
+def edge_sets(n_frames=20, seed=0):
+    # the edges of some noisy blobs, each as a raster ordered (n, 2) array of (row, col) points
+    rand = np.random.RandomState(seed)
+    edges_xy = []
+    for _ in range(n_frames):
+        frame = np.zeros((120, 160))
+        for _ in range(3):
+            rr, cc = draw.ellipse(rand.uniform(20, 100), rand.uniform(20, 140),
+                                  rand.uniform(5, 30), rand.uniform(5, 30),
+                                  shape=frame.shape, rotation=rand.uniform(0, np.pi))
+            frame[rr, cc] += rand.uniform(0.3, 1.)
+        frame += rand.normal(0, 0.05, frame.shape)
+        edges = feature.canny(frame, sigma=2)
+        labeled = measure.label(edges, connectivity=2)
+        for i in range(1, labeled.max() + 1):
+            points = np.column_stack(np.where(labeled == i))
+            if len(points) > 2:
+                edges_xy.append(points)
+    return edges_xy
+
+
+def check_walk(points, ordered):
+    # every point at most once, all from the edge, each step to a point
+    # within the 5x5 neighborhood the walk searches (old: distance < 3)
+    assert len(set(map(tuple, ordered))) == len(ordered)
+    assert set(map(tuple, ordered)) <= set(map(tuple, points))
+    assert tuple(points[0]) in set(map(tuple, ordered))
+    steps = np.sqrt(np.sum(np.diff(ordered, axis=0)**2, axis=1))
+    assert np.all(steps < 3)
+
+
+def test_order_points_walks_arcs():
+    # open one pixel wide arcs have one walk, so nothing gets dropped and
+    # the old distance based walk finds the same points (ties only change which way it steps)
+    rand = np.random.RandomState(0)
+    for _ in range(100):
+        rr, cc = draw.ellipse_perimeter(60, 80, rand.randint(5, 40), rand.randint(5, 40),
+                                        orientation=rand.uniform(0, np.pi))
+        points = np.unique(np.column_stack((rr, cc)), axis=0)
+        angles = np.arctan2(points[:, 0] - 60, points[:, 1] - 80)
+        arc = points[np.mod(angles - rand.uniform(-np.pi, np.pi), 2 * np.pi) < rand.uniform(1, 5)]
+
+        ordered = imops.order_points(arc)
+        check_walk(arc, ordered)
+        assert len(ordered) == len(arc)
+        assert set(map(tuple, ordered)) == set(map(tuple, imops.order_points_old(arc)))
+
+
+def test_order_points_walks_edges():
+    # canny edges branch, and which branch gets walked depends on how ties are broken
+    edges_xy = edge_sets()
+    assert len(edges_xy) > 20
+    for points in edges_xy:
+        check_walk(points, imops.order_points(points))
+
+
+def test_prasad_lines_batch_matches_prasad_lines():
+    edges_xy = [imops.order_points(points) for points in edge_sets(seed=1)]
+    seglists = imops.prasad_lines_batch(edges_xy)
+    assert len(seglists) == len(edges_xy)
+    for edge, seglist in zip(edges_xy, seglists):
+        np.testing.assert_array_equal(seglist, imops.prasad_lines(edge))
+
+
+def test_break_corners_matches_break_at_corners():
+    edges_xy = [imops.order_points(points) for points in edge_sets(seed=4)]
+    split_edges, split_segs = imops.break_corners(edges_xy, return_segments=True)
+    # some edges should get broken up
+    assert len(split_edges) > len(edges_xy)
+    assert len(split_segs) == len(split_edges)
+
+    expected_edges, expected_segs = [], []
+    for edge in edges_xy:
+        edges, segs = imops.break_at_corners(edge, return_segments=True)
+        expected_edges.extend(edges)
+        expected_segs.extend(segs)
+
+    assert len(split_edges) == len(expected_edges)
+    for edge, expected in zip(split_edges, expected_edges):
+        np.testing.assert_array_equal(edge, expected)
+    for segs, expected in zip(split_segs, expected_segs):
+        if expected is None:
+            assert segs is None
+        else:
+            np.testing.assert_array_equal(segs, expected)
+
+
+def merge_curves_dense(edges_xy, grads, threshold=0.5):
+    # merge_curves as it was before the KD-tree, scoring every pair of endpoints
+    edge_points = np.row_stack([(e[0], e[-1]) for e in edges_xy])
+
+    edge_dists = distance.squareform(distance.pdist(edge_points))
+    edge_grads = np.column_stack((grads['grad_x'][edge_points[:, 0], edge_points[:, 1]],
+                                  grads['grad_y'][edge_points[:, 0], edge_points[:, 1]]))
+    edge_grads = distance.squareform(distance.pdist(edge_grads, "cosine"))
+
+    segs = [imops.prasad_lines(e) for e in edges_xy]
+    edge_segs = np.row_stack([((e[0], e[1]), (e[-1], e[-2])) for e in segs])
+    edge_vects = normalize(edge_segs[:, 0, :] - edge_segs[:, 1, :])
+    edge_mids = np.mean(edge_segs, axis=1)
+    edge_affinity = np.row_stack(
+        [distance.cdist(edge_vects[i, :].reshape(1, 2), edge_mids - edge_points[i, :], "cosine")
+         for i in range(len(edge_segs))])
+    edge_affinity = (edge_affinity + edge_affinity.T) / 2.
+
+    merge_score = (1 - edge_dists/np.max(edge_dists)) * (1 - edge_grads/2.)**2 * (1 - edge_affinity/2.)**2
+    merge_score[np.isnan(merge_score)] = 0.
+    merge_score[np.triu_indices(len(merge_score))] = 0.
+
+    merge_points = np.column_stack(np.where(merge_score > threshold))
+    merge_points = merge_points[merge_points[:, 0]//2 != merge_points[:, 1]//2, :]
+
+    # join the edges at the merged ends (even points are starts, odd are ends)
+    newsegs = []
+    for p in merge_points:
+        seg1, seg2 = edges_xy[p[0]//2], edges_xy[p[1]//2]
+        if p[0] % 2 == 0 and p[1] % 2 == 1:
+            newsegs.append(np.row_stack((seg2, seg1)))
+        elif p[0] % 2 == 1 and p[1] % 2 == 0:
+            newsegs.append(np.row_stack((seg1, seg2)))
+        elif p[0] % 2 == 0:
+            newsegs.append(np.row_stack((np.flipud(seg1), seg2)))
+        else:
+            newsegs.append(np.row_stack((seg1, np.flipud(seg2))))
+    return newsegs
+
+
+def test_merge_curves_matches_dense():
+    rand = np.random.RandomState(5)
+    n_merged = 0
+    for _ in range(10):
+        frame = np.zeros((120, 160))
+        for _ in range(4):
+            rr, cc = draw.ellipse(rand.uniform(20, 100), rand.uniform(20, 140),
+                                  rand.uniform(5, 30), rand.uniform(5, 30),
+                                  shape=frame.shape, rotation=rand.uniform(0, np.pi))
+            frame[rr, cc] += rand.uniform(0.3, 1.)
+        frame += rand.normal(0, 0.05, frame.shape)
+        grad_x, grad_y, edge_mag = imops.edge_vectors(frame, sigma=1)
+        grads = {'grad_x': grad_x, 'grad_y': grad_y, 'edge_mag': edge_mag}
+
+        edges_xy = imops.labeled2xy(measure.label(feature.canny(frame, sigma=2), connectivity=2),
+                                    small_thresh=5)
+        edges_xy = [e for e in imops.break_corners(edges_xy) if len(e) > 5]
+        if len(edges_xy) < 2:
+            continue
+
+        expected = merge_curves_dense(edges_xy, grads)
+        merged = imops.merge_curves(list(edges_xy), frame, grads=grads)[len(edges_xy):]
+        assert len(merged) == len(expected)
+        for edge, expected_edge in zip(merged, expected):
+            np.testing.assert_array_equal(edge, expected_edge)
+        n_merged += len(merged)
+    assert n_merged > 0
+
+
+def major_first(params):
+    # (x, y, a, b, t) with a as the major axis and t in [0, pi), so fits can be compared
+    params = np.array(params, dtype=np.float64).reshape(-1, 5)
+    swap = params[:, 3] > params[:, 2]
+    params[swap, 2], params[swap, 3] = params[swap, 3], params[swap, 2].copy()
+    params[swap, 4] += np.pi / 2
+    params[:, 4] = np.mod(params[:, 4], np.pi)
+    return params
+
+
+def test_fit_ellipses_matches_ellipse_model():
+    rand = np.random.RandomState(2)
+    edges_xy = []
+    for _ in range(100):
+        x0, y0 = rand.uniform(0, 480), rand.uniform(0, 640)
+        a, b = rand.uniform(10, 60), rand.uniform(10, 60)
+        t = rand.uniform(0, np.pi)
+        # arcs of all lengths, some of them too short or straight to fit
+        start = rand.uniform(0, 2 * np.pi)
+        thetas = np.linspace(start, start + rand.uniform(0.5, 2 * np.pi), rand.randint(3, 100))
+        points = np.column_stack((x0 + a * np.cos(thetas) * np.cos(t) - b * np.sin(thetas) * np.sin(t),
+                                  y0 + a * np.cos(thetas) * np.sin(t) + b * np.sin(thetas) * np.cos(t)))
+        edges_xy.append(np.round(points + rand.normal(0, 0.5, points.shape)))
+    edges_xy.append(np.column_stack((np.arange(10.), np.arange(10.))))
+
+    params, success = imops.fit_ellipses(edges_xy)
+    assert np.sum(success) > 50
+    # too few points or all on a line
+    assert not np.any(success[np.array([len(e) for e in edges_xy]) < 5])
+    assert not success[-1]
+
+    for points, fit_params, ok in zip(edges_xy, params, success):
+        if not ok:
+            continue
+        ellipse = imops.measure.EllipseModel()
+        assert ellipse.estimate(points)
+        np.testing.assert_allclose(major_first(fit_params)[0, :4], major_first(ellipse.params)[0, :4],
+                                   rtol=1e-6, atol=1e-6)
+        t_diff = major_first(fit_params)[0, 4] - major_first(ellipse.params)[0, 4]
+        assert abs(t_diff - np.pi * np.round(t_diff / np.pi)) < 1e-6
+
+
+def test_score_ellipses_matches_per_ellipse():
+    rand = np.random.RandomState(3)
+    frame = rand.uniform(0, 1, (120, 160))
+    edge_mag = rand.uniform(0, 1, (120, 160))
+    # some hanging off the frame
+    params = np.column_stack((rand.uniform(-10, 130, 200), rand.uniform(-10, 170, 200),
+                              rand.uniform(3, 40, 200), rand.uniform(3, 40, 200),
+                              rand.uniform(0, np.pi, 200)))
+    n_pts = rand.randint(5, 200, 200)
+
+    c, g, v = imops.score_ellipses(params, n_pts, frame, edge_mag)
+
+    thetas = np.linspace(0, np.pi * 2, 200)
+    for i, (x, y, a, b, t) in enumerate(params):
+        perimeter = np.pi * (3 * (a + b) - np.sqrt((3 * a + b) * (a + 3 * b)))
+        np.testing.assert_allclose(c[i], n_pts[i] / perimeter)
+
+        ellipse = imops.measure.EllipseModel()
+        e_points = np.round(ellipse.predict_xy(thetas, params=(x, y, a, b, t))).astype(np.int64)
+        e_points[:, 0] = np.clip(e_points[:, 0], 0, frame.shape[0] - 1)
+        e_points[:, 1] = np.clip(e_points[:, 1], 0, frame.shape[1] - 1)
+        np.testing.assert_allclose(g[i], np.mean(edge_mag[e_points[:, 0], e_points[:, 1]]))
+
+        rr, cc = draw.ellipse(x, y, a, b, shape=frame.shape, rotation=t)
+        if len(rr) == 0:
+            assert np.isnan(v[i])
+        else:
+            np.testing.assert_allclose(v[i], np.mean(frame[rr, cc]))
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+import model
+
+
+def test_ew_stats_matches_pandas_ewm():
+    values = np.random.RandomState(4).normal(5., 2., 300)
+    ewm_mean = pd.Series(values).ewm(halflife=10).mean().values
+    ewm_std = pd.Series(values).ewm(halflife=10).std().values
+
+    stats = model.EW_Stats(halflife=10)
+    assert np.isnan(stats.mean())
+    for i, x in enumerate(values):
+        stats.append(x)
+        np.testing.assert_allclose(stats.mean(), ewm_mean[i])
+        if i == 0:
+            assert np.isnan(stats.std())
+        else:
+            np.testing.assert_allclose(stats.std(), ewm_std[i])
+
+
+def test_mean_dq():
+    values = np.random.RandomState(5).normal(100., 10., 1000)
+    dq = model.mean_dq(maxlen=50)
+    assert np.isnan(dq.mean())
+    for i, x in enumerate(values):
+        dq.append(x)
+        window = values[max(i - 49, 0):i + 1]
+        assert len(dq) == len(window)
+        np.testing.assert_allclose(dq.mean(), np.mean(window))
+    np.testing.assert_array_equal(list(dq), values[-50:])
+    assert dq[-1] == values[-1]
+
+    dq.clear()
+    dq.extend(values[:10])
+    np.testing.assert_allclose(dq.mean(), np.mean(values[:10]))
+
+
+def ellipse_distance(params, points, n_thetas=5000):
+    # distance to the nearest of a lot of points on the ellipse
+    x, y, a, b, t = params
+    thetas = np.linspace(0, 2 * np.pi, n_thetas, endpoint=False)
+    e_x = x + a * np.cos(thetas) * np.cos(t) - b * np.sin(thetas) * np.sin(t)
+    e_y = y + a * np.cos(thetas) * np.sin(t) + b * np.sin(thetas) * np.cos(t)
+    return np.min(np.hypot(points[:, 0:1] - e_x, points[:, 1:2] - e_y), axis=1)
+
+
+def test_ellipse_residuals():
+    rand = np.random.RandomState(6)
+    for a, b in [(30., 30.), (40., 30.), (40., 20.), (45., 12.)]:
+        params = (100., 80., a, b, rand.uniform(0, np.pi))
+        points = np.column_stack((rand.uniform(40, 160, 500), rand.uniform(20, 140, 500)))
+        true_dist = ellipse_distance(params, points)
+        resids = model.ellipse_residuals(params, points)
+        inside = model.normalized_radius(params, points) < 1
+
+        # close to the true distance near the ellipse
+        near = true_dist < 2
+        np.testing.assert_allclose(resids[near], true_dist[near], atol=0.5)
+        # and not much more than it deep inside oblong ones
+        assert np.all(resids[inside] <= true_dist[inside] * 1.2 + 0.01)
@@ -0,0 +1,25 @@
+import numpy as np
+
+import runops
+
+
+def test_ellipse_sink_resume(tmpdir):
+    path = str(tmpdir.join("Ellall_test"))
+    params = {'roi': (0, 0, 100, 80), 'canny_sig': 2., 'files': ['a.avi']}
+    result = {'x': [1.], 'y': [2.], 'a': [3.], 'b': [4.], 't': [0.5], 'n': [1], 'v': [0.1], 'c': [0.2], 'g': [0.3]}
+
+    sink = runops.EllipseSink(path, chunk_frames=2, params=params)
+    for n in range(1, 6):
+        sink.append(n, dict(result, n=[n]))
+    sink.close()
+
+    # same params (more files don't matter) picks up where it left off
+    sink = runops.EllipseSink(path, resume=True, params=dict(params, files=['a.avi', 'b.avi']))
+    assert sink.done_frames == {1, 2, 3, 4, 5}
+    assert runops.first_unprocessed(sink.done_frames) == 6
+    np.testing.assert_array_equal(runops.load_ellipses(path)['n'], [1, 2, 3, 4, 5])
+
+    # different params start over rather than mixing results
+    sink = runops.EllipseSink(path, resume=True, params=dict(params, canny_sig=3.))
+    assert sink.done_frames == set()
+    assert len(runops.load_ellipses(path)) == 0
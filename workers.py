@@ -1,7 +1,9 @@
 import runops
+import imops
 import multiprocessing as mp
 import cv2
 import json
+import warnings
 from skimage import draw
 import numpy as np
 from tqdm import tqdm
@@ -37,7 +39,7 @@ def frame_worker2(input, output, params, pbar):
     c_list = []  # coverage - n_points/perimeter
     g_list = []  # gradient magnitude of edge points
 
-    thetas = np.linspace(0, np.pi*2, 200)
+    n_thetas = 200
     for frame, n in iter(input.get, 'END'):
         try:
             ellipses, frame_preproc, edge_mag = runops.process_frame(frame, params, crop=False, preproc=False)
@@ -47,39 +49,27 @@ def frame_worker2(input, output, params, pbar):
             pbar.put(1)
             continue
 
-        for e, n_pts in ellipses:
-            # ellipses actually gets returned as a tuple (ellipse object, n_pts)
-            if not e:
-                continue
-
-            x_list.append(e.params[0])
-            y_list.append(e.params[1])
-            a_list.append(e.params[2])
-            b_list.append(e.params[3])
-            t_list.append(e.params[4])
-            n_list.append(n)
-
-            # get mean darkness within each ellipse
-            # TODO: Validate - make sure we're getting the right shit here.
-            ell_mask_y, ell_mask_x = draw.ellipse(e.params[0], e.params[1], e.params[2], e.params[3],
-                                                  shape=(frame_preproc.shape[1], frame_preproc.shape[0]),
-                                                  rotation=e.params[4])
-            v_list.append(np.mean(frame_preproc[ell_mask_x, ell_mask_y]))
-
-            # coverage - number of points vs. circumference
-            # perim: https://stackoverflow.com/a/42311034
-            perimeter = np.pi * (3 * (e.params[2] + e.params[3]) -
-                                 np.sqrt((3 * e.params[2] + e.params[3]) *
-                                         (e.params[2] + 3 * e.params[3])))
-
-            c_list.append(float(n_pts) / perimeter)
-
-            # get the mean edge mag for predicted points on the ellipse,
-            # off-target ellipses often go through the pupil aka through areas with low gradients...
-            e_points = np.round(e.predict_xy(thetas)).astype(np.int)
-            e_points[:, 0] = np.clip(e_points[:, 0], 0, frame_preproc.shape[0] - 1)
-            e_points[:, 1] = np.clip(e_points[:, 1], 0, frame_preproc.shape[1] - 1)
-            g_list.append(np.mean(edge_mag[e_points[:, 0], e_points[:, 1]]))
+        # ellipses actually gets returned as a list of tuples (ellipse object, n_pts)
+        ellipses = [(e, n_pts) for e, n_pts in ellipses if e]
+        if len(ellipses) == 0:
+            pbar.put(1)
+            continue
+
+        ell_params = np.row_stack([e.params for e, n_pts in ellipses])
+        ell_npts = np.array([n_pts for e, n_pts in ellipses])
+
+        # get coverage, edge magnitude and mean darkness within each ellipse all at once
+        c, g, v = imops.score_ellipses(ell_params, ell_npts, frame_preproc, edge_mag, n_thetas=n_thetas)
+
+        x_list.extend(ell_params[:, 0])
+        y_list.extend(ell_params[:, 1])
+        a_list.extend(ell_params[:, 2])
+        b_list.extend(ell_params[:, 3])
+        t_list.extend(ell_params[:, 4])
+        n_list.extend([n]*len(ell_params))
+        v_list.extend(v)
+        c_list.extend(c)
+        g_list.extend(g)
 
         pbar.put(1)
 
@@ -98,6 +88,150 @@ def frame_worker2(input, output, params, pbar):
     output.put(ret_dict)
 
 
+class FrameRing(object):
+    """
+    A fixed number of frame slots in shared memory.
+
+    The decoder writes cropped frames into free slots and workers read them by slot index,
+    so only (slot, frame number) tuples are pickled between processes rather than the frames.
+    Putting a frame blocks until a worker releases a slot, so the ring also limits
+    how far ahead of the workers the decoder can get.
+
+    Pass the ring to worker processes when they're started.
+    """
+
+    def __init__(self, n_slots, shape):
+        self.n_slots = n_slots
+        self.shape = tuple(shape)
+        self.buffer = mp.RawArray('B', int(n_slots * np.prod(self.shape)))
+
+        # slot indices ready to be written to, and (slot, n_frame) ready to be processed
+        self.free = mp.Queue()
+        self.full = mp.Queue()
+        for i in range(n_slots):
+            self.free.put(i)
+
+    def frames(self):
+        # numpy view of all the slots, (n_slots, height, width)
+        return np.frombuffer(self.buffer, dtype=np.uint8).reshape((self.n_slots,) + self.shape)
+
+    def put(self, frame, n):
+        slot = self.free.get()
+        self.frames()[slot] = frame
+        self.full.put((slot, n))
+
+    def release(self, slot):
+        self.free.put(slot)
+
+    def stop(self, n_workers):
+        for i in range(n_workers):
+            self.full.put('END')
+
+
+def ring_worker(ring, output, params):
+    # process frames from a FrameRing, params are passed once when the process is started.
+    # puts (n_frame, result dict) for every frame
+    # workers each get every n_proc'th frame or so, so there's no tracking (params['track']) here,
+    # see shard_worker for that
+    frames = ring.frames()
+    workspace = imops.shape_constants(ring.shape).workspace
+    # each worker keeps its own equalizer and window. the frames it gets aren't contiguous,
+    # they're whichever frames were next when it was free (about every n_proc'th one), so the
+    # equalizer's drift check and the window compare against a frame a few frames back.
+    # still close enough in time to reuse equalization and follow the pupil, if they're turned on
+    equalizer = runops.make_equalizer(params)
+    window = runops.make_window(params)
+    for slot, n in iter(ring.full.get, 'END'):
+        try:
+            # read straight from shared memory, process_frame_all doesn't modify its frame
+            result = runops.process_frame_all(frames[slot], params, n, workspace=workspace,
+                                              equalizer=equalizer,
+                                              window=window.window() if window is not None else None)
+        except:
+            print('an exception in frame {}...'.format(n))
+            result = {}
+        if window is not None:
+            window.update(result)
+        ring.release(slot)
+        output.put((n, result))
+
+
+def seek(vid, n_frame):
+    # position a capture so the next read() returns frame n_frame (from 1, like CAP_PROP_POS_FRAMES
+    # after a read). cv2 seeks to the nearest keyframe and decodes up to the requested frame,
+    # but if the backend lands somewhere else, start over and grab our way there.
+    # that decodes every frame before n_frame, so it's slow for ranges late in long videos
+    if n_frame <= 1:
+        return
+    vid.set(cv2.CAP_PROP_POS_FRAMES, n_frame-1)
+    if int(vid.get(cv2.CAP_PROP_POS_FRAMES)) != n_frame-1:
+        warnings.warn("Couldn't seek to frame {}, grabbing every frame up to it instead".format(n_frame))
+        vid.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        for i in range(n_frame-1):
+            if not vid.grab():
+                break
+
+
+def shard_worker(tasks, output, params):
+    # decode and process whole frame ranges, so neither frames nor decoding go through the parent.
+    # tasks are (video file, start, stop) frame ranges (see runops.frame_ranges), and for each one
+    # the worker puts (file, n_frame, result dict) for every frame it reads, then (file, None, None)
+    # once the range is finished -- always, even if reading the range fails partway,
+    # so the parent doesn't wait on it forever.
+    # with params['track'], each range is tracked on its own with a runops.PupilTracker,
+    # so ranges can still be processed in parallel.
+    vid = None
+    vid_file = None
+    workspace = imops.shape_constants(params['shape']).workspace
+    for file, start, stop in iter(tasks.get, 'END'):
+        try:
+            # keep the capture open if the next range is from the same video
+            if file != vid_file:
+                if vid is not None:
+                    vid.release()
+                vid = cv2.VideoCapture(file)
+                vid_file = file
+            seek(vid, start)
+            # ranges aren't necessarily next to each other, start equalization & tracking fresh
+            equalizer = runops.make_equalizer(params)
+            tracker = runops.make_tracker(params, equalizer=equalizer)
+            window = runops.make_window(params)
+
+            for i in range(start, stop):
+                ret, frame = vid.read()
+                if ret == False:
+                    break
+                n = vid.get(cv2.CAP_PROP_POS_FRAMES)
+
+                try:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+                    frame = imops.crop(frame, params['roi'])
+                    if tracker is not None:
+                        result = tracker.step(frame, n)
+                    else:
+                        result = runops.process_frame_all(frame, params, n, workspace=workspace,
+                                                          equalizer=equalizer,
+                                                          window=window.window() if window is not None else None)
+                except:
+                    print('an exception in frame {}...'.format(n))
+                    result = {}
+                if window is not None and tracker is None:
+                    window.update(result)
+                output.put((file, n, result))
+        except:
+            print('an exception in frames {}-{} of {}...'.format(start, stop, file))
+            # don't reuse a capture that might be in a bad state
+            if vid is not None:
+                vid.release()
+            vid = None
+            vid_file = None
+        finally:
+            output.put((file, None, None))
+
+    if vid is not None:
+        vid.release()
+
+
 def result_grabber(input):
     results = []
     for result in iter(input.get, 'END'):